@@ -0,0 +1,86 @@
+import unittest
+import io
+import os
+import tempfile
+import threading
+from cryptography.hazmat.primitives.asymmetric import rsa
+import key_store as ks
+import key_agent as ka
+from PGPFacade import PGPFacade
+
+class RingStores:
+    # the parts of KeyManager the agent uses
+    def __init__(self, filename):
+        self.public_key_store = ks.PublicKeyStore(filename, filename)
+        self.private_key_store = ks.PrivateKeyStore(filename, unlock_cache_size=8)
+
+    def get_public_key_store(self): return self.public_key_store
+
+    def get_private_key_store(self): return self.private_key_store
+
+    def stats(self): return {"private": self.private_key_store.stats()}
+
+class KeyAgentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ring = os.path.join(self.tmpdir.name, "ring.json")
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        self.key_id = self.private_key.public_key().public_numbers().n % (2 ** 64)
+        writer = RingStores(self.ring)
+        writer.public_key_store.add_key(self.private_key.public_key(), "user@mail", "user")
+        writer.private_key_store.add_key(self.private_key.public_key(), self.private_key, "user@mail", "password", "user")
+        self.server = ka.KeyAgentServer(os.path.join(self.tmpdir.name, "agent.sock"), RingStores(self.ring))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.private_ks, self.public_ks = ka.load_agent_key_stores(self.server.socket_path)
+
+    def tearDown(self):
+        self.server.shutdown(); self.server.server_close()
+        self.private_ks.client.close()
+        self.tmpdir.cleanup()
+
+    def test_socket_owner_only(self):
+        self.assertEqual(os.stat(self.server.socket_path).st_mode & 0o777, 0o600)
+
+    def test_lookups(self):
+        self.assertEqual(self.public_ks.get_key_by_kid(self.key_id).public_numbers(), self.private_key.public_key().public_numbers())
+        self.assertEqual(len(self.public_ks.get_key_by_uid("user@mail")), 1)
+        self.assertEqual([kid for kid, key in self.public_ks.get_kid_key_pairs_by_uid("user@mail")], [self.key_id])
+        self.assertEqual(self.public_ks.get_uid_by_kid(self.key_id), "user@mail")
+        self.assertIsNone(self.public_ks.get_key_by_kid(1))
+        self.assertIsNone(self.private_ks.get_key_by_kid(self.key_id, "wrong password"))
+        self.assertEqual(self.private_ks.get_key_by_kid(self.key_id, "password").key_size, 1024)
+        self.assertEqual(len(self.private_ks.get_key_by_uid("user@mail", "password")), 1)
+
+    def test_facade_through_agent(self):
+        facade = PGPFacade(self.private_ks, self.public_ks)
+        facade.set_send_msg_params(self.key_id, "password", self.key_id, self.key_id)
+        options = ["compression", "radix64", "sign_msg", "aes_encrypt", "3des_encrypt"]
+        msg = facade.pgp_encrypt_message(b"through the agent" * 50, "agent_test", options, save_file=False)
+        self.assertEqual(facade.pgp_decrypt_message(msg, "agent_test", "password", options, save_file=False), b"through the agent" * 50)
+        sink = io.BytesIO()
+        facade.pgp_decrypt_stream(io.BytesIO(msg), sink, "password", options)
+        self.assertEqual(sink.getvalue(), b"through the agent" * 50)
+        # the key was unlocked once, by the agent
+        stats = self.private_ks.client.call("stats")["stats"]["private"]
+        self.assertEqual(stats["unlocks"], 1)
+
+    def test_ring_changes_picked_up(self):
+        other_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        other_id = other_key.public_key().public_numbers().n % (2 ** 64)
+        self.assertIsNone(self.public_ks.get_key_by_kid(other_id))
+        writer = RingStores(self.ring)
+        writer.public_key_store.add_key(other_key.public_key(), "other@mail", "other")
+        os.utime(self.ring, (0, os.path.getmtime(self.ring) + 1)) # mtime granularity
+        self.assertIsNotNone(self.public_ks.get_key_by_kid(other_id))
+
+    def test_errors(self):
+        with self.assertRaises(ka.KeyAgentError):
+            self.private_ks.client.call("sign_digest", kid=str(self.key_id), passwd="wrong password", digest="")
+        with self.assertRaises(ka.KeyAgentError):
+            self.private_ks.client.call("no such op")
+        # the connection is still usable
+        self.assertEqual(self.private_ks.client.call("ping"), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import threading
+from concurrent.futures import Future
+import key_pool as kp
+
+class ManualExecutor:
+    # futures stay pending until complete() is called
+    def __init__(self): self.pending = []
+
+    def submit(self, fn, *args):
+        future = Future(); self.pending.append((future, fn, args))
+        return future
+
+    def complete(self, count=None):
+        for i in range(count if count is not None else len(self.pending)):
+            future, fn, args = self.pending.pop(0)
+            future.set_result(fn(*args))
+
+    def fail(self):
+        future, fn, args = self.pending.pop(0)
+        future.set_exception(RuntimeError("worker died"))
+
+class KeyPoolTests(unittest.TestCase):
+
+    def test_pool_filled_and_refilled(self):
+        executor = ManualExecutor()
+        pool = kp.KeyPool({1024: 2}, executor=executor).start()
+        self.assertEqual(len(executor.pending), 2)
+        self.assertIsNone(pool.take(1024))
+        executor.complete()
+        self.assertEqual(pool.stats()["ready_1024"], 2)
+        self.assertEqual(pool.take(1024).key_size, 1024)
+        # taking a key starts generating its replacement
+        self.assertEqual(len(executor.pending), 1)
+
+    def test_job_waits_for_key(self):
+        executor = ManualExecutor()
+        pool = kp.KeyPool({}, executor=executor)
+        job = pool.submit(1024, lambda private_key: private_key.key_size)
+        self.assertEqual(job.status, kp.JOB_PENDING)
+        self.assertIs(pool.get_job(job.job_id), job)
+        executor.complete()
+        self.assertEqual((job.status, job.result), (kp.JOB_DONE, 1024))
+        # the key went to the job, not to the pool
+        self.assertEqual(pool.stats()["ready_1024"], 0)
+
+    def test_job_from_pool_and_failures(self):
+        executor = ManualExecutor()
+        pool = kp.KeyPool({1024: 1}, executor=executor).start()
+        executor.complete()
+        job = pool.submit(1024, lambda private_key: 1 / 0)
+        self.assertEqual(job.status, kp.JOB_FAILED)
+        self.assertIn("ZeroDivisionError", job.to_dict()["error"])
+
+    def test_failed_key_replaced(self):
+        executor = ManualExecutor()
+        pool = kp.KeyPool({1024: 1}, executor=executor, retry_delay=0.01).start()
+        executor.fail()
+        # not right away, after the retry delay
+        self.assertEqual((len(executor.pending), pool.failures[1024]), (0, 1))
+        for i in range(500):
+            if executor.pending: break
+            threading.Event().wait(0.01)
+        self.assertEqual(len(executor.pending), 1)
+        executor.complete()
+        self.assertEqual(pool.stats()["ready_1024"], 1)
+        self.assertEqual(pool.failures[1024], 0)
+
+    def test_process_pool(self):
+        pool = kp.KeyPool({1024: 1}, max_workers=1).start()
+        try:
+            done = threading.Event()
+            job = pool.submit(1024, lambda private_key: done.set() or "stored")
+            self.assertTrue(done.wait(60))
+            self.assertEqual(job.result, "stored")
+        finally:
+            pool.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+""" Startup time of PublicKeyStore for large rings.
+    usage: python KeyStoreBench.py [number of keys] """
+
+import sys
+import os
+import json
+import time
+import tempfile
+from datetime import datetime
+from cryptography.hazmat.primitives.asymmetric import rsa
+import key_store as ks
+
+def make_ring(filename, key_count, distinct_keys=16):
+    # generating tens of thousands of RSA keys takes too long, the same PEMs
+    # are reused under different key ids - parsing cost is the same
+    pems = [ks.PublicKeyStore.serialize_public_key(
+        rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()) for i in range(distinct_keys)]
+    timestamp = datetime.now().isoformat()
+    ring = {str(kid): [pems[kid % distinct_keys], "user" + str(kid) + "@bench", timestamp, "user" + str(kid)] for kid in range(key_count)}
+    with open(filename, "w") as f: json.dump({"public_key_store": ring}, f)
+
+def bench(label, fn, repeat=3):
+    best = min(timed(fn) for i in range(repeat))
+    print(" [*]\t%-40s %9.1f ms" % (label, best * 1000))
+    return best
+
+def timed(fn):
+    start = time.perf_counter(); fn(); return time.perf_counter() - start
+
+def load_store(filename):
+    return ks.PublicKeyStore(filename, filename)
+
+def load_store_and_parse_all(filename):
+    store = load_store(filename)
+    for key_id in store.keys_by_kid: store.get_key_by_kid(key_id)
+    return store
+
+if __name__ == "__main__":
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    fd, filename = tempfile.mkstemp(suffix=".json"); os.close(fd)
+    try:
+        make_ring(filename, key_count)
+        print(" [*]\tPublicKeyStore startup, %d keys" % key_count)
+        lazy = bench("load (keys parsed on first use)", lambda: load_store(filename))
+        eager = bench("load + parse every key", lambda: load_store_and_parse_all(filename))
+        store = load_store(filename)
+        bench("first lookup of one key", lambda: store.get_key_by_kid(key_count // 2), repeat=1)
+        print(" [*]\tlazy load is %.1fx faster" % (eager / lazy))
+    finally:
+        os.remove(filename)
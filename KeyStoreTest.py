@@ -0,0 +1,256 @@
+import unittest
+import json
+from datetime import datetime
+import os
+import tempfile
+from unittest import mock
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+import hashlib
+import key_store as ks
+import sqlite_key_store as sks
+import mock_key_store as mks
+from key_manager import KeyManager
+
+class PrivateKeyStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".json"); os.close(fd); os.remove(self.filename)
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        self.key_id = self.private_key.public_key().public_numbers().n % (2 ** 64)
+
+    def tearDown(self):
+        if os.path.exists(self.filename): os.remove(self.filename)
+
+    def make_store(self, **kwargs):
+        store = ks.PrivateKeyStore(self.filename, **kwargs)
+        store.add_key(self.private_key.public_key(), self.private_key, "user@mail", "password", "user")
+        return store
+
+    def test_unlock_cache_skips_kdf(self):
+        store = self.make_store(unlock_cache_size=4)
+        with mock.patch.object(serialization, "load_pem_private_key", wraps=serialization.load_pem_private_key) as load:
+            for i in range(5): store.get_key_by_kid(self.key_id, "password")
+            store.get_key_by_uid("user@mail", "password")
+            self.assertEqual(load.call_count, 1)
+        self.assertEqual(store.unlock_cache_stats()["hits"], 5)
+        self.assertEqual(store.unlock_cache_stats()["misses"], 1)
+        self.assertIsNone(store.get_key_by_kid(self.key_id, "wrong password"))
+
+    def test_lock_and_ttl(self):
+        store = self.make_store(unlock_cache_size=4, unlock_ttl=60)
+        store.get_key_by_kid(self.key_id, "password")
+        store.lock(self.key_id)
+        store.get_key_by_kid(self.key_id, "password")
+        self.assertEqual(store.unlock_cache_stats()["misses"], 2)
+        with mock.patch.object(ks.time, "monotonic", return_value=ks.time.monotonic() + 61):
+            store.get_key_by_kid(self.key_id, "password")
+        self.assertEqual(store.unlock_cache_stats()["misses"], 3)
+        store.lock_all()
+        self.assertEqual(store.unlock_cache_stats()["size"], 0)
+
+    def test_unlock_cache_is_bounded(self):
+        cache = ks.UnlockedKeyCache(max_size=2)
+        for kid in range(3): cache.put(kid, "password", kid)
+        self.assertIsNone(cache.get(0, "password"))
+        self.assertEqual(cache.get(2, "password"), 2)
+
+    def test_unlock_cache_off_by_default(self):
+        store = self.make_store()
+        self.assertIsNone(store.unlock_cache_stats())
+        self.assertIsNotNone(store.get_key_by_kid(self.key_id, "password"))
+
+    def test_stats(self):
+        store = self.make_store(unlock_cache_size=4)
+        for i in range(3): store.get_key_by_kid(self.key_id, "password")
+        stats = store.stats()
+        self.assertEqual((stats["keys"], stats["unlocks"], stats["unlock_cache_hits"]), (1, 1, 2))
+        self.assertGreater(stats["unlock_seconds"], 0)
+
+class PublicKeyStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".json"); os.close(fd); os.remove(self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename): os.remove(self.filename)
+
+    def test_keys_parsed_lazily(self):
+        public_key = rsa.generate_private_key(public_exponent=65537, key_size=1024).public_key()
+        key_id = public_key.public_numbers().n % (2 ** 64)
+        ks.PublicKeyStore(self.filename, self.filename).add_key(public_key, "user@mail", "user")
+        store = ks.PublicKeyStore(self.filename, self.filename)
+        entry = store.keys_by_kid[key_id][0]
+        self.assertFalse(entry.is_parsed())
+        self.assertEqual(store.get_pem_by_kid(key_id), ks.PublicKeyStore.serialize_public_key(public_key))
+        self.assertFalse(entry.is_parsed())
+        self.assertEqual(store.get_key_by_kid(key_id).public_numbers(), public_key.public_numbers())
+        self.assertIs(store.get_key_by_kid(key_id), store.get_key_by_uid("user@mail")[0])
+        self.assertEqual(store.get_kid_key_pairs_by_uid("user@mail"), [(key_id, store.get_key_by_kid(key_id))])
+
+    def test_fingerprint_and_changes(self):
+        public_key = rsa.generate_private_key(public_exponent=65537, key_size=1024).public_key()
+        key_id = public_key.public_numbers().n % (2 ** 64)
+        der = public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        store = ks.PublicKeyStore(self.filename, self.filename)
+        changes = store.change_count()
+        store.add_public_key(public_key, "other@mail", "other")
+        self.assertNotEqual(store.change_count(), changes)
+        self.assertEqual(store.list_public_key_ring()[0][5], hashlib.sha256(der).hexdigest())
+        store.add_key(public_key, "user@mail", "user")
+        self.assertEqual(ks.PublicKeyStore(self.filename, self.filename).get_fingerprint_by_kid(key_id), hashlib.sha256(der).hexdigest())
+
+class KeyIndexTests(unittest.TestCase):
+
+    KEY_COUNT = 20000
+
+    @classmethod
+    def setUpClass(cls):
+        # large rings reuse a few PEMs under many key ids, only the indexes are tested
+        fd, cls.filename = tempfile.mkstemp(suffix=".json"); os.close(fd)
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        cls.public_pem = ks.PublicKeyStore.serialize_public_key(private_key.public_key())
+        cls.private_pem, cls.passwd_hash = ks.PrivateKeyStore.protect_key(private_key, "password")
+        timestamp = datetime.now().isoformat()
+        ring = {
+            "public_key_store": {str(kid): [cls.public_pem, "user%d@mail" % (kid % 100), timestamp, "name%d" % kid] for kid in range(cls.KEY_COUNT)},
+            "private_key_store": {str(kid): [cls.private_pem.decode(), cls.passwd_hash, "user%d@mail" % (kid % 100), timestamp, "name%d" % kid] for kid in range(cls.KEY_COUNT)}
+        }
+        with open(cls.filename, "w") as f: json.dump(ring, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.filename)
+
+    def assert_indexes_consistent(self, store):
+        self.assertEqual(sum(len(kids) for kids in store.keys_by_uid.values()), len(store.keys_by_kid))
+        self.assertEqual(sum(len(kids) for kids in store.keys_by_name.values()), len(store.keys_by_kid))
+        for key_id, entry in store.keys_by_kid.items():
+            self.assertIn(key_id, store.keys_by_uid[entry[store.UID]])
+            self.assertIn(key_id, store.keys_by_name[entry[store.NAME]])
+
+    def test_public_indexes(self):
+        store = ks.PublicKeyStore(self.filename, self.filename)
+        self.assertEqual(len(store.get_key_by_uid("user7@mail")), self.KEY_COUNT // 100)
+        self.assertIsNotNone(store.get_key_by_name("name123"))
+        self.assertIsNone(store.get_key_by_name("no such name"))
+        self.assertEqual(store.get_uid_by_kid(123), "user23@mail")
+        with mock.patch.object(store, "save_keys"):
+            for kid in range(0, self.KEY_COUNT, 2): store.remove_key(kid)
+        # user ids of even key ids are gone, odd ones are untouched
+        self.assertEqual(len(store.get_key_by_uid("user7@mail")), self.KEY_COUNT // 100)
+        self.assertIsNone(store.get_key_by_name("name122"))
+        self.assertIsNone(store.get_uid_by_kid(122))
+        self.assertNotIn("user8@mail", store.keys_by_uid)
+        self.assert_indexes_consistent(store)
+
+    def test_private_indexes(self):
+        store = ks.PrivateKeyStore(self.filename)
+        with mock.patch.object(store, "unlock", return_value="unlocked"):
+            self.assertEqual(len(store.get_key_by_uid("user7@mail", "password")), self.KEY_COUNT // 100)
+            self.assertEqual(store.get_key_by_uid("user7@mail", "wrong password"), [])
+            self.assertEqual(store.get_key_by_name("name123", "password"), "unlocked")
+        with mock.patch.object(store, "save_keys"):
+            for kid in range(0, self.KEY_COUNT, 2): store.remove_key(kid)
+        self.assertEqual(len(store.keys_by_uid.key_ids("user7@mail")), self.KEY_COUNT // 100)
+        self.assertEqual(store.keys_by_uid.key_ids("user8@mail"), [])
+        self.assertIsNone(store.get_key_by_name("name122", "password"))
+        self.assertEqual(store.get_uid_by_kid(123), "user23@mail")
+        self.assert_indexes_consistent(store)
+
+    def test_readd_moves_key_between_indexes(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmpdir.name, "ring.json")
+        public_key = rsa.generate_private_key(public_exponent=65537, key_size=1024).public_key()
+        store = ks.PublicKeyStore(filename, filename)
+        store.add_key(public_key, "old@mail", "old")
+        store.add_key(public_key, "new@mail", "new")
+        self.assertEqual(store.get_key_by_uid("old@mail"), [])
+        self.assertIsNone(store.get_key_by_name("old"))
+        self.assertEqual(len(store.get_key_by_uid("new@mail")), 1)
+        self.assert_indexes_consistent(store)
+        tmpdir.cleanup()
+
+class SQLiteKeyStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_filename = os.path.join(self.tmpdir.name, "keys.db")
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        self.public_key = self.private_key.public_key()
+        self.key_id = self.public_key.public_numbers().n % (2 ** 64)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_add_get_remove(self):
+        puks = sks.SQLitePublicKeyStore(self.db_filename)
+        prks = sks.SQLitePrivateKeyStore(self.db_filename)
+        puks.add_key(self.public_key, "user@mail", "user")
+        prks.add_key(self.public_key, self.private_key, "user@mail", "password", "user")
+        # reopening sees the writes
+        puks = sks.SQLitePublicKeyStore(self.db_filename)
+        prks = sks.SQLitePrivateKeyStore(self.db_filename)
+        self.assertEqual(puks.get_key_by_kid(self.key_id).public_numbers(), self.public_key.public_numbers())
+        self.assertEqual(len(puks.get_key_by_uid("user@mail")), 1)
+        self.assertEqual([kid for kid, key in puks.get_kid_key_pairs_by_uid("user@mail")], [self.key_id])
+        self.assertIsNotNone(puks.get_key_by_name("user"))
+        self.assertEqual(prks.get_key_by_kid(self.key_id, "password").private_numbers(), self.private_key.private_numbers())
+        self.assertIsNone(prks.get_key_by_kid(self.key_id, "wrong password"))
+        self.assertEqual(len(prks.get_key_by_uid("user@mail", "password")), 1)
+        self.assertIsNotNone(prks.get_key_by_name("user", "password"))
+        self.assertEqual(puks.stats(), {"keys": 1, "public_ring_keys": 0, "parsed_keys": 1})
+        self.assertEqual(prks.stats()["keys"], 1)
+        puks.remove_key(self.key_id); prks.remove_key(self.key_id)
+        self.assertIsNone(puks.get_key_by_kid(self.key_id))
+        self.assertIsNone(prks.get_key_by_kid(self.key_id, "password"))
+
+    def test_import_json_rings(self):
+        private_ring = os.path.join(self.tmpdir.name, "private.json")
+        public_ring = os.path.join(self.tmpdir.name, "public.json")
+        ks.PublicKeyStore(private_ring, public_ring).add_key(self.public_key, "user@mail", "user")
+        ks.PublicKeyStore(private_ring, public_ring).add_public_key(self.public_key, "other@mail", "other")
+        ks.PrivateKeyStore(private_ring).add_key(self.public_key, self.private_key, "user@mail", "password", "user")
+        self.assertEqual(sks.import_json_rings(self.db_filename, private_ring, public_ring), (1, 1, 1))
+        prks = sks.SQLitePrivateKeyStore(self.db_filename)
+        self.assertIsNotNone(prks.get_key_by_kid(self.key_id, "password"))
+        self.assertEqual([k[0] for k in sks.SQLitePublicKeyStore(self.db_filename).list_public_key_ring()], [self.key_id])
+
+    def test_key_ring_listings_cached(self):
+        manager = KeyManager(db_filename=self.db_filename)
+        manager.add_key_pair(self.private_key, "user", "user@mail", "password")
+        listing, etag, body = manager.cached_key_ring("private")
+        self.assertEqual(json.loads(body), listing)
+        self.assertEqual(listing["private_key_ring"][0]["fingerprint"], manager.get_public_key_store().get_fingerprint_by_kid(self.key_id))
+        self.assertIs(manager.cached_key_ring("private")[0], listing)
+        self.assertIs(manager.cached_key_ring("private")[2], body)
+        self.assertEqual(KeyManager(db_filename=self.db_filename).cached_key_ring("private")[1], etag)
+        # writes through another connection (process) are noticed too
+        sks.SQLitePublicKeyStore(self.db_filename).add_public_key(self.public_key, "other@mail", "other")
+        self.assertEqual(len(manager.list_public_key_ring()["public_key_ring"]), 1)
+        manager.remove_key(self.key_id)
+        self.assertEqual(manager.list_private_key_ring(), {"private_key_ring": []})
+        self.assertNotEqual(manager.cached_key_ring("private")[1], etag)
+
+class MockKeyStoreTests(unittest.TestCase):
+
+    def test_fixture_keys_reused(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(mks, "FIXTURE_FILE", os.path.join(tmpdir, "keys.json")), mock.patch.dict(mks.fixture_keys, clear=True):
+                key = mks.fixture_key("test", 1024)
+                mks.fixture_keys.clear()
+                with mock.patch.object(rsa, "generate_private_key") as generate:
+                    self.assertEqual(mks.fixture_key("test", 1024).private_numbers(), key.private_numbers())
+                    generate.assert_not_called()
+                self.assertEqual(mks.fixture_key("test", 2048).key_size, 2048)
+
+    def test_mock_keys_from_fixture(self):
+        with mock.patch.object(rsa, "generate_private_key") as generate:
+            self.assertEqual(mks.MockPRKStore().get_key_by_uid("prk1_2048", "password").key_size, 2048)
+            generate.assert_not_called()
+        self.assertEqual(mks.MockPUKStore().get_key_by_kid(0), mks.public_key_data["puk1_2048"])
+        kid, key = mks.MockPUKStore().get_kid_key_pairs_by_uid("puk1_2048")[0]
+        self.assertEqual(kid, key.public_numbers().n % (2 ** 64))
+
+if __name__ == '__main__':
+    unittest.main()
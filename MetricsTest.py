@@ -0,0 +1,43 @@
+import unittest
+import io
+import metrics
+import mock_key_store as mks
+from PGPFacade import PGPFacade
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(buckets=(1, 2))
+        for value in [0.5, 1, 1.5, 3]: histogram.observe(value)
+        self.assertEqual(list(histogram.cumulative_counts()), [(1, 2), (2, 3), ("+Inf", 4)])
+        self.assertEqual(histogram.sum, 6)
+
+    def test_facade_stage_hook(self):
+        stage_metrics = metrics.StageMetrics()
+        facade = PGPFacade(mks.MockPRKStore(), mks.MockPUKStore(), stage_metrics.record)
+        facade.set_send_msg_params("prk1_1024", "password", "puk1_1024", "puk1_1024")
+        options = ["compression", "radix64", "sign_msg", "aes_encrypt", "3des_encrypt"]
+        msg = facade.pgp_encrypt_message(b"timed" * 100, "metrics_test", options, save_file=False)
+        facade.pgp_decrypt_message(msg, "metrics_test", "password", options, save_file=False)
+        sink = io.BytesIO()
+        facade.pgp_decrypt_stream(io.BytesIO(msg), sink, "password", options)
+        stats = stage_metrics.stats()
+        for stage in ["key_unlock", "sign", "compression", "aes", "3des", "key_wrap", "radix64", "total"]:
+            self.assertEqual(stats[("encrypt", stage)]["count"], 1)
+        for stage in ["key_unlock", "key_unwrap", "radix64", "3des", "aes", "compression", "total"]:
+            self.assertEqual(stats[("decrypt", stage)]["count"], 2)
+        self.assertEqual(stats[("encrypt", "total")]["bytes"], 500)
+        self.assertEqual(stats[("decrypt", "total")]["bytes"], 1000)
+        text = stage_metrics.render()
+        self.assertIn('pgp_stage_duration_seconds_count{op="encrypt",stage="aes"} 1', text)
+        self.assertIn('pgp_stage_duration_seconds_bucket{op="decrypt",stage="total",le="+Inf"} 2', text)
+
+    def test_format_gauges(self):
+        text = metrics.format_gauges("pgp_key_store", {"public": {"keys": 3}, "private": {"keys": 2, "unlocks": 1, "cache": None}}, "store")
+        self.assertEqual(text.count("# TYPE pgp_key_store_keys gauge"), 1)
+        self.assertIn('pgp_key_store_keys{store="private"} 2', text)
+        self.assertIn('pgp_key_store_unlocks{store="private"} 1', text)
+        self.assertNotIn("cache", text)
+
+if __name__ == '__main__':
+    unittest.main()
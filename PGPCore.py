@@ -4,10 +4,22 @@ import cryptography.hazmat.primitives.ciphers.algorithms as cphr_algo
 import cryptography.hazmat.primitives.ciphers as cphr
 from cryptography.hazmat.primitives.ciphers.modes import CFB
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.poly1305 import Poly1305
+from cryptography.exceptions import InvalidTag, InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import padding, utils
 import zipfile as zf
+import zlib
+import bz2
+import lzma
+import io
+import itertools
+import mmap
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
 import codecs
+import struct
+import binascii
+import time
 
 class PGPCore():
 
@@ -16,7 +28,34 @@ class PGPCore():
     SKEY_SIZE_IN_BYTES = 16 # 16B = 128b - size of session key
     TRIPPLE_DES_BLOCK_SIZE = 8 # 8B = 64b
     AES128_BLOCK_SIZE = 16 # 16B = 128b
-    TEMP_DATA_FILE = "temp_data.tmp"
+    # AEAD ciphers, the 16B tag follows the ciphertext
+    AEAD_KEY_SIZE = 32 # AES-256-GCM and ChaCha20-Poly1305 both take 256b keys
+    AEAD_NONCE_SIZE = 12
+    AEAD_TAG_SIZE = 16
+    AEAD_ONESHOT_LIMIT = 2 ** 31 - 1 # larger buffers go through the stream stages
+    # segmented payloads - every segment is sealed on its own, with the nonce XORed with
+    # its number and the number plus a last segment flag as associated data, so segments
+    # can't be reordered, dropped or cut off at the end without decryption failing
+    SEGMENT_SIZE = 256 * 1024
+    SEGMENT_AAD = struct.Struct(">QB")
+    TEMP_DATA_FILE = "temp_data.tmp" # member name used inside zip-wrapped data
+    ZIP_MAGIC = b"PK\x03\x04" # zip local file header, marks legacy zip-wrapped data
+    ZLIB_LEVEL = 6
+    # compressed data starts with COMPRESSION_MAGIC, the algorithm id and the level
+    # (1B each). The magic can't start a zlib stream - its first byte has 8 in the
+    # low nibble - so data compressed by older versions is still recognized
+    COMPRESSION_MAGIC = b"\x89C"
+    COMPRESS_STORED = 0 # kept as is, the data didn't compress
+    COMPRESS_DEFLATE = 1
+    COMPRESS_BZ2 = 2
+    COMPRESS_LZMA = 3
+    COMPRESSION_ALGOS = {"stored": COMPRESS_STORED, "deflate": COMPRESS_DEFLATE, "bz2": COMPRESS_BZ2, "lzma": COMPRESS_LZMA}
+    COMPRESSION_LEVELS = {COMPRESS_STORED: 0, COMPRESS_DEFLATE: ZLIB_LEVEL, COMPRESS_BZ2: 9, COMPRESS_LZMA: 6} # defaults
+    # data is stored instead of compressed when a fast deflate of its first
+    # COMPRESSION_SAMPLE_SIZE bytes saves less than COMPRESSION_MIN_GAIN of them
+    COMPRESSION_SAMPLE_SIZE = 64 * 1024
+    COMPRESSION_MIN_GAIN = 0.05
+    STREAM_CHUNK_SIZE = 64 * 1024 # 64KB read size used by stream()
 
     def __init__(self, private_key, public_key, data, session_key=None, iv=None):
         self.private_key : RSAPrivateKey = private_key
@@ -25,6 +64,8 @@ class PGPCore():
         # symmetric algorithm parameters
         self.session_key = session_key
         self.iv = iv
+        self.aead = None # set by aes256_gcm()/chacha20_poly1305()
+        self.aad = b"" # associated data the AEAD tag covers besides the data, see set_associated_data
 
     def get_data(self):
         return self.data
@@ -34,21 +75,38 @@ class PGPCore():
         signature = hl.sha1(self.data).digest()
         return signature
 
-    def data_signature(self):
+    # signatures are RSA-PSS over a SHA-256 digest, the digest can be built
+    # chunk by chunk with new_hasher() while data streams through other stages
+    @staticmethod
+    def new_hasher():
+        return hashes.Hash(hashes.SHA256())
+
+    def digest_signature(self, digest : bytes):
         return self.private_key.sign(
-            self.data, padding.PSS(
+            digest, padding.PSS(
                 mgf=padding.MGF1(hashes.SHA256()),
                 salt_length=padding.PSS.MAX_LENGTH),
-            hashes.SHA256()
+            utils.Prehashed(hashes.SHA256())
         )
 
-    def verify_data_signature(self, signature):
+    def verify_digest_signature(self, signature, digest : bytes):
         return self.public_key.verify(
-            signature, self.data, padding.PSS(
+            bytes(signature), digest, padding.PSS(
                 mgf=padding.MGF1(hashes.SHA256()),
                 salt_length=padding.PSS.MAX_LENGTH),
-            hashes.SHA256()
+            utils.Prehashed(hashes.SHA256())
         )
+
+    def data_digest(self):
+        hasher = self.new_hasher()
+        hasher.update(self.data)
+        return hasher.finalize()
+
+    def data_signature(self):
+        return self.digest_signature(self.data_digest())
+
+    def verify_data_signature(self, signature):
+        return self.verify_digest_signature(signature, self.data_digest())
     
     def generate_session_key(self):
         self.session_key = os.urandom(self.SKEY_SIZE_IN_BYTES)
@@ -76,55 +134,87 @@ class PGPCore():
         self.decryptor = cipher.decryptor()
         return self
 
+    # AEAD modes - one pass encrypts and authenticates, decrypt() raises
+    # cryptography.exceptions.InvalidTag if the data was changed. The iv is the nonce
+    def aes256_gcm(self):
+        return self.aead_cipher(AESGCM, GCMEncryptStage, GCMDecryptStage)
+
+    # for hosts without AES instructions
+    def chacha20_poly1305(self):
+        return self.aead_cipher(ChaCha20Poly1305, ChaChaPolyEncryptStage, ChaChaPolyDecryptStage)
+
+    def aead_cipher(self, aead_class, encrypt_stage_class, decrypt_stage_class):
+        if self.session_key is None: self.session_key = os.urandom(self.AEAD_KEY_SIZE)
+        if self.iv is None: self.iv = os.urandom(self.AEAD_NONCE_SIZE)
+        self.aead = aead_class(self.session_key)
+        self.aead_stages = (encrypt_stage_class, decrypt_stage_class)
+        return self
+
+    # e.g. the message header, decryption fails if it isn't the same as when encrypting
+    def set_associated_data(self, aad : bytes):
+        self.aad = bytes(aad)
+        return self
+
+    def segment_nonce(self, index : int) -> bytes:
+        return (int.from_bytes(self.iv, "big") ^ index).to_bytes(len(self.iv), "big")
+
+    # call after aes256_gcm()/chacha20_poly1305(), these don't touch self.data
+    def encrypt_segment(self, index : int, data, last : bool) -> bytes:
+        return self.aead.encrypt(self.segment_nonce(index), data, self.aad + self.SEGMENT_AAD.pack(index, last))
+
+    def decrypt_segment(self, index : int, data, last : bool) -> bytes:
+        return self.aead.decrypt(self.segment_nonce(index), data, self.aad + self.SEGMENT_AAD.pack(index, last))
+
     def encrypt(self):
+        if self.aead is not None:
+            if len(self.data) > self.AEAD_ONESHOT_LIMIT: self.data = b"".join(run_stages([self.data], [self.encrypt_stage()]))
+            else: self.data = self.aead.encrypt(self.iv, self.data, self.aad)
+            return self
         self.data = self.encryptor.update(self.data) + self.encryptor.finalize()
         return self
     
     def decrypt(self):
+        if self.aead is not None:
+            if len(self.data) > self.AEAD_ONESHOT_LIMIT: self.data = b"".join(run_stages([self.data], [self.decrypt_stage()]))
+            else: self.data = self.aead.decrypt(self.iv, self.data, self.aad)
+            return self
         self.data = self.decryptor.update(self.data) + self.decryptor.finalize()
         #self.data = self.data.decode(encoding="UTF-8")
         return self
     
-    def del_temp_data(self):
-        os.remove(self.TEMP_DATA_FILE)
-        return self
-
-    def write_data_to_tmp(self):
-        with open(self.TEMP_DATA_FILE, "wb") as f: f.write(self.data)
-        return self
-    
-    def read_data_from_temp(self):
-        with open(self.TEMP_DATA_FILE, "rb") as f: self.data = f.read()
-        self.del_temp_data()
-        return self
-    
     def zip_to_file(self, filename: str):
         if not filename.endswith(".zip"): filename += ".zip"
-        self.write_data_to_tmp()
         with zf.ZipFile(filename, "w", zf.ZIP_DEFLATED) as zipf:
-            zipf.write(self.TEMP_DATA_FILE)
-        self.del_temp_data()
+            zipf.writestr(self.TEMP_DATA_FILE, self.data)
         return self
     
     def unzip_from_file(self, filename: str):
         if not filename.endswith(".zip"): filename += ".zip"
         with zf.ZipFile(filename, "r", zf.ZIP_DEFLATED) as zipf:
-            zipf.extract(member=self.TEMP_DATA_FILE, path="./arch_" + self.TEMP_DATA_FILE)
-        os.replace("./arch_" + self.TEMP_DATA_FILE + "/" + self.TEMP_DATA_FILE, "./" + self.TEMP_DATA_FILE)
-        os.rmdir("./arch_" + self.TEMP_DATA_FILE)
-        self.read_data_from_temp()
+            self.data = zipf.read(self.TEMP_DATA_FILE)
         return self
     
-    def zip(self):
-        self.zip_to_file("tmp_data.zip")
-        with open("tmp_data.zip", "rb") as f: self.data = f.read()
-        os.remove("tmp_data.zip")
+    # compresses data in memory, no filesystem access. algo is a name from
+    # COMPRESSION_ALGOS or its id, level None takes the algorithm's default.
+    # Data that doesn't compress (see COMPRESSION_MIN_GAIN) is stored as is
+    def zip(self, algo="deflate", level=None, min_gain=None):
+        algo, level = choose_compression(algo, level, min_gain, self.data[:self.COMPRESSION_SAMPLE_SIZE])
+        compressor = new_compressor(algo, level)
+        data = compressor.compress(self.data) + compressor.flush()
+        # the sample can be misleading, never make the data bigger
+        if algo != self.COMPRESS_STORED and len(data) >= len(self.data):
+            algo, level, data = self.COMPRESS_STORED, 0, bytes(self.data)
+        self.data = compression_header(algo, level) + data
         return self
     
-    def unzip(self):
-        with open("tmp_data.zip", "wb") as f: f.write(self.data)
-        self.unzip_from_file("tmp_data.zip")
-        os.remove("tmp_data.zip")
+    # zip_wrapped=None detects the format, True forces reading
+    # data zipped by older versions (a zip archive held in memory)
+    def unzip(self, zip_wrapped=None):
+        if zip_wrapped is None: zip_wrapped = bytes(self.data[:len(self.ZIP_MAGIC)]) == self.ZIP_MAGIC
+        if zip_wrapped:
+            with zf.ZipFile(io.BytesIO(self.data), "r") as zipf:
+                self.data = zipf.read(self.TEMP_DATA_FILE)
+        else: self.data = b"".join(run_stages([self.data], [UnzipStage()]))
         return self
 
     def rsa_publ_encry(self):
@@ -153,4 +243,669 @@ class PGPCore():
         self.data = codecs.decode(self.data, "base64")
         return self
 
+    # stream stages - incremental counterparts of the operations above,
+    # see stream() for how they are chained
+    def sign_stage(self):
+        return SignStage(self.private_key)
+
+    def verify_stage(self):
+        return VerifyStage(self.public_key)
+
+    def zip_stage(self, algo="deflate", level=None, min_gain=None):
+        return ZipStage(algo, level, min_gain)
+
+    def unzip_stage(self):
+        return UnzipStage()
+
+    # call after aes128()/tripple_des()/aes256_gcm()/chacha20_poly1305()
+    def encrypt_stage(self):
+        if self.aead is not None: return self.aead_stages[0](self.session_key, self.iv, self.aad)
+        return CipherStage(self.encryptor)
+
+    def decrypt_stage(self):
+        if self.aead is not None: return self.aead_stages[1](self.session_key, self.iv, self.aad)
+        return CipherStage(self.decryptor)
+
+    def radix64_encode_stage(self):
+        return Radix64EncodeStage()
+
+    def radix64_decode_stage(self):
+        return Radix64DecodeStage()
+
+    def armor_encode_stage(self, headers=None):
+        return ArmorEncodeStage(headers)
+
+    def armor_decode_stage(self):
+        return ArmorDecodeStage()
+
+    # ASCII armor (radix64 with BEGIN/END lines, headers and CRC24 checksum)
+    def armor_encode(self, headers=None):
+        self.data = b"".join(run_stages(iter_chunks(self.data), [ArmorEncodeStage(headers)]))
+        return self
+
+    # reads armored data and plain radix64 (radix64_encode output) alike
+    def armor_decode(self):
+        self.data = b"".join(run_stages(iter_chunks(self.data), [ArmorDecodeStage()]))
+        return self
+
+
+class StreamStage():
+
+    """ One step of a streaming pipeline. update() takes a chunk and returns
+    whatever output is ready, finalize() returns the rest once input ends """
+
+    def update(self, chunk) -> bytes: return bytes(chunk)
+
+    def finalize(self) -> bytes: return b""
+
+
+class TimedStage(StreamStage):
+
+    """ Wraps a stage and adds up the time spent in it and the bytes fed to it,
+    on_finalize(seconds, size) gets the totals once the wrapped stage is done """
+
+    def __init__(self, stage, on_finalize):
+        self.stage = stage
+        self.on_finalize = on_finalize
+        self.seconds = 0.0
+        self.size = 0
+
+    def update(self, chunk):
+        started = time.perf_counter()
+        out = self.stage.update(chunk)
+        self.seconds += time.perf_counter() - started
+        self.size += len(chunk)
+        return out
+
+    def finalize(self):
+        started = time.perf_counter()
+        out = self.stage.finalize()
+        self.on_finalize(self.seconds + time.perf_counter() - started, self.size)
+        return out
+
+
+class SignStage(StreamStage):
+
+    """ Passes data through unchanged while hashing it, the RSA-PSS
+    signature of everything seen is appended on finalize """
+
+    def __init__(self, private_key : RSAPrivateKey):
+        self.signer = PGPCore(private_key, None, None)
+        self.hasher = PGPCore.new_hasher()
+
+    def update(self, chunk):
+        self.hasher.update(chunk)
+        return bytes(chunk)
+
+    def finalize(self):
+        return self.signer.digest_signature(self.hasher.finalize())
+
+
+class VerifyStage(StreamStage):
+
+    """ Counterpart of SignStage - holds back the trailing signature, passes
+    the rest through and raises InvalidSignature on finalize if it doesn't match """
+
+    def __init__(self, public_key : RSAPublicKey):
+        self.verifier = PGPCore(None, public_key, None)
+        self.hasher = PGPCore.new_hasher()
+        self.signature_size = (public_key.key_size + 7) // 8
+        self.tail = bytearray()
+
+    def update(self, chunk):
+        self.tail += chunk
+        ready = len(self.tail) - self.signature_size
+        if ready <= 0: return b""
+        out = bytes(self.tail[:ready])
+        del self.tail[:ready]
+        self.hasher.update(out)
+        return out
+
+    def finalize(self):
+        self.verifier.verify_digest_signature(self.tail, self.hasher.finalize())
+        return b""
+
+
+class StoredCodec():
+
+    """ Compressor and decompressor for COMPRESS_STORED, passes data through """
+
+    eof = True
+
+    def compress(self, data): return bytes(data)
+
+    def decompress(self, data): return bytes(data)
+
+    def flush(self): return b""
+
+
+def compression_algo_id(algo) -> int:
+    algo = PGPCore.COMPRESSION_ALGOS.get(algo, algo)
+    if algo not in PGPCore.COMPRESSION_LEVELS: raise ValueError("unknown compression algorithm " + str(algo))
+    return algo
+
+def compression_header(algo : int, level : int) -> bytes:
+    return PGPCore.COMPRESSION_MAGIC + bytes([algo, level])
+
+def compression_gain(sample) -> float:
+    """ fraction of sample saved by a fast deflate, a cheap estimate for every algorithm """
+    if not len(sample): return 0.0
+    return 1 - len(zlib.compress(sample, 1)) / len(sample)
+
+def choose_compression(algo, level, min_gain, sample):
+    """ (algorithm id, level) to compress data starting with sample """
+    algo = compression_algo_id(algo)
+    if min_gain is None: min_gain = PGPCore.COMPRESSION_MIN_GAIN
+    if algo != PGPCore.COMPRESS_STORED and compression_gain(sample) < min_gain: algo = PGPCore.COMPRESS_STORED
+    if algo == PGPCore.COMPRESS_STORED or level is None: level = PGPCore.COMPRESSION_LEVELS[algo]
+    return algo, level
+
+def new_compressor(algo : int, level : int):
+    if algo == PGPCore.COMPRESS_DEFLATE: return zlib.compressobj(level)
+    if algo == PGPCore.COMPRESS_BZ2: return bz2.BZ2Compressor(level)
+    if algo == PGPCore.COMPRESS_LZMA: return lzma.LZMACompressor(preset=level)
+    return StoredCodec()
+
+def new_decompressor(algo : int):
+    if algo == PGPCore.COMPRESS_DEFLATE: return zlib.decompressobj()
+    if algo == PGPCore.COMPRESS_BZ2: return bz2.BZ2Decompressor()
+    if algo == PGPCore.COMPRESS_LZMA: return lzma.LZMADecompressor()
+    if algo == PGPCore.COMPRESS_STORED: return StoredCodec()
+    raise ValueError("unknown compression algorithm " + str(algo))
+
+
+class ZipStage(StreamStage):
+
+    """ Holds back the first COMPRESSION_SAMPLE_SIZE bytes to pick between
+    algo and storing the data, then compresses as data comes in """
+
+    def __init__(self, algo="deflate", level=None, min_gain=None):
+        self.algo = compression_algo_id(algo)
+        self.level = level
+        self.min_gain = min_gain
+        self.sample = bytearray()
+        self.compressor = None
+
+    def start(self):
+        self.algo, self.level = choose_compression(self.algo, self.level, self.min_gain, self.sample)
+        self.compressor = new_compressor(self.algo, self.level)
+        out = compression_header(self.algo, self.level) + self.compressor.compress(self.sample)
+        self.sample = None
+        return out
+
+    def update(self, chunk):
+        if self.compressor is not None: return self.compressor.compress(chunk)
+        self.sample += chunk
+        return self.start() if len(self.sample) >= PGPCore.COMPRESSION_SAMPLE_SIZE else b""
+
+    def finalize(self):
+        out = self.start() if self.compressor is None else b""
+        return out + self.compressor.flush()
+
+
+class UnzipStage(StreamStage):
+
+    """ Reads ZipStage output and bare zlib streams (data compressed by older versions) """
+
+    HEADER_SIZE = len(PGPCore.COMPRESSION_MAGIC) + 2
+
+    def __init__(self):
+        self.head = b""
+        self.decompressor = None
+        self.algo = None
+        self.level = None
+
+    # True once the decompressor is set up, self.head then holds the data after the header
+    def read_header(self):
+        magic = PGPCore.COMPRESSION_MAGIC
+        if self.head[:len(magic)] != magic[:len(self.head)]:
+            self.algo = PGPCore.COMPRESS_DEFLATE
+            self.decompressor = zlib.decompressobj()
+            return True
+        if len(self.head) < self.HEADER_SIZE: return False
+        self.algo, self.level = self.head[len(magic)], self.head[len(magic) + 1]
+        self.decompressor = new_decompressor(self.algo)
+        self.head = self.head[self.HEADER_SIZE:]
+        return True
+
+    def update(self, chunk):
+        if self.decompressor is not None: return self.decompressor.decompress(chunk)
+        self.head += bytes(chunk)
+        if not self.head or not self.read_header(): return b""
+        data, self.head = self.head, b""
+        return self.decompressor.decompress(data)
+
+    def finalize(self):
+        if self.decompressor is None: raise zlib.error("compressed stream is truncated")
+        # zlib keeps some output until flush(), bz2 and lzma don't have one
+        data = self.decompressor.flush() if self.algo == PGPCore.COMPRESS_DEFLATE else b""
+        if not self.decompressor.eof: raise zlib.error("compressed stream is truncated")
+        return data
+
+
+class CipherStage(StreamStage):
+
+    """ Wraps an encryptor or decryptor context (see PGPCore.aes128/tripple_des) """
+
+    def __init__(self, cipher_ctx):
+        self.cipher_ctx = cipher_ctx
+
+    def update(self, chunk): return self.cipher_ctx.update(chunk)
+
+    def finalize(self): return self.cipher_ctx.finalize()
+
+
+class TagHoldBackStage(StreamStage):
+
+    """ Base of the AEAD decrypt stages - everything but the trailing
+    AEAD_TAG_SIZE bytes goes to decrypt(), check(tag) runs on finalize """
+
+    def __init__(self):
+        self.tail = b""
+
+    def update(self, chunk):
+        if len(chunk) >= PGPCore.AEAD_TAG_SIZE:
+            data = self.tail + bytes(chunk[:-PGPCore.AEAD_TAG_SIZE]) if self.tail else chunk[:-PGPCore.AEAD_TAG_SIZE]
+            self.tail = bytes(chunk[-PGPCore.AEAD_TAG_SIZE:])
+        else:
+            data = self.tail + bytes(chunk)
+            data, self.tail = data[:-PGPCore.AEAD_TAG_SIZE], data[-PGPCore.AEAD_TAG_SIZE:]
+        return self.decrypt(data) if len(data) else b""
+
+    def finalize(self):
+        if len(self.tail) != PGPCore.AEAD_TAG_SIZE: raise InvalidTag()
+        return self.check(self.tail)
+
+
+class GCMEncryptStage(StreamStage):
+
+    def __init__(self, key, nonce, aad=b""):
+        self.encryptor = cphr.Cipher(cphr_algo.AES(key), cphr.modes.GCM(nonce)).encryptor()
+        if aad: self.encryptor.authenticate_additional_data(aad)
+
+    def update(self, chunk): return self.encryptor.update(chunk)
+
+    def finalize(self): return self.encryptor.finalize() + self.encryptor.tag
+
+
+class GCMDecryptStage(TagHoldBackStage):
+
+    """ Decrypted data is passed on before the tag is checked, finalize raises InvalidTag """
+
+    def __init__(self, key, nonce, aad=b""):
+        super().__init__()
+        self.decryptor = cphr.Cipher(cphr_algo.AES(key), cphr.modes.GCM(nonce)).decryptor()
+        if aad: self.decryptor.authenticate_additional_data(aad)
+
+    def decrypt(self, data): return self.decryptor.update(data)
+
+    def check(self, tag): return self.decryptor.finalize_with_tag(tag)
+
+
+class ChaChaPolyEncryptStage(StreamStage):
+
+    """ ChaCha20-Poly1305 as in RFC 8439, built from ChaCha20 and Poly1305 since the
+    one-shot ChaCha20Poly1305 can't take data in chunks. Output is the same as
+    ChaCha20Poly1305.encrypt() """
+
+    def __init__(self, key, nonce, aad=b""):
+        # 4B little-endian block counter + 12B nonce, block 0 gives the Poly1305 key
+        self.cipher = cphr.Cipher(cphr_algo.ChaCha20(key, bytes(4) + nonce), None).encryptor()
+        self.mac = Poly1305(self.cipher.update(bytes(64))[:32])
+        self.mac.update(aad + bytes(-len(aad) % 16))
+        self.aad_size = len(aad)
+        self.size = 0
+
+    def update(self, chunk):
+        data = self.cipher.update(chunk)
+        self.mac.update(data)
+        self.size += len(data)
+        return data
+
+    def mac_trailer(self):
+        return bytes(-self.size % 16) + struct.pack("<QQ", self.aad_size, self.size)
+
+    def finalize(self):
+        self.mac.update(self.mac_trailer())
+        return self.mac.finalize()
+
+
+class ChaChaPolyDecryptStage(TagHoldBackStage):
+
+    def __init__(self, key, nonce, aad=b""):
+        super().__init__()
+        self.stream = ChaChaPolyEncryptStage(key, nonce, aad) # same keystream and MAC
+
+    def decrypt(self, data):
+        self.stream.mac.update(data)
+        self.stream.size += len(data)
+        return self.stream.cipher.update(data)
+
+    def check(self, tag):
+        self.stream.mac.update(self.stream.mac_trailer())
+        try:
+            self.stream.mac.verify(tag)
+        except InvalidSignature:
+            raise InvalidTag()
+        return b""
+
+
+class Radix64EncodeStage(StreamStage):
+
+    """ Same output as PGPCore.radix64_encode - lines of 76 characters,
+    so input is encoded in groups of 57 bytes """
+
+    GROUP_SIZE = 57
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def update(self, chunk):
+        self.pending += chunk
+        ready = len(self.pending) - len(self.pending) % self.GROUP_SIZE
+        if ready == 0: return b""
+        out = codecs.encode(bytes(self.pending[:ready]), "base64")
+        del self.pending[:ready]
+        return out
+
+    def finalize(self):
+        return codecs.encode(bytes(self.pending), "base64")
+
+
+class Radix64DecodeStage(StreamStage):
+
+    WHITESPACE = b" \t\r\n"
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def update(self, chunk):
+        self.pending += bytes(chunk).translate(None, self.WHITESPACE)
+        ready = len(self.pending) - len(self.pending) % 4
+        if ready == 0: return b""
+        out = binascii.a2b_base64(bytes(self.pending[:ready]))
+        del self.pending[:ready]
+        return out
+
+    def finalize(self):
+        if self.pending: raise binascii.Error("radix64 input is truncated")
+        return b""
+
+
+CRC24_INIT = 0xB704CE
+CRC24_POLY = 0x1864CFB
+
+CRC24_MASK_BITS = 2 ** 16
+
+def crc24_mulmod(a, b):
+    # a * b mod CRC24_POLY over GF(2)
+    result = 0
+    while b:
+        if b & 1: result ^= a
+        b >>= 1; a <<= 1
+        if a & 0x1000000: a ^= CRC24_POLY
+    return result
+
+def make_crc24_masks():
+    # bit j of x^i mod CRC24_POLY for i < CRC24_MASK_BITS, one int per j with bit i set
+    # if it is 1 - the remainder of a whole block is then 24 parities, computed in C
+    masks = [0] * 24
+    remainder = 1
+    for i in range(32):
+        for j in range(24):
+            if remainder >> j & 1: masks[j] |= 1 << i
+        remainder = crc24_mulmod(remainder, 2)
+    length, x_length = 32, crc24_mulmod(1 << 16, 1 << 16)
+    while length < CRC24_MASK_BITS:
+        # x^(i + length) = x^i * x^length, so the upper half is a linear map of the lower one
+        columns = [crc24_mulmod(1 << k, x_length) for k in range(24)]
+        upper = [0] * 24
+        for j in range(24):
+            for k in range(24):
+                if columns[k] >> j & 1: upper[j] ^= masks[k]
+        masks = [mask | (upper_mask << length) for mask, upper_mask in zip(masks, upper)]
+        length, x_length = length * 2, crc24_mulmod(x_length, x_length)
+    return masks
+
+CRC24_MASKS = make_crc24_masks()
+
+def crc24(data, crc=CRC24_INIT):
+    """ OpenPGP armor checksum (RFC 4880 6.1), pass the previous result as crc to continue it """
+    view = memoryview(data)
+    step = (CRC24_MASK_BITS - 24) // 8
+    for start in range(0, len(view), step):
+        block = view[start:start + step]
+        value = (crc << 8 * len(block)) ^ (int.from_bytes(block, "big") << 24)
+        crc = 0
+        for j, mask in enumerate(CRC24_MASKS):
+            crc |= ((value & mask).bit_count() & 1) << j
+    return crc
+
+
+class ArmorEncodeStage(StreamStage):
+
+    """ OpenPGP style ASCII armor - BEGIN line, headers, radix64 body in lines
+    of 64 characters, CRC24 checksum line and END line """
+
+    BEGIN = b"-----BEGIN PGP MESSAGE-----\n"
+    END = b"-----END PGP MESSAGE-----\n"
+    GROUP_SIZE = 48 # input bytes per 64 character line
+
+    def __init__(self, headers=None):
+        self.pending = bytearray()
+        self.crc = CRC24_INIT
+        self.started = False
+        self.headers = headers or {}
+
+    def start(self):
+        self.started = True
+        return self.BEGIN + b"".join((key + ": " + value + "\n").encode() for key, value in self.headers.items()) + b"\n"
+
+    def update(self, chunk):
+        out = b"" if self.started else self.start()
+        self.crc = crc24(chunk, self.crc)
+        self.pending += chunk
+        ready = len(self.pending) - len(self.pending) % self.GROUP_SIZE
+        if ready == 0: return out
+        view = memoryview(self.pending)
+        out += b"".join(binascii.b2a_base64(view[i:i + self.GROUP_SIZE]) for i in range(0, ready, self.GROUP_SIZE))
+        view.release()
+        del self.pending[:ready]
+        return out
+
+    def finalize(self):
+        out = b"" if self.started else self.start()
+        if self.pending: out += binascii.b2a_base64(bytes(self.pending))
+        return out + b"=" + binascii.b2a_base64(self.crc.to_bytes(3, "big")) + self.END
+
+
+class ArmorDecodeStage(StreamStage):
+
+    """ Decodes ArmorEncodeStage output line by line and checks the CRC24.
+    Input that doesn't start with a BEGIN line is read as plain radix64 """
+
+    def __init__(self):
+        self.line = bytearray() # incomplete line
+        self.state = "detect" # detect -> headers -> body -> end, or plain
+        self.body = Radix64DecodeStage()
+        self.crc = CRC24_INIT
+        self.checksum = None
+
+    def update(self, chunk):
+        if self.state == "plain": return self.body.update(chunk)
+        self.line += chunk
+        if self.state == "detect":
+            stripped = bytes(self.line).lstrip()
+            if len(stripped) < 5: return b""
+            if not stripped.startswith(b"-----"):
+                self.state = "plain"
+                data = bytes(self.line); self.line = bytearray()
+                return self.body.update(data)
+            self.state = "begin"
+        out = []
+        while True:
+            if self.state == "body": out.append(self.read_body_lines())
+            end = self.line.find(b"\n")
+            if end < 0: break
+            line = bytes(self.line[:end]).strip()
+            del self.line[:end + 1]
+            out.append(self.read_line(line))
+        return b"".join(out)
+
+    # decodes complete body lines in one go, up to a checksum or END line
+    def read_body_lines(self):
+        end = self.line.rfind(b"\n") + 1
+        for marker in (b"\n=", b"\n-"):
+            pos = self.line.find(marker, 0, end)
+            if pos >= 0: end = min(end, pos + 1)
+        if end == 0 or self.line[:1] in (b"=", b"-"): return b""
+        data = self.body.update(bytes(self.line[:end]))
+        del self.line[:end]
+        self.crc = crc24(data, self.crc)
+        return data
+
+    def read_line(self, line):
+        if self.state == "begin":
+            if line.startswith(b"-----BEGIN "): self.state = "headers"
+        elif self.state == "headers":
+            if not line: self.state = "body"
+            elif b":" not in line: raise binascii.Error("bad armor header " + line.decode(errors="replace"))
+        elif self.state == "body":
+            if line.startswith(b"-----END "): self.state = "end"
+            elif line.startswith(b"="): self.checksum = binascii.a2b_base64(line[1:])
+            else:
+                data = self.body.update(line)
+                self.crc = crc24(data, self.crc)
+                return data
+        return b""
+
+    def finalize(self):
+        if self.state == "plain": return self.body.finalize()
+        # plain radix64 too short to tell from a BEGIN line
+        if self.state == "detect":
+            self.state = "plain"
+            data = bytes(self.line); self.line = bytearray()
+            return self.body.update(data) + self.body.finalize()
+        if self.line.strip(): self.read_line(bytes(self.line).strip())
+        if self.state != "end": raise binascii.Error("armor END line missing")
+        self.body.finalize()
+        if self.checksum is not None and int.from_bytes(self.checksum, "big") != self.crc:
+            raise binascii.Error("armor checksum mismatch")
+        return b""
+
+
+def map_file(path):
+    """ Read-only memory map of a file, data is read from the page cache as it is
+    used instead of being copied to the heap. Empty files can't be mapped, b"" then """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close_map(source):
+    """ Closes a map from map_file, anything else is left alone. A map still viewed (e.g. by
+    the frames of a traceback) can't be closed yet, it is then closed when it is collected """
+    if not isinstance(source, mmap.mmap): return
+    try:
+        source.close()
+    except BufferError:
+        pass
+
+
+def as_buffer(source):
+    """ memoryview of bytes, bytearray, mmap, memoryview or any other buffer, None for anything else """
+    try:
+        view = memoryview(source)
+    except TypeError:
+        return None
+    return view if view.format == "B" and view.ndim == 1 else view.cast("B")
+
+
+def iter_chunks(source, chunk_size=PGPCore.STREAM_CHUNK_SIZE):
+    """ Yields chunks from a file path (memory mapped, see map_file), a buffer (memoryview
+    slices of it, nothing is copied), a readable file-like object, or passes through
+    an iterable of chunks (bytes, bytearray, memoryview) as it is """
+    if isinstance(source, (str, os.PathLike)): source = map_file(source)
+    view = as_buffer(source)
+    if view is not None:
+        for start in range(0, len(view), chunk_size): yield view[start:start + chunk_size]
+    elif hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk: return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk: yield chunk
+
+
+def iter_fixed_chunks(chunks, size : int):
+    """ Regroups chunks into pieces of exactly size bytes, the last one can be shorter.
+    Pieces that lie within one chunk are memoryview slices of it, not copies """
+    pending = bytearray()
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if pending:
+            fill = size - len(pending)
+            pending += view[:fill]
+            view = view[fill:]
+            if len(pending) < size: continue
+            yield bytes(pending)
+            pending = bytearray()
+        full = len(view) - len(view) % size
+        for start in range(0, full, size): yield view[start:start + size]
+        pending += view[full:]
+    if pending: yield bytes(pending)
+
+
+def iter_with_last(items):
+    """ Yields (item, True if it is the last one) """
+    items = iter(items)
+    for item in items:
+        for next_item in items:
+            yield item, False
+            item = next_item
+        yield item, True
+
+
+def peek_chunks(chunks, size : int):
+    """ Returns (the first size bytes of chunks or more - fewer if they end first, an iterator
+    over all of the chunks again), to look at a header before the rest is read """
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head = chunk if not len(head) else bytes(head) + bytes(chunk)
+        if len(head) >= size: break
+    return head, itertools.chain([head] if len(head) else [], chunks)
+
+
+def is_armored(data) -> bool:
+    """ True for data that starts with an armor BEGIN line (see ArmorEncodeStage) """
+    return bytes(data[:64]).lstrip().startswith(b"-----BEGIN ")
+
+
+def run_stages(chunks, stages : list):
+    """ Pushes chunks through stages in order, yields the output of the last stage """
+    for chunk in chunks:
+        for stage in stages:
+            chunk = stage.update(chunk)
+            if not chunk: break
+        else: yield chunk
+    # flush stages in order, output of each one still goes through the ones after it
+    for i in range(len(stages)):
+        chunk = stages[i].finalize()
+        for stage in stages[i + 1:]:
+            if not chunk: break
+            chunk = stage.update(chunk)
+        if chunk: yield chunk
+
 
+def stream(source, sink, stages : list, chunk_size=PGPCore.STREAM_CHUNK_SIZE):
+    """ Reads source chunk by chunk, runs it through stages and writes the result
+    to sink. Only about one chunk per stage is held in memory at a time.
+    Returns the number of bytes written """
+    written = 0
+    for chunk in run_stages(iter_chunks(source, chunk_size), stages):
+        sink.write(chunk)
+        written += len(chunk)
+    return written
@@ -3,7 +3,10 @@ import unittest
 import mock_key_store as mks
 import PGPCore as pgpc
 import os
-from cryptography.exceptions import InvalidSignature
+import io
+import tempfile
+import zlib
+from cryptography.exceptions import InvalidSignature, InvalidTag
 
 class PGPCoreTests(unittest.TestCase):
 
@@ -21,6 +24,28 @@ class PGPCoreTests(unittest.TestCase):
         pgpt.encrypt()
         self.assertEqual(msgt, pgpt.decrypt().get_data())
     
+    def test_aead_idemp(self):
+        msgt = os.urandom(10000)
+        for mode in [pgpc.PGPCore.aes256_gcm, pgpc.PGPCore.chacha20_poly1305]:
+            pgpt = mode(pgpc.PGPCore(1, 2, msgt))
+            encrypted = pgpt.encrypt().get_data()
+            self.assertEqual(len(encrypted), len(msgt) + pgpc.PGPCore.AEAD_TAG_SIZE)
+            decryptor = mode(pgpc.PGPCore(1, 2, encrypted, pgpt.get_session_key(), pgpt.get_iv()))
+            self.assertEqual(decryptor.decrypt().get_data(), msgt)
+            # stream stages give the same bytes, in chunks of any size
+            chunks = [msgt[i:i + 999] for i in range(0, len(msgt), 999)]
+            self.assertEqual(b"".join(pgpc.run_stages(chunks, [pgpt.encrypt_stage()])), encrypted)
+            for size in [5, 16, 1000]:
+                chunks = [encrypted[i:i + size] for i in range(0, len(encrypted), size)]
+                self.assertEqual(b"".join(pgpc.run_stages(chunks, [pgpt.decrypt_stage()])), msgt)
+            tampered = bytearray(encrypted); tampered[100] ^= 1
+            with self.assertRaises(InvalidTag):
+                mode(pgpc.PGPCore(1, 2, bytes(tampered), pgpt.get_session_key(), pgpt.get_iv())).decrypt()
+            with self.assertRaises(InvalidTag):
+                b"".join(pgpc.run_stages([tampered], [pgpt.decrypt_stage()]))
+            with self.assertRaises(InvalidTag):
+                b"".join(pgpc.run_stages([encrypted[:10]], [pgpt.decrypt_stage()]))
+
     def test_sha1_signature(self):
         result = b'\xfd\xfe6\xe5\xb7\xa1\xc2O\xbc\x87\xe6\xf2u\xb6\xee~\xd7:\xfc\x94'
         pgpt = pgpc.PGPCore(5, 6, b"message for testing sha1 message digest")
@@ -44,6 +69,15 @@ class PGPCoreTests(unittest.TestCase):
         pgpt.zip().unzip()
         self.assertEqual(pgpt.get_data(), tdata)
     
+    def test_unzip_legacy_zip_wrapped(self):
+        tdata = b"Data zipped the old way, as a zip archive with one member" * 20
+        pgpt = pgpc.PGPCore(9, 10, tdata)
+        pgpt.zip_to_file("legacy")
+        with open("legacy.zip", "rb") as f: pgpt.data = f.read()
+        os.remove("legacy.zip")
+        self.assertEqual(pgpt.unzip().get_data(), tdata)
+        self.assertEqual(pgpc.PGPCore(9, 10, tdata).zip().unzip(zip_wrapped=False).get_data(), tdata)
+
     def test_rsa_puk_encr_prk_decr_idemp(self):
         tdata = b"Data to test RSA public\\private key encr\\decr idempotence"
         mprks = mks.MockPRKStore()
@@ -76,5 +110,123 @@ class PGPCoreTests(unittest.TestCase):
         pgpt = pgpc.PGPCore(7, 7, tdata)
         self.assertEqual(pgpt.radix64_encode().radix64_decode().get_data(), tdata)
 
+    def test_stream_idemp(self):
+        tdata = os.urandom(100000) + b"streamed through all stages " * 5000
+        mprks = mks.MockPRKStore()
+        mpuks = mks.MockPUKStore()
+        prk = mprks.get_key_by_uid("prk1_2048", "password")
+        puk = mpuks.get_key_by_uid("puk1_2048")
+        aes = pgpc.PGPCore(None, None, None).aes128()
+        des3 = pgpc.PGPCore(None, None, None).tripple_des()
+        encr_core = pgpc.PGPCore(prk, puk, None)
+        sink = io.BytesIO()
+        pgpc.stream(io.BytesIO(tdata), sink, [
+            encr_core.sign_stage(), encr_core.zip_stage(), aes.encrypt_stage(),
+            des3.encrypt_stage(), encr_core.radix64_encode_stage()
+        ], chunk_size=1000)
+        out = io.BytesIO()
+        pgpc.stream(io.BytesIO(sink.getvalue()), out, [
+            encr_core.radix64_decode_stage(), des3.decrypt_stage(),
+            aes.decrypt_stage(), encr_core.unzip_stage(), encr_core.verify_stage()
+        ], chunk_size=777)
+        self.assertEqual(out.getvalue(), tdata)
+
+    def test_compression_algos(self):
+        tdata = b"Data to test every compression algorithm and level " * 500
+        for algo in ["deflate", "bz2", "lzma"]:
+            for level in [None, 1, 9]:
+                zipped = pgpc.PGPCore(9, 10, tdata).zip(algo, level).get_data()
+                self.assertEqual(zipped[2], pgpc.PGPCore.COMPRESSION_ALGOS[algo])
+                self.assertLess(len(zipped), len(tdata) // 10)
+                self.assertEqual(pgpc.PGPCore(9, 10, zipped).unzip().get_data(), tdata)
+                chunks = [tdata[i:i + 1000] for i in range(0, len(tdata), 1000)]
+                streamed = b"".join(pgpc.run_stages(chunks, [pgpc.ZipStage(algo, level)]))
+                self.assertEqual(streamed[:4], zipped[:4])
+                self.assertEqual(b"".join(pgpc.run_stages([streamed[i:i + 3] for i in range(0, len(streamed), 3)], [pgpc.UnzipStage()])), tdata)
+        with self.assertRaises(ValueError):
+            pgpc.PGPCore(9, 10, tdata).zip("zstd")
+        # bare zlib streams from older versions
+        self.assertEqual(pgpc.PGPCore(9, 10, zlib.compress(tdata)).unzip().get_data(), tdata)
+        self.assertEqual(b"".join(pgpc.run_stages([zlib.compress(tdata)], [pgpc.UnzipStage()])), tdata)
+
+    def test_incompressible_stored(self):
+        tdata = os.urandom(200000)
+        zipped = pgpc.PGPCore(9, 10, tdata).zip("lzma").get_data()
+        self.assertEqual(zipped[:4], pgpc.PGPCore.COMPRESSION_MAGIC + bytes([pgpc.PGPCore.COMPRESS_STORED, 0]))
+        self.assertEqual(zipped[4:], tdata)
+        self.assertEqual(pgpc.PGPCore(9, 10, zipped).unzip().get_data(), tdata)
+        streamed = b"".join(pgpc.run_stages([tdata[i:i + 5000] for i in range(0, len(tdata), 5000)], [pgpc.ZipStage("bz2")]))
+        self.assertEqual(streamed, zipped)
+        # compressible data after a random prefix shorter than the sample is still compressed
+        self.assertEqual(pgpc.PGPCore(9, 10, os.urandom(1000) + b"a" * 100000).zip().get_data()[2], pgpc.PGPCore.COMPRESS_DEFLATE)
+        # tiny inputs would only grow
+        self.assertEqual(pgpc.PGPCore(9, 10, b"abc").zip().get_data()[2], pgpc.PGPCore.COMPRESS_STORED)
+        self.assertEqual(pgpc.PGPCore(9, 10, b"ab" * 20).zip(min_gain=0.9).get_data()[2], pgpc.PGPCore.COMPRESS_STORED)
+        with self.assertRaises(zlib.error):
+            b"".join(pgpc.run_stages([pgpc.PGPCore(9, 10, b"ab" * 500).zip("bz2").get_data()[:-5]], [pgpc.UnzipStage()]))
+
+    def test_stream_matches_whole_buffer_ops(self):
+        tdata = os.urandom(10000)
+        chunks = [tdata[i:i + 100] for i in range(0, len(tdata), 100)]
+        sink = io.BytesIO()
+        pgpc.stream(iter(chunks), sink, [pgpc.Radix64EncodeStage()])
+        self.assertEqual(sink.getvalue(), pgpc.PGPCore(7, 7, tdata).radix64_encode().get_data())
+        pgpt = pgpc.PGPCore(mks.MockPRKStore().get_key_by_uid("prk1_1024", "password"), mks.MockPUKStore().get_key_by_uid("puk1_1024"), tdata)
+        signed = b"".join(pgpc.run_stages(iter(chunks), [pgpt.sign_stage()]))
+        self.assertIsNone(pgpt.verify_data_signature(signed[len(tdata):]))
+        tampered = bytearray(signed); tampered[5] ^= 1
+        with self.assertRaises(InvalidSignature):
+            b"".join(pgpc.run_stages([tampered], [pgpt.verify_stage()]))
+    def test_armor_idemp(self):
+        tdata = os.urandom(5000)
+        armored = pgpc.PGPCore(7, 7, tdata).armor_encode({"Version": "test"}).get_data()
+        self.assertTrue(armored.startswith(b"-----BEGIN PGP MESSAGE-----\nVersion: test\n\n"))
+        self.assertTrue(armored.endswith(b"-----END PGP MESSAGE-----\n"))
+        self.assertTrue(all(len(line) <= 64 for line in armored.splitlines()))
+        chunks = [armored[i:i + 7] for i in range(0, len(armored), 7)]
+        self.assertEqual(b"".join(pgpc.run_stages(chunks, [pgpc.ArmorDecodeStage()])), tdata)
+        # plain radix64 is still accepted
+        self.assertEqual(pgpc.PGPCore(7, 7, pgpc.PGPCore(7, 7, tdata).radix64_encode().get_data()).armor_decode().get_data(), tdata)
+
+    def test_short_plain_radix64(self):
+        # under 5 characters, still undecided between armor and plain radix64 when the input ends
+        for tdata in [b"", b"a", b"ab", b"abc"]:
+            encoded = pgpc.PGPCore(7, 7, tdata).radix64_encode().get_data()
+            self.assertEqual(b"".join(pgpc.run_stages([encoded], [pgpc.ArmorDecodeStage()])), tdata)
+            self.assertEqual(pgpc.PGPCore(7, 7, encoded).armor_decode().get_data(), tdata)
+
+    def test_armor_checksum(self):
+        self.assertEqual(pgpc.crc24(b"123456789"), 0x21CF02)
+        armored = bytearray(pgpc.PGPCore(7, 7, b"armor checksum test data" * 10).armor_encode().get_data())
+        pos = armored.index(b"\n\n") + 2
+        armored[pos] = ord("B") if armored[pos] == ord("A") else ord("A")
+        with self.assertRaises(ValueError):
+            pgpc.PGPCore(7, 7, bytes(armored)).armor_decode()
+
+    def test_mapped_input(self):
+        tdata = os.urandom(200000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "input")
+            with open(path, "wb") as f: f.write(tdata)
+            self.assertEqual(b"".join(pgpc.iter_chunks(path, 4096)), tdata)
+            mapped = pgpc.map_file(path)
+            chunks = list(pgpc.iter_chunks(mapped, 4096))
+            self.assertTrue(all(isinstance(chunk, memoryview) for chunk in chunks))
+            armored = pgpc.PGPCore(7, 7, mapped).armor_encode().get_data()
+            self.assertEqual(armored, pgpc.PGPCore(7, 7, tdata).armor_encode().get_data())
+            self.assertEqual(pgpc.PGPCore(7, 7, memoryview(armored)).armor_decode().get_data(), tdata)
+            # a map still viewed is left open, it closes once the views are gone
+            pgpc.close_map(mapped)
+            self.assertFalse(mapped.closed)
+            del chunks
+            pgpc.close_map(mapped)
+            self.assertTrue(mapped.closed)
+            open(os.path.join(tmpdir, "empty"), "wb").close()
+            self.assertEqual(pgpc.map_file(os.path.join(tmpdir, "empty")), b"")
+        # whole pieces of a chunk are not copied
+        pieces = list(pgpc.iter_fixed_chunks([b"x" * 10, b"y" * 25], 10))
+        self.assertIsInstance(pieces[0], memoryview)
+        self.assertEqual([bytes(piece) for piece in pieces], [b"x" * 10, b"y" * 10, b"y" * 10, b"y" * 5])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
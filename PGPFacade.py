@@ -1,5 +1,13 @@
 from datetime import datetime
+import io
+import os
+import time
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import PGPCore as pgpc
+import PGPPacket as pkt
 import mock_key_store as mks
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
@@ -9,100 +17,313 @@ import key_store_interface as ksi
 BYTE_SEPARATOR_SEQ = b"&???|||???&"
 PART_BYTE_SEPARATOR_SEQ = b"{}{}***{}][{}***{}{}"
 
+# none of the recipients' private keys is in the store, or the password doesn't unlock them
+class NoPrivateKeyError(Exception): pass
+
+# options that encrypt the payload with a session key
+CIPHER_OPTIONS = ["aes_encrypt", "3des_encrypt", "aes_gcm_encrypt", "chacha20_encrypt"]
+
+# option -> message header flag (see PGPPacket), decryption reads the options from the header
+OPTION_FLAGS = {"compression": pkt.FLAG_COMPRESSED, "sign_msg": pkt.FLAG_SIGNED, "aes_encrypt": pkt.FLAG_AES128,
+    "3des_encrypt": pkt.FLAG_3DES, "aes_gcm_encrypt": pkt.FLAG_AES256_GCM, "chacha20_encrypt": pkt.FLAG_CHACHA20_POLY1305,
+    "segmented": pkt.FLAG_SEGMENTED}
+# options decrypt insists on when the caller passes them
+REQUIRED_OPTIONS = ["sign_msg"] + CIPHER_OPTIONS
+# inspect_message reads this much at a time, a header takes a few hundred bytes
+INSPECT_CHUNK_SIZE = 512
+
+def options_of(flags : int) -> list:
+    return [option for option, flag in OPTION_FLAGS.items() if flags & flag]
+
+# segmented messages at least this big are encrypted and decrypted on the segment thread pool
+PARALLEL_THRESHOLD = 4 * 2 ** 20
+SEGMENT_WORKERS = int(os.environ.get("PGP_SEGMENT_WORKERS", os.cpu_count() or 1))
+segment_pool = None
+segment_pool_lock = threading.Lock()
+
+# shared by every PGPFacade in the process, zlib/bz2/lzma and the AEAD ciphers do their work outside the GIL
+def get_segment_pool() -> ThreadPoolExecutor:
+    global segment_pool
+    with segment_pool_lock:
+        if segment_pool is None: segment_pool = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="pgp-segment")
+        return segment_pool
+
+# key parameters of the CFB ciphers as [aes key, aes iv, 3des key, 3des iv], without the ones not used
+def session_key_component_of(key_params : dict) -> list:
+    session_key_component = []
+    for algo, (session_key, iv) in sorted(key_params.items()):
+        if algo in (pkt.ALGO_AES128, pkt.ALGO_3DES): session_key_component += [session_key, iv]
+    return session_key_component
+
 class PGPFacade():
 
-    def __init__(self, private_ks: ksi.PrivateKeyStore, public_ks: ksi.PublicKeyStore):
+    # stage_hook(op, stage, seconds, size) is called after every step of encrypt
+    # ("encrypt") and decrypt ("decrypt") with its duration and input size in bytes,
+    # e.g. metrics.StageMetrics().record. Without one nothing is timed
+    def __init__(self, private_ks: ksi.PrivateKeyStore, public_ks: ksi.PublicKeyStore, stage_hook=None):
         self.private_ks = private_ks
         self.public_ks = public_ks
+        self.stage_hook = stage_hook
+        self.set_compression_params()
+        self.set_segment_params()
+        self.set_parallel_params()
+
+    def timed(self, op, stage, size, fn, *args):
+        if self.stage_hook is None: return fn(*args)
+        started = time.perf_counter()
+        result = fn(*args)
+        self.stage_hook(op, stage, time.perf_counter() - started, size)
+        return result
+
+    # stage of a streaming pipeline, reports its totals to stage_hook once the stream ends
+    def timed_stage(self, op, stage_name, stage):
+        if self.stage_hook is None: return stage
+        return pgpc.TimedStage(stage, lambda seconds, size: self.stage_hook(op, stage_name, seconds, size))
+
+    # used by the "compression" option - algo is "deflate", "bz2" or "lzma", level None
+    # is the algorithm's default. Payloads that barely compress (less than min_gain,
+    # PGPCore.COMPRESSION_MIN_GAIN by default) are stored uncompressed. Decryption
+    # reads the algorithm from the message
+    def set_compression_params(self, algo="deflate", level=None, min_gain=None):
+        pgpc.compression_algo_id(algo)
+        self.compression_algo = algo
+        self.compression_level = level
+        self.compression_min_gain = min_gain
+        return self
+
+    # used by the "segmented" option, segment_size is the plaintext size of a segment
+    def set_segment_params(self, segment_size=pgpc.PGPCore.SEGMENT_SIZE):
+        if segment_size <= 0: raise ValueError("segment size must be positive")
+        if segment_size > pkt.MAX_CHUNK_SIZE: raise ValueError("segment size must be at most %d" % pkt.MAX_CHUNK_SIZE)
+        self.segment_size = segment_size
+        return self
 
+    # segments of "segmented" messages run on executor (the shared segment pool if None) once
+    # threshold bytes of them are reached, threshold None keeps everything on the calling thread.
+    # window - segments queued at a time, bounds memory use. Don't pass an executor whose
+    # workers call this facade, they would wait on themselves
+    def set_parallel_params(self, threshold=PARALLEL_THRESHOLD, executor=None, window=None):
+        self.parallel_threshold = threshold
+        self.segment_executor = executor
+        self.parallel_window = window if window is not None else 2 * SEGMENT_WORKERS
+        return self
+
+    def map_segments(self, fn, items, size_hint=None):
+        """ fn(*item) for every item, results in order. The first parallel_threshold bytes
+        worth of segments run here, the rest on the segment pool - all of them if size_hint
+        (bytes in all segments) is known to reach the threshold """
+        items = iter(items)
+        if self.parallel_threshold is None:
+            yield from itertools.starmap(fn, items)
+            return
+        inline = 0 if size_hint is not None and size_hint >= self.parallel_threshold else -(-self.parallel_threshold // self.segment_size)
+        yield from itertools.starmap(fn, itertools.islice(items, inline))
+        executor = self.segment_executor if self.segment_executor is not None else get_segment_pool()
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, *item))
+            if len(pending) >= self.parallel_window: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+
+    # receiver_puk_id can be a list of ids - the message is then encrypted once
+    # and its session key wrapped for every receiver
     def set_send_msg_params(self, sender_prk_id, sender_prk_passwd : str, sender_puk_id, receiver_puk_id):
         self.sender_prk = None
         self.sender_puk = None
         self.receiver_puk = None
+        self.receiver_puks = []
+        # key ids of the public keys, as the key stores keep them
+        self.sender_kid = None
+        self.receiver_kids = []
 
         if sender_prk_id is not None:
             if isinstance(sender_prk_id, int):
-                self.sender_prk = self.private_ks.get_key_by_kid(sender_prk_id, sender_prk_passwd)
+                self.sender_prk = self.timed("encrypt", "key_unlock", 0, self.private_ks.get_key_by_kid, sender_prk_id, sender_prk_passwd)
             elif isinstance(sender_prk_id, str):
-                self.sender_prk = self.private_ks.get_key_by_uid(sender_prk_id, sender_prk_passwd)
+                self.sender_prk = self.timed("encrypt", "key_unlock", 0, self.private_ks.get_key_by_uid, sender_prk_id, sender_prk_passwd)
+
+        if isinstance(sender_puk_id, (int, str)):
+            self.sender_kid, self.sender_puk = self.lookup_public_key(sender_puk_id)
 
-        if sender_puk_id is not None:
-            if isinstance(sender_puk_id, int):
-                self.sender_puk = self.public_ks.get_key_by_kid(sender_puk_id)
-            elif isinstance(sender_puk_id, str):
-                self.sender_puk = self.public_ks.get_key_by_uid(sender_puk_id)
+        receiver_puk_ids = receiver_puk_id if isinstance(receiver_puk_id, (list, tuple)) else [receiver_puk_id]
+        for receiver_puk_id in receiver_puk_ids:
+            if not isinstance(receiver_puk_id, (int, str)): continue
+            receiver_kid, receiver_puk = self.lookup_public_key(receiver_puk_id)
+            self.receiver_kids += [receiver_kid]
+            self.receiver_puks += [receiver_puk]
+        if self.receiver_puks: self.receiver_puk = self.receiver_puks[0]
 
-        if receiver_puk_id is not None:
-            if isinstance(receiver_puk_id, int):
-                self.receiver_puk = self.public_ks.get_key_by_kid(receiver_puk_id)
-            elif isinstance(receiver_puk_id, str):
-                self.receiver_puk = self.public_ks.get_key_by_uid(receiver_puk_id)
+    # (key id, public key) by key id, or of the user id's first key with the id the store keeps for it
+    def lookup_public_key(self, key_id):
+        if isinstance(key_id, int): return key_id, self.public_ks.get_key_by_kid(key_id)
+        pairs = self.public_ks.get_kid_key_pairs_by_uid(key_id)
+        return pairs[0] if pairs else (None, None)
 
     def get_public_key_id(self, puk):
         return puk.public_numbers().n % (2 ** 64)
     
     def save_to_pgp_file(self, data : bytes, filename : str):
         if not filename.endswith(".pgp"): filename += ".pgp"
-        with open(filename, "wb") as f: f.write(data)
+        # written next to it and renamed, the old file may still be mapped by load_pgp_file
+        with open(filename + ".tmp", "wb") as f: f.write(data)
+        os.replace(filename + ".tmp", filename)
 
-    def load_pgp_file(self, filename : str) -> bytes:
+    # memory mapped, pages are read as the message is parsed and decrypted
+    def load_pgp_file(self, filename : str):
         if not filename.endswith(".pgp"): filename += ".pgp"
-        data = None
-        with open(filename, "rb") as f: data = f.read()
-        return data
+        return pgpc.map_file(filename)
     
-    def encr_sign_message(self, data):
-        encr_engine = pgpc.PGPCore(self.sender_prk, self.sender_puk, data)
-        msg_digest = encr_engine.data_signature()
+    # binding - pkt.header_binding of the message, the signature covers it too
+    def encr_sign_message(self, data, binding=b""):
+        hasher = pgpc.PGPCore.new_hasher()
+        hasher.update(binding); hasher.update(data)
+        msg_digest = pgpc.PGPCore(self.sender_prk, self.sender_puk, None).digest_signature(hasher.finalize())
         l2o_msg_digest = msg_digest[0:2]
-        sender_puk_id = self.get_public_key_id(self.sender_puk)
-        data += msg_digest + BYTE_SEPARATOR_SEQ + \
-            l2o_msg_digest + BYTE_SEPARATOR_SEQ + \
-            str(sender_puk_id).encode() + BYTE_SEPARATOR_SEQ
+        data += pkt.pack(pkt.TAG_SIGNATURE, pkt.pack_key_id(self.sender_kid) + l2o_msg_digest + msg_digest)
         return data
     
     def encr_compression(self, data):
-        data = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).zip().get_data()
+        data = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).zip(
+            self.compression_algo, self.compression_level, self.compression_min_gain).get_data()
         return data
     
     def encr_aes(self, data):
         aes_pgp_encryptor = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).aes128().encrypt()
         data = aes_pgp_encryptor.get_data()
-        aes_sk = pgpc.PGPCore(None, self.receiver_puk, aes_pgp_encryptor.get_session_key()).rsa_publ_encry().get_data()
-        aes_iv = pgpc.PGPCore(None, self.receiver_puk, aes_pgp_encryptor.get_iv()).rsa_publ_encry().get_data()
-        return data, aes_sk, aes_iv
+        return data, (pkt.ALGO_AES128, aes_pgp_encryptor.get_session_key(), aes_pgp_encryptor.get_iv())
     
     def encr_3des(self, data):
         des3_pgp_encryptor = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).tripple_des().encrypt()
         data = des3_pgp_encryptor.get_data()
-        des3_sk = pgpc.PGPCore(None, self.receiver_puk, des3_pgp_encryptor.get_session_key()).rsa_publ_encry().get_data()
-        des3_iv = pgpc.PGPCore(None, self.receiver_puk, des3_pgp_encryptor.get_iv()).rsa_publ_encry().get_data()
-        return data, des3_sk, des3_iv
+        return data, (pkt.ALGO_3DES, des3_pgp_encryptor.get_session_key(), des3_pgp_encryptor.get_iv())
+
+    # AEAD ciphers, a single pass that also authenticates the payload
+    # aad - pkt.header_binding of the message, the tag covers it too
+    def encr_aes_gcm(self, data, aad=b""):
+        gcm_pgp_encryptor = pgpc.PGPCore(None, None, data).aes256_gcm().set_associated_data(aad).encrypt()
+        return gcm_pgp_encryptor.get_data(), (pkt.ALGO_AES256_GCM, gcm_pgp_encryptor.get_session_key(), gcm_pgp_encryptor.get_iv())
+
+    def encr_chacha20(self, data, aad=b""):
+        chacha_pgp_encryptor = pgpc.PGPCore(None, None, data).chacha20_poly1305().set_associated_data(aad).encrypt()
+        return chacha_pgp_encryptor.get_data(), (pkt.ALGO_CHACHA20_POLY1305, chacha_pgp_encryptor.get_session_key(), chacha_pgp_encryptor.get_iv())
+
+    # one RSA operation per recipient no matter how many ciphers are used,
+    # returns a key wrap packet body for each recipient
+    def encr_wrap_session_keys(self, cipher_params):
+        material = pkt.pack_key_material(cipher_params)
+        for receiver_puk in self.receiver_puks:
+            # RSA-OAEP with SHA-256 takes at most key size - 66 bytes
+            if len(material) > receiver_puk.key_size // 8 - 66:
+                raise Exception("too many ciphers for a %d bit receiver key, use fewer ciphers or a bigger key" % receiver_puk.key_size)
+        return [pkt.pack_key_id(receiver_kid) + pgpc.PGPCore(None, receiver_puk, material).rsa_publ_encry().get_data()
+            for receiver_puk, receiver_kid in zip(self.receiver_puks, self.receiver_kids)]
     
+    def armor_headers(self):
+        return {"Version": "ZP PGP " + str(pkt.VERSION)}
+
     def encr_radix64(self, data):
-        data = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).radix64_encode().get_data()
+        data = pgpc.PGPCore(self.sender_prk, self.sender_puk, data).armor_encode(self.armor_headers()).get_data()
         return data
 
-    def pgp_encrypt_message(self, data : bytes, filename : str, options : list):
-        time_stamp1 = datetime.now()
-        data += BYTE_SEPARATOR_SEQ + time_stamp1.__str__().encode() \
-             + BYTE_SEPARATOR_SEQ + filename.encode() + PART_BYTE_SEPARATOR_SEQ
-        if "sign_msg" in options: data = self.encr_sign_message(data)
-        time_stamp2 = datetime.now(); data += time_stamp2.__str__().encode()
-        if "compression" in options: data = self.encr_compression(data)
-        aes_sk = None; aes_iv = None; des3_sk = None; des3_iv = None
-        if "aes_encrypt" in options: data, aes_sk, aes_iv = self.encr_aes(data)
-        if "3des_encrypt" in options: data, des3_sk, des3_iv = self.encr_3des(data)
-        data += PART_BYTE_SEPARATOR_SEQ
-        if "aes_encrypt" in options: data += aes_sk + BYTE_SEPARATOR_SEQ + aes_iv + BYTE_SEPARATOR_SEQ
-        if "3des_encrypt" in options: data += des3_sk + BYTE_SEPARATOR_SEQ + des3_iv + BYTE_SEPARATOR_SEQ
-        data +=  str(self.get_public_key_id(self.receiver_puk)).encode()
-        if "radix64" in options: data = self.encr_radix64(data)
-        self.save_to_pgp_file(data, filename)
+    # save_file=False only returns the message, filename is still stored in it
+    def pgp_encrypt_message(self, data : bytes, filename : str, options : list, save_file=True):
+        started = time.perf_counter(); size = len(data)
+        if "segmented" in options: data = b"".join(self.encr_segmented_message([data], filename, options, lambda: size, size))
+        else: data = self.encr_packet_message(data, filename, options)
+        if "radix64" in options: data = self.timed("encrypt", "radix64", len(data), self.encr_radix64, data)
+        if save_file: self.save_to_pgp_file(data, filename)
+        if self.stage_hook is not None: self.stage_hook("encrypt", "total", time.perf_counter() - started, size)
         return data
 
+    # message with a single payload packet, the whole payload goes through each step in turn
+    def encr_packet_message(self, data : bytes, filename : str, options : list):
+        header_fields = self.encr_header_fields(options); binding = pkt.header_binding(*header_fields)
+        time_stamp1 = datetime.now()
+        data = pkt.pack(pkt.TAG_FILENAME, filename.encode()) \
+            + pkt.pack(pkt.TAG_TIMESTAMP, time_stamp1.__str__().encode()) \
+            + pkt.pack(pkt.TAG_LITERAL_DATA, data)
+        if "sign_msg" in options: data = self.timed("encrypt", "sign", len(data), self.encr_sign_message, data, binding)
+        time_stamp2 = datetime.now(); data += pkt.pack(pkt.TAG_TIMESTAMP, time_stamp2.__str__().encode())
+        if "compression" in options: data = self.timed("encrypt", "compression", len(data), self.encr_compression, data)
+        packets = []; cipher_params = []
+        if "aes_encrypt" in options: data, aes_params = self.timed("encrypt", "aes", len(data), self.encr_aes, data); cipher_params += [aes_params]
+        if "3des_encrypt" in options: data, des3_params = self.timed("encrypt", "3des", len(data), self.encr_3des, data); cipher_params += [des3_params]
+        if "aes_gcm_encrypt" in options: data, gcm_params = self.timed("encrypt", "aes_gcm", len(data), self.encr_aes_gcm, data, binding); cipher_params += [gcm_params]
+        if "chacha20_encrypt" in options: data, chacha_params = self.timed("encrypt", "chacha20", len(data), self.encr_chacha20, data, binding); cipher_params += [chacha_params]
+        if cipher_params: packets += [(pkt.TAG_KEY_WRAP, key_wrap) for key_wrap in self.timed("encrypt", "key_wrap", 0, self.encr_wrap_session_keys, cipher_params)]
+        packets += [(pkt.TAG_PAYLOAD, data)]
+        return pkt.message(packets, *header_fields)
+
+    # flags, sender key id and recipient key ids of the message header (see PGPPacket.message)
+    def encr_header_fields(self, options : list, flags=0):
+        flags |= sum(flag for option, flag in OPTION_FLAGS.items() if option in options)
+        return flags, self.sender_kid if "sign_msg" in options else 0, list(self.receiver_kids)
+
+    # "segmented" messages are sealed with one AEAD cipher, AES-256-GCM unless chacha20_encrypt is given
+    def segment_sealer(self, options : list):
+        ciphers = [option for option in options if option in CIPHER_OPTIONS]
+        if ciphers == ["chacha20_encrypt"]: return pkt.ALGO_CHACHA20_POLY1305, pgpc.PGPCore(None, None, None).chacha20_poly1305()
+        if ciphers in ([], ["aes_gcm_encrypt"]): return pkt.ALGO_AES256_GCM, pgpc.PGPCore(None, None, None).aes256_gcm()
+        raise Exception("segmented messages use a single AEAD cipher, aes_gcm_encrypt or chacha20_encrypt")
+
+    def encr_segment(self, sealer, index : int, segment : bytes, last : bool, options : list):
+        if "compression" in options:
+            segment = pgpc.PGPCore(None, None, segment).zip(self.compression_algo, self.compression_level, self.compression_min_gain).get_data()
+        return pkt.pack(pkt.TAG_PAYLOAD, sealer.encrypt_segment(index, segment, last))
+
+    def encr_segmented_message(self, chunks, filename : str, options : list, literal_data_size, size_hint=None):
+        """ Segmented message (see PGPPacket) for data read from chunks, yields it piece by piece.
+        The inner packets are cut into segments of self.segment_size, each one compressed
+        ("compression") and sealed on its own. Literal data packets hold self.segment_size bytes
+        so pgp_decrypt_range can find any byte of the data. literal_data_size() returns the
+        size of the data once chunks are used up, size_hint is the size if it is known in advance.
+        Segments are compressed and sealed in parallel, see set_parallel_params """
+        started = time.perf_counter(); seconds = 0.0; size = 0
+        algo, sealer = self.segment_sealer(options)
+        # the header names the cipher even when it was picked by default
+        header_fields = self.encr_header_fields(options, pkt.FLAG_AES256_GCM if algo == pkt.ALGO_AES256_GCM else pkt.FLAG_CHACHA20_POLY1305)
+        binding = pkt.header_binding(*header_fields)
+        sealer.set_associated_data(binding)
+        inner = self.encr_inner_stream(pgpc.iter_fixed_chunks(chunks, self.segment_size), filename, options, binding)
+        prefix = [next(inner), next(inner)] # filename and timestamp
+        params = pkt.SegmentParams(algo, pkt.SEGMENT_FLAG_COMPRESSED if "compression" in options else 0,
+            self.segment_size, self.segment_size, sum(len(packet) for packet in prefix))
+        packets = [(pkt.TAG_KEY_WRAP, key_wrap) for key_wrap in self.timed("encrypt", "key_wrap", 0,
+            self.encr_wrap_session_keys, [(algo, sealer.get_session_key(), sealer.get_iv())])]
+        packets += [(pkt.TAG_SEGMENTED, pkt.pack_segment_params(params))]
+        head = pkt.message(packets, *header_fields)
+        seconds += time.perf_counter() - started
+        yield head
+        offset = len(head); offsets = []
+        segments = pgpc.iter_with_last(pgpc.iter_fixed_chunks(itertools.chain(prefix, inner), self.segment_size))
+        items = ((sealer, index, segment, last, options) for index, (segment, last) in enumerate(segments))
+        started = time.perf_counter()
+        for packet in self.map_segments(self.encr_segment, items, size_hint):
+            offsets += [offset]; offset += len(packet)
+            yield packet
+        seconds += time.perf_counter() - started
+        if self.stage_hook is not None: self.stage_hook("encrypt", "segments", seconds, literal_data_size())
+        yield pkt.pack(pkt.TAG_SEGMENT_INDEX, pkt.pack_segment_index(literal_data_size(), offsets, offset))
+
+    # armor is recognized by its BEGIN line, plain radix64 (older versions) by the "radix64" option
+    def decr_is_armored(self, head, options):
+        return pgpc.is_armored(head) or (options is not None and "radix64" in options and not pkt.is_packet_message(head))
+
+    # options of a message from its header, messages made by older versions have none and need them passed in
+    # options the caller passes are requirements then, a message without the signature or
+    # cipher asked for is rejected (the header could have been changed to drop them)
+    def decr_message_options(self, header, options):
+        if header is not None and header.flags is not None:
+            header_options = options_of(header.flags)
+            missing = [option for option in options or [] if option in REQUIRED_OPTIONS and option not in header_options]
+            if missing: raise Exception("message was not made with " + ", ".join(missing))
+            return header_options
+        if options is None: raise Exception("message has no header, pass the options it was made with")
+        return options
+
+    # armored messages and plain radix64 ones from older versions
     def decr_radix64(self, msg_data):
-        msg_data = pgpc.PGPCore(None, None, msg_data).radix64_decode().get_data()
+        msg_data = pgpc.PGPCore(None, None, msg_data).armor_decode().get_data()
         return msg_data
     
     def decr_decrypt_session_key_component(self, session_key_component, passwd):
@@ -142,18 +363,143 @@ class PGPFacade():
         if l2o_msg_digest != msg_digest[0:2]:
             raise Exception("signature not received correctly")
         sender_puk : RSAPublicKey = self.public_ks.get_key_by_kid(int(sender_key_id.decode()))
-        pgpc.PGPCore(None, sender_puk, BYTE_SEPARATOR_SEQ.join(message_component) + PART_BYTE_SEPARATOR_SEQ) \
-            .verify_data_signature(msg_digest)
+        # hash the signed bytes part by part instead of joining them into another copy
+        hasher = pgpc.PGPCore.new_hasher()
+        for i in range(len(message_component)):
+            if i > 0: hasher.update(BYTE_SEPARATOR_SEQ)
+            hasher.update(message_component[i])
+        hasher.update(PART_BYTE_SEPARATOR_SEQ)
+        pgpc.PGPCore(None, sender_puk, None).verify_digest_signature(msg_digest, hasher.finalize())
 
     
-    def pgp_decrypt_message(self, data, filename : str, passwd : str, options : list):
-        msg_data = None
-        if data != None:
-            msg_data = data
-        else:
-            msg_data = self.load_pgp_file(filename)
-        if "radix64" in options: msg_data = self.decr_radix64(msg_data)
-        msg_data_parts = msg_data.split(PART_BYTE_SEPARATOR_SEQ)
+    # key wrap packet addressed to one of our private keys, and that key
+    def decr_find_key_wrap(self, key_wrap_packets, passwd):
+        for key_wrap_packet in key_wrap_packets:
+            receiver_kid = pkt.unpack_key_id(key_wrap_packet.body[:pkt.KEY_ID.size])
+            receiver_prk : RSAPrivateKey = self.timed("decrypt", "key_unlock", 0, self.private_ks.get_key_by_kid, receiver_kid, passwd)
+            if receiver_prk is not None: return key_wrap_packet, receiver_prk
+        raise NoPrivateKeyError("no private key for any recipient of this message (or wrong password)")
+
+    # {algo id: (session key, iv)} from the key wrap packet addressed to us
+    def decr_unwrap_key_params(self, key_wrap_packets, passwd):
+        key_wrap_packet, receiver_prk = self.decr_find_key_wrap(key_wrap_packets, passwd)
+        material = self.timed("decrypt", "key_unwrap", 0,
+            lambda: pgpc.PGPCore(receiver_prk, None, bytes(key_wrap_packet.body[pkt.KEY_ID.size:])).rsa_priv_decry().get_data())
+        return pkt.unpack_key_material(material)
+
+    # returns session keys and ivs in the order decr_aes/decr_3des expect them
+    def decr_unwrap_session_keys(self, key_wrap_packets, passwd):
+        return session_key_component_of(self.decr_unwrap_key_params(key_wrap_packets, passwd))
+
+    # aead - PGPCore.aes256_gcm or PGPCore.chacha20_poly1305, key_params - decr_unwrap_key_params
+    # aad - pkt.message_header_binding of the message
+    def decr_aead(self, processed_data, aead, key_params, algo, aad=b""):
+        session_key, nonce = key_params[algo]
+        return aead(pgpc.PGPCore(None, None, processed_data, session_key, nonce)).set_associated_data(aad).decrypt().get_data()
+
+    def decr_verify_signature(self, signature_packet, signed_data, binding=b""):
+        hasher = pgpc.PGPCore.new_hasher()
+        hasher.update(binding); hasher.update(signed_data)
+        self.decr_verify_digest(signature_packet, hasher.finalize())
+
+    def decr_verify_digest(self, signature_packet, digest):
+        sender_key_id = pkt.unpack_key_id(signature_packet.body[:pkt.KEY_ID.size])
+        l2o_msg_digest = signature_packet.body[pkt.KEY_ID.size:pkt.KEY_ID.size + 2]
+        msg_digest = bytes(signature_packet.body[pkt.KEY_ID.size + 2:])
+        if l2o_msg_digest != msg_digest[0:2]:
+            raise Exception("signature not received correctly")
+        sender_puk : RSAPublicKey = self.public_ks.get_key_by_kid(sender_key_id)
+        pgpc.PGPCore(None, sender_puk, None).verify_digest_signature(msg_digest, digest)
+
+    # options are read from the message header, only messages made by older versions need them
+    def pgp_decrypt_message(self, data, filename : str, passwd : str, options=None, save_file=True):
+        if data != None: return self.decr_message_data(data, filename, passwd, options, save_file)
+        # the map of the file is closed when decryption is done, not whenever it is collected
+        msg_data = self.load_pgp_file(filename)
+        try:
+            return self.decr_message_data(msg_data, filename, passwd, options, save_file)
+        finally: pgpc.close_map(msg_data)
+
+    def decr_message_data(self, msg_data, filename : str, passwd : str, options, save_file):
+        started = time.perf_counter()
+        if self.decr_is_armored(msg_data, options): msg_data = self.timed("decrypt", "radix64", len(msg_data), self.decr_radix64, msg_data)
+        if not pkt.is_packet_message(msg_data):
+            data = self.pgp_decrypt_legacy_message(msg_data, filename, passwd, self.decr_message_options(None, options), save_file)
+            if self.stage_hook is not None: self.stage_hook("decrypt", "total", time.perf_counter() - started, len(data))
+            return data
+
+        header = pkt.unpack_message_header(msg_data)
+        options = self.decr_message_options(header, options)
+        binding = pkt.message_header_binding(header)
+        packets = list(pkt.iter_packets(msg_data, header.size))
+        if pkt.find(packets, pkt.TAG_SEGMENTED) is not None:
+            processed_data = self.decr_segmented_payload(packets, passwd, binding)
+        else: processed_data = self.decr_packet_payload(packets, passwd, options, binding)
+
+        inner_packets = pkt.parse_packets(processed_data)
+        signature_packet = pkt.find(inner_packets, pkt.TAG_SIGNATURE)
+        # a signature is checked even if the header was changed to say there is none
+        if signature_packet is not None:
+            self.timed("decrypt", "verify", signature_packet.start, self.decr_verify_signature, signature_packet, memoryview(processed_data)[:signature_packet.start], binding)
+        elif "sign_msg" in options: raise Exception("message is not signed")
+        data = b"".join(packet.body for packet in pkt.find_all(inner_packets, pkt.TAG_LITERAL_DATA))
+        if save_file: self.save_to_pgp_file(data, filename)
+        if self.stage_hook is not None: self.stage_hook("decrypt", "total", time.perf_counter() - started, len(data))
+        return data
+
+    # inner packets of a message with one payload (or several packets of one streamed payload)
+    def decr_packet_payload(self, packets, passwd : str, options : list, binding=b""):
+        payload_packets = pkt.find_all(packets, pkt.TAG_PAYLOAD)
+        # streamed messages split the payload into several packets
+        processed_data = payload_packets[0].body if len(payload_packets) == 1 else b"".join(p.body for p in payload_packets)
+        if any(option in CIPHER_OPTIONS for option in options):
+            key_params = self.decr_unwrap_key_params(pkt.find_all(packets, pkt.TAG_KEY_WRAP), passwd)
+            session_key_component = session_key_component_of(key_params)
+        if "chacha20_encrypt" in options:
+            processed_data = self.timed("decrypt", "chacha20", len(processed_data), self.decr_aead, processed_data, pgpc.PGPCore.chacha20_poly1305, key_params, pkt.ALGO_CHACHA20_POLY1305, binding)
+        if "aes_gcm_encrypt" in options:
+            processed_data = self.timed("decrypt", "aes_gcm", len(processed_data), self.decr_aead, processed_data, pgpc.PGPCore.aes256_gcm, key_params, pkt.ALGO_AES256_GCM, binding)
+        if "3des_encrypt" in options:
+            processed_data = self.timed("decrypt", "3des", len(processed_data), self.decr_3des, processed_data, session_key_component, options)
+        if "aes_encrypt" in options:
+            processed_data = self.timed("decrypt", "aes", len(processed_data), self.decr_aes, processed_data, session_key_component)
+        if "compression" in options:
+            processed_data = self.timed("decrypt", "compression", len(processed_data), self.decr_compression, processed_data)
+        return processed_data
+
+    # segment parameters of a segmented message and the PGPCore that opens its segments
+    def decr_segment_opener(self, segmented_packet, key_wrap_packets, passwd : str, binding=b""):
+        params = pkt.unpack_segment_params(segmented_packet.body)
+        key_params = self.decr_unwrap_key_params(key_wrap_packets, passwd)
+        if params.algo not in key_params: raise pkt.PacketFormatError("no key for the segment cipher")
+        opener = pgpc.PGPCore(None, None, None, *key_params[params.algo]).set_associated_data(binding)
+        if params.algo == pkt.ALGO_CHACHA20_POLY1305: opener.chacha20_poly1305()
+        elif params.algo == pkt.ALGO_AES256_GCM: opener.aes256_gcm()
+        else: raise pkt.PacketFormatError("segments need an AEAD cipher")
+        return params, opener
+
+    def decr_segment(self, params, opener, index : int, body, last : bool):
+        segment = opener.decrypt_segment(index, body, last)
+        if params.flags & pkt.SEGMENT_FLAG_COMPRESSED: segment = pgpc.PGPCore(None, None, segment).unzip().get_data()
+        return segment
+
+    # decrypted segments of a segmented message in order, in parallel like encr_segmented_message
+    def decr_segments(self, params, opener, payload_packets, size_hint=None):
+        started = time.perf_counter(); size = 0
+        items = ((params, opener, index, packet.body, last) for index, (packet, last) in enumerate(pgpc.iter_with_last(payload_packets)))
+        for segment in self.map_segments(self.decr_segment, items, size_hint):
+            size += len(segment)
+            yield segment
+        if self.stage_hook is not None: self.stage_hook("decrypt", "segments", time.perf_counter() - started, size)
+
+    def decr_segmented_payload(self, packets, passwd : str, binding=b""):
+        params, opener = self.decr_segment_opener(pkt.find(packets, pkt.TAG_SEGMENTED), pkt.find_all(packets, pkt.TAG_KEY_WRAP), passwd, binding)
+        payload_packets = pkt.find_all(packets, pkt.TAG_PAYLOAD)
+        return b"".join(self.decr_segments(params, opener, payload_packets, sum(len(p.body) for p in payload_packets)))
+
+    # messages made before packet framing, fields are joined with separator sequences
+    def pgp_decrypt_legacy_message(self, msg_data, filename : str, passwd : str, options : list, save_file=True):
+        msg_data_parts = bytes(msg_data).split(PART_BYTE_SEPARATOR_SEQ)
 
         processed_data, session_key_component, signature_component, message_component = None, None, None, None
         if "compression" in options or "aes_encrypt" in options or "3des_encrypt" in options:
@@ -186,12 +532,287 @@ class PGPFacade():
         # filename = message_component[2]
         time_stamp1 = message_component[1]
         data = message_component[0]
-        self.save_to_pgp_file(data, filename)
+        if save_file: self.save_to_pgp_file(data, filename)
         #return data.decode("utf-8")
         return data
 
+    # inner packets of a streamed message, the signature digest is fed
+    # chunk by chunk as literal data packets are produced
+    def encr_inner_stream(self, chunks, filename : str, options : list, binding=b""):
+        hasher = pgpc.PGPCore.new_hasher() if "sign_msg" in options else None
+        if hasher is not None: hasher.update(binding)
+        time_stamp1 = datetime.now()
+        for packet in [pkt.pack(pkt.TAG_FILENAME, filename.encode()), pkt.pack(pkt.TAG_TIMESTAMP, time_stamp1.__str__().encode())]:
+            if hasher is not None: hasher.update(packet)
+            yield packet
+        for chunk in chunks:
+            packet = pkt.pack(pkt.TAG_LITERAL_DATA, bytes(chunk))
+            if hasher is not None: hasher.update(packet)
+            yield packet
+        if hasher is not None:
+            msg_digest = pgpc.PGPCore(self.sender_prk, self.sender_puk, None).digest_signature(hasher.finalize())
+            yield pkt.pack(pkt.TAG_SIGNATURE, pkt.pack_key_id(self.sender_kid) + msg_digest[0:2] + msg_digest)
+        time_stamp2 = datetime.now()
+        yield pkt.pack(pkt.TAG_TIMESTAMP, time_stamp2.__str__().encode())
+
+    def pgp_encrypt_stream(self, source, sink, filename : str, options : list, chunk_size=pgpc.PGPCore.STREAM_CHUNK_SIZE):
+        """ Streaming version of pgp_encrypt_message - reads source (file path, buffer,
+        file-like object or iterable of chunks, see PGPCore.iter_chunks) and writes the message to sink (anything with write()).
+        Memory use depends on chunk_size, not on the message size. Literal data and payload
+        are split into packets of about chunk_size, pgp_decrypt_message reads these too.
+        Returns the number of bytes written """
+        if chunk_size > pkt.MAX_CHUNK_SIZE: raise ValueError("chunk size must be at most %d" % pkt.MAX_CHUNK_SIZE)
+        started = time.perf_counter()
+        size = 0
+        def counted(chunks):
+            nonlocal size
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        if "segmented" in options:
+            out = self.encr_segmented_message(counted(pgpc.iter_chunks(source, chunk_size)), filename, options, lambda: size)
+        else: out = self.encr_payload_stream(counted(pgpc.iter_chunks(source, chunk_size)), filename, options)
+        if "radix64" in options: out = pgpc.run_stages(out, [self.timed_stage("encrypt", "radix64", pgpc.ArmorEncodeStage(self.armor_headers()))])
+        written = 0
+        for chunk in out:
+            sink.write(chunk)
+            written += len(chunk)
+        if self.stage_hook is not None: self.stage_hook("encrypt", "total", time.perf_counter() - started, size)
+        return written
+
+    # message with the payload in packets of about chunk_size, encrypted as one stream
+    def encr_payload_stream(self, chunks, filename : str, options : list):
+        stages = []; cipher_params = []; packets = []
+        header_fields = self.encr_header_fields(options); binding = pkt.header_binding(*header_fields)
+        if "compression" in options: stages += [self.timed_stage("encrypt", "compression", pgpc.PGPCore(None, None, None).zip_stage(
+            self.compression_algo, self.compression_level, self.compression_min_gain))]
+        if "aes_encrypt" in options:
+            aes_pgp_encryptor = pgpc.PGPCore(None, None, None).aes128()
+            stages += [self.timed_stage("encrypt", "aes", aes_pgp_encryptor.encrypt_stage())]
+            cipher_params += [(pkt.ALGO_AES128, aes_pgp_encryptor.get_session_key(), aes_pgp_encryptor.get_iv())]
+        if "3des_encrypt" in options:
+            des3_pgp_encryptor = pgpc.PGPCore(None, None, None).tripple_des()
+            stages += [self.timed_stage("encrypt", "3des", des3_pgp_encryptor.encrypt_stage())]
+            cipher_params += [(pkt.ALGO_3DES, des3_pgp_encryptor.get_session_key(), des3_pgp_encryptor.get_iv())]
+        if "aes_gcm_encrypt" in options:
+            gcm_pgp_encryptor = pgpc.PGPCore(None, None, None).aes256_gcm().set_associated_data(binding)
+            stages += [self.timed_stage("encrypt", "aes_gcm", gcm_pgp_encryptor.encrypt_stage())]
+            cipher_params += [(pkt.ALGO_AES256_GCM, gcm_pgp_encryptor.get_session_key(), gcm_pgp_encryptor.get_iv())]
+        if "chacha20_encrypt" in options:
+            chacha_pgp_encryptor = pgpc.PGPCore(None, None, None).chacha20_poly1305().set_associated_data(binding)
+            stages += [self.timed_stage("encrypt", "chacha20", chacha_pgp_encryptor.encrypt_stage())]
+            cipher_params += [(pkt.ALGO_CHACHA20_POLY1305, chacha_pgp_encryptor.get_session_key(), chacha_pgp_encryptor.get_iv())]
+        if cipher_params: packets += [(pkt.TAG_KEY_WRAP, key_wrap) for key_wrap in self.timed("encrypt", "key_wrap", 0, self.encr_wrap_session_keys, cipher_params)]
+        stages += [pkt.PacketStage(pkt.TAG_PAYLOAD)]
+        inner = self.encr_inner_stream(chunks, filename, options, binding)
+        return itertools.chain([pkt.message(packets, *header_fields)], pgpc.run_stages(inner, stages))
+
+    # decrypted and decompressed payload of a streamed message, chunk by chunk
+    def decr_payload_stream(self, outer_packets, passwd : str, options : list, binding=b""):
+        outer_packets = iter(outer_packets)
+        key_wrap_packets = []; first_payload = None; segmented_packet = None
+        for packet in outer_packets:
+            if packet.tag == pkt.TAG_KEY_WRAP: key_wrap_packets += [packet]
+            elif packet.tag == pkt.TAG_SEGMENTED: segmented_packet = packet
+            elif packet.tag == pkt.TAG_PAYLOAD: first_payload = packet; break
+        if first_payload is None: raise pkt.PacketFormatError("message has no payload")
+        if segmented_packet is not None:
+            params, opener = self.decr_segment_opener(segmented_packet, key_wrap_packets, passwd, binding)
+            payload_packets = itertools.chain([first_payload], (p for p in outer_packets if p.tag == pkt.TAG_PAYLOAD))
+            yield from self.decr_segments(params, opener, payload_packets)
+            return
+        stages = []
+        if any(option in CIPHER_OPTIONS for option in options):
+            key_params = self.decr_unwrap_key_params(key_wrap_packets, passwd)
+            session_key_component = session_key_component_of(key_params)
+        if "chacha20_encrypt" in options:
+            stages += [self.timed_stage("decrypt", "chacha20", pgpc.PGPCore(None, None, None, *key_params[pkt.ALGO_CHACHA20_POLY1305]).chacha20_poly1305().set_associated_data(binding).decrypt_stage())]
+        if "aes_gcm_encrypt" in options:
+            stages += [self.timed_stage("decrypt", "aes_gcm", pgpc.PGPCore(None, None, None, *key_params[pkt.ALGO_AES256_GCM]).aes256_gcm().set_associated_data(binding).decrypt_stage())]
+        if "3des_encrypt" in options:
+            des3_sk, des3_iv = session_key_component[2:4] if "aes_encrypt" in options else session_key_component[0:2]
+            stages += [self.timed_stage("decrypt", "3des", pgpc.PGPCore(None, None, None, des3_sk, des3_iv).tripple_des().decrypt_stage())]
+        if "aes_encrypt" in options:
+            stages += [self.timed_stage("decrypt", "aes", pgpc.PGPCore(None, None, None, session_key_component[0], session_key_component[1]).aes128().decrypt_stage())]
+        if "compression" in options: stages += [self.timed_stage("decrypt", "compression", pgpc.PGPCore(None, None, None).unzip_stage())]
+        payload = itertools.chain([first_payload.body], (p.body for p in outer_packets if p.tag == pkt.TAG_PAYLOAD))
+        yield from pgpc.run_stages(payload, stages)
+
+    # literal data of a streamed message, the signature is checked after the last chunk.
+    # max_packet_size - None for messages with a single literal data packet
+    def decr_literal_stream(self, payload_chunks, options : list, binding=b"", max_packet_size=pkt.MAX_PACKET_SIZE):
+        hasher = pgpc.PGPCore.new_hasher() if "sign_msg" in options else None
+        if hasher is not None: hasher.update(binding)
+        signature_packet = None; digest = None
+        for packet in pkt.read_packets(payload_chunks, max_packet_size=max_packet_size):
+            # the signature would not be checked, the header was changed to say there is none
+            if hasher is None and packet.tag == pkt.TAG_SIGNATURE: raise Exception("signed message, but its header says it isn't")
+            if hasher is not None and signature_packet is None:
+                if packet.tag == pkt.TAG_SIGNATURE:
+                    signature_packet = packet; digest = hasher.finalize()
+                    continue
+                hasher.update(pkt.PACKET_HEADER.pack(packet.tag, len(packet.body)))
+                hasher.update(packet.body)
+            if packet.tag == pkt.TAG_LITERAL_DATA: yield packet.body
+        if hasher is not None:
+            if signature_packet is None: raise Exception("message is not signed")
+            self.decr_verify_digest(signature_packet, digest)
+
+    def pgp_decrypt_stream(self, source, sink, passwd : str, options=None, chunk_size=pgpc.PGPCore.STREAM_CHUNK_SIZE):
+        """ Streaming version of pgp_decrypt_message, reads source (file path, buffer, file-like
+        object or iterable of chunks) and writes the message data to sink. Data is written as it is decrypted, so
+        with "sign_msg" an invalid signature is only reported (InvalidSignature raised) after
+        all of it has been written. Options are read from the message header like in
+        pgp_decrypt_message. Returns the number of bytes written """
+        started = time.perf_counter()
+        header, armored, chunks = self.decr_peek_header(pgpc.iter_chunks(source, chunk_size), options)
+        if header is None:
+            # messages made before packet framing can't be read incrementally
+            data = self.pgp_decrypt_legacy_message(b"".join(chunks), "", passwd, self.decr_message_options(None, options), save_file=False)
+            sink.write(data)
+            if self.stage_hook is not None: self.stage_hook("decrypt", "total", time.perf_counter() - started, len(data))
+            return len(data)
+
+        options = self.decr_message_options(header, options)
+        binding = pkt.message_header_binding(header)
+        outer_packets = pkt.read_packets(chunks, expect_message_header=True)
+        # only streamed and segmented messages split the literal data into bounded packets
+        literal_packet_size = pkt.MAX_PACKET_SIZE if header.flags is not None and header.payload_length == pkt.UNKNOWN_LENGTH else None
+        written = 0
+        for chunk in self.decr_literal_stream(self.decr_payload_stream(outer_packets, passwd, options, binding), options, binding, literal_packet_size):
+            sink.write(chunk)
+            written += len(chunk)
+        if self.stage_hook is not None: self.stage_hook("decrypt", "total", time.perf_counter() - started, written)
+        return written
+
+    # (message header or None if there is none, True if armored, chunks to read the whole message from),
+    # only the first few hundred bytes of chunks are read
+    def decr_peek_header(self, chunks, options=None):
+        head, chunks = pgpc.peek_chunks(chunks, 64)
+        armored = self.decr_is_armored(head, options)
+        if armored: chunks = pgpc.run_stages(chunks, [self.timed_stage("decrypt", "radix64", pgpc.ArmorDecodeStage())])
+        head, chunks = pgpc.peek_chunks(chunks, len(pkt.MESSAGE_HEADER) + pkt.MESSAGE_INFO.size)
+        if not pkt.is_packet_message(head): return None, armored, chunks
+        head, chunks = pgpc.peek_chunks(chunks, pkt.message_header_size(head) or len(head))
+        return pkt.unpack_message_header(head), armored, chunks
+
+    def inspect_message(self, source) -> dict:
+        """ Options, signer and recipients of a message read from its header, without decrypting
+        anything - only the first few hundred bytes of source (anything PGPCore.iter_chunks reads,
+        armored or binary) are read. Returns {"version", "armored", "options", "sender_key_id"
+        (None if not signed), "recipient_key_ids", "keys_length", "payload_length"}, lengths
+        are None when not known. Version 1 messages only have "version" and "armored" set """
+        header, armored, chunks = self.decr_peek_header(pgpc.iter_chunks(source, INSPECT_CHUNK_SIZE))
+        if header is None: raise pkt.PacketFormatError("message has no header")
+        if header.flags is None: return {"version": header.version, "armored": armored, "options": None,
+            "sender_key_id": None, "recipient_key_ids": None, "keys_length": None, "payload_length": None}
+        return {"version": header.version, "armored": armored, "options": options_of(header.flags),
+            "sender_key_id": header.sender_kid if header.flags & pkt.FLAG_SIGNED else None,
+            "recipient_key_ids": header.recipient_kids, "keys_length": header.keys_length,
+            "payload_length": header.payload_length if header.payload_length != pkt.UNKNOWN_LENGTH else None}
+
+    # outer packets of a segmented message in a seekable binary file, up to its first segment
+    def decr_segmented_head(self, f):
+        index_packet = pkt.read_segment_index(f)
+        literal_data_size, offsets = pkt.unpack_segment_index(index_packet.body)
+        header = pkt.read_message_header(f)
+        packets = []; offset = header.size
+        while offset < (offsets[0] if offsets else index_packet.start):
+            packet = pkt.read_packet_at(f, offset)
+            packets += [packet]; offset += pkt.PACKET_HEADER.size + len(packet.body)
+        if pkt.find(packets, pkt.TAG_SEGMENTED) is None: raise pkt.PacketFormatError("not a segmented message")
+        return packets, literal_data_size, offsets, pkt.message_header_binding(header)
+
+    def pgp_segmented_data_size(self, source) -> int:
+        """ size of the data in a segmented message (bytes-like or seekable binary file) """
+        f = source if hasattr(source, "seek") else io.BytesIO(source)
+        return pkt.unpack_segment_index(pkt.read_segment_index(f).body)[0]
+
+    def pgp_decrypt_range(self, source, passwd : str, start : int, end=None) -> bytes:
+        """ Bytes start to end (exclusive, None for the end of the data) of a segmented binary
+        message, source is bytes-like or a seekable binary file. Only the segments holding
+        that range are read and decrypted. Each of them is authenticated by its AEAD tag,
+        the signature of the whole message ("sign_msg") is not checked """
+        f = source if hasattr(source, "seek") else io.BytesIO(source)
+        packets, literal_data_size, offsets, binding = self.decr_segmented_head(f)
+        end = literal_data_size if end is None else min(end, literal_data_size)
+        if start < 0 or start >= end: return b""
+        params, opener = self.decr_segment_opener(pkt.find(packets, pkt.TAG_SEGMENTED), pkt.find_all(packets, pkt.TAG_KEY_WRAP), passwd, binding)
+        # literal data packet k holds bytes k * literal_size on, its header starts at packet_start(k) in the plaintext
+        header_size = pkt.PACKET_HEADER.size
+        packet_start = lambda k: params.literal_start + k * (header_size + params.literal_size)
+        first_packet, last_packet = start // params.literal_size, (end - 1) // params.literal_size
+        first_segment = packet_start(first_packet) // params.segment_size
+        last_segment = (packet_start(last_packet) + header_size + (end - 1) % params.literal_size) // params.segment_size
+        if last_segment >= len(offsets): raise pkt.PacketFormatError("segment index doesn't match the payload")
+        items = ((params, opener, index, pkt.read_packet_at(f, offsets[index]).body, index == len(offsets) - 1)
+            for index in range(first_segment, last_segment + 1))
+        plaintext = b"".join(self.map_segments(self.decr_segment, items, (last_segment + 1 - first_segment) * params.segment_size))
+        base = first_segment * params.segment_size
+        data = bytearray()
+        for k in range(first_packet, last_packet + 1):
+            position = packet_start(k) - base
+            tag, length = pkt.PACKET_HEADER.unpack_from(plaintext, position)
+            if tag != pkt.TAG_LITERAL_DATA or length != min(params.literal_size, literal_data_size - k * params.literal_size):
+                raise pkt.PacketFormatError("segment index doesn't match the payload")
+            data_start = position + header_size - k * params.literal_size
+            data += plaintext[data_start + max(start, k * params.literal_size):data_start + min(end, (k + 1) * params.literal_size)]
+        return bytes(data)
+
+    def pgp_run_batch_item(self, item : dict) -> dict:
+        """ item - {"op": "encrypt_message" or "decrypt_message", "data": bytes, "options": list (optional for decrypt),
+        "filename": str (optional), "passwd": str (decrypt), "sender_prk_id", "sender_prk_passwd",
+        "sender_puk_id", "receiver_puk_id", "compression_algo", "compression_level" (encrypt, optional)}
+        returns {"ok": True, "data": bytes} or {"ok": False, "error": str}, nothing is saved to files """
+        try:
+            # set_send_msg_params keeps state, so every item gets its own facade
+            pgpf = PGPFacade(self.private_ks, self.public_ks, self.stage_hook).set_compression_params(
+                item.get("compression_algo", self.compression_algo), item.get("compression_level", self.compression_level), self.compression_min_gain)
+            filename = item.get("filename", "batch_message.pgp")
+            if item["op"] == "encrypt_message":
+                pgpf.set_send_msg_params(item.get("sender_prk_id"), item.get("sender_prk_passwd"),
+                    item.get("sender_puk_id"), item.get("receiver_puk_id"))
+                data = pgpf.pgp_encrypt_message(item["data"], filename, item["options"], save_file=False)
+            elif item["op"] == "decrypt_message":
+                data = pgpf.pgp_decrypt_message(item["data"], filename, item.get("passwd"), item.get("options"), save_file=False)
+            else: raise Exception("unknown batch operation " + str(item["op"]))
+            return {"ok": True, "data": data}
+        except Exception as e:
+            return {"ok": False, "error": repr(e)}
+
+    def pgp_process_batch(self, items : list, executor=None) -> list:
+        """ Runs every item (see pgp_run_batch_item) and returns their results in the same order.
+        executor - None runs items one by one, a ThreadPoolExecutor shares this facade's key stores,
+        a ProcessPoolExecutor has to come from make_batch_process_pool so its workers have key stores """
+        if executor is None: return [self.pgp_run_batch_item(item) for item in items]
+        if isinstance(executor, ProcessPoolExecutor): return list(executor.map(run_batch_item_in_worker, items))
+        return list(executor.map(self.pgp_run_batch_item, items))
+
+
+# facade of a batch worker process, see make_batch_process_pool
+worker_facade = None
+
+def init_batch_worker(load_key_stores):
+    global worker_facade
+    private_ks, public_ks = load_key_stores()
+    worker_facade = PGPFacade(private_ks, public_ks)
+
+def run_batch_item_in_worker(item : dict) -> dict:
+    return worker_facade.pgp_run_batch_item(item)
+
+def make_batch_process_pool(max_workers, load_key_stores) -> ProcessPoolExecutor:
+    """ load_key_stores - picklable callable returning (private key store, public key store),
+    called once in every worker process. Workers see keys as they were when they loaded
+    them, unless the stores read from a shared database (sqlite_key_store) """
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=init_batch_worker, initargs=(load_key_stores,))
+
 # tests for this class
+def load_mock_key_stores():
+    return mks.MockPRKStore(), mks.MockPUKStore()
+
 if __name__ == "__main__":
+    import os
+    from cryptography.exceptions import InvalidTag
 
     # test all combinations of options
     p1 = PGPFacade(mks.MockPRKStore(), mks.MockPUKStore())
@@ -204,16 +825,135 @@ if __name__ == "__main__":
     rez = p1.pgp_decrypt_message(None, "pgp_facade_test.pgp", "password", ["compression", "radix64", "sign_msg", "aes_encrypt", "3des_encrypt"])
     if rez != b"abcdefgh" * 111: raise Exception("Error")
 
+    # one message for several receivers, each of them can decrypt it
+    p1.set_send_msg_params(
+        sender_prk_id="prk1_2048", sender_prk_passwd="password",
+        sender_puk_id="puk1_2048", receiver_puk_id=["puk2_2048", "puk1_1024"]
+    )
+    multi_options = ["compression", "sign_msg", "aes_encrypt", "3des_encrypt"]
+    msg = p1.pgp_encrypt_message(b"abcdefgh" * 111, "pgp_facade_test.pgp", multi_options)
+    for receiver in ["prk2_2048", "prk1_1024"]:
+        receiver_ks = mks.MockPRKStore(); receiver_ks.my_kids = [receiver]
+        receiver_ks.my_key_store = {k: v for k, v in mks.private_key_data.items() if v is mks.private_key_data[receiver]}
+        rez = PGPFacade(receiver_ks, mks.MockPUKStore()).pgp_decrypt_message(msg, "pgp_facade_test.pgp", "password", multi_options)
+        if rez != b"abcdefgh" * 111: raise Exception("Error")
+    p1.set_send_msg_params(
+        sender_prk_id="prk1_2048", sender_prk_passwd="password",
+        sender_puk_id="puk1_2048", receiver_puk_id="puk1_2048"
+    )
+
     all_passed = True
     test_data = b"abcdefgh" * 111
     options = ["compression", "radix64", "sign_msg", "aes_encrypt", "3des_encrypt"]
     sub_options = None
     for i in range(1 << len(options)):
         sub_options = [options[j] for j in range(len(options)) if (i & (1 << j))]
-        p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", sub_options)
+        msg = p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", sub_options)
         rez = p1.pgp_decrypt_message(None, "pgp_facade_test.pgp", "password", sub_options)
         if rez != test_data:
             all_passed = False; break
+        # streamed messages in small chunks, read by both decrypt versions
+        streamed = io.BytesIO()
+        p1.pgp_encrypt_stream(io.BytesIO(test_data), streamed, "pgp_facade_test.pgp", sub_options, chunk_size=100)
+        rez = io.BytesIO()
+        p1.pgp_decrypt_stream(iter([streamed.getvalue()[j:j + 33] for j in range(0, len(streamed.getvalue()), 33)]), rez, "password", sub_options, chunk_size=100)
+        if rez.getvalue() != test_data or p1.pgp_decrypt_message(streamed.getvalue(), "", "password", sub_options, save_file=False) != test_data:
+            all_passed = False; break
+        rez = io.BytesIO()
+        p1.pgp_decrypt_stream(io.BytesIO(msg), rez, "password", sub_options, chunk_size=100)
+        if rez.getvalue() != test_data:
+            all_passed = False; break
+    # AEAD ciphers, alone, with the other options and with the CFB ciphers, tampering is detected
+    for aead_options in [["aes_gcm_encrypt"], ["chacha20_encrypt"], ["compression", "radix64", "sign_msg", "aes_gcm_encrypt"],
+        ["compression", "sign_msg", "chacha20_encrypt"], ["aes_encrypt", "3des_encrypt", "aes_gcm_encrypt", "chacha20_encrypt"]]:
+        msg = p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", aead_options, save_file=False)
+        streamed = io.BytesIO()
+        p1.pgp_encrypt_stream(io.BytesIO(test_data), streamed, "pgp_facade_test.pgp", aead_options, chunk_size=100)
+        rez = io.BytesIO()
+        p1.pgp_decrypt_stream(iter([streamed.getvalue()[j:j + 33] for j in range(0, len(streamed.getvalue()), 33)]), rez, "password", aead_options, chunk_size=100)
+        if p1.pgp_decrypt_message(msg, "", "password", aead_options, save_file=False) != test_data or rez.getvalue() != test_data \
+            or p1.pgp_decrypt_message(streamed.getvalue(), "", "password", aead_options, save_file=False) != test_data:
+            all_passed = False; sub_options = aead_options
+        if "radix64" not in aead_options:
+            tampered = bytearray(msg); tampered[-1] ^= 1
+            try:
+                p1.pgp_decrypt_message(bytes(tampered), "", "password", aead_options, save_file=False)
+                all_passed = False; sub_options = aead_options
+            except InvalidTag:
+                pass
+    # options and key ids come from the message header, decrypting doesn't need the options
+    msg = p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", options, save_file=False)
+    info = p1.inspect_message(msg)
+    rez = io.BytesIO()
+    p1.pgp_decrypt_stream(io.BytesIO(msg), rez, "password")
+    if info["options"] != [option for option in options if option != "radix64"] or not info["armored"] \
+        or info["recipient_key_ids"] != [p1.get_public_key_id(p1.receiver_puk)] or rez.getvalue() != test_data \
+        or p1.pgp_decrypt_message(msg, "", "password", save_file=False) != test_data:
+        all_passed = False; sub_options = options + ["inspect"]
+    # the header is signed and sealed with the payload, changing a flag (bytes 5-6) breaks decryption,
+    # options passed to decrypt must be in the header
+    for header_options, flag in [(["sign_msg", "chacha20_encrypt"], pkt.FLAG_SIGNED), (["sign_msg", "aes_encrypt"], pkt.FLAG_SIGNED),
+        (["compression", "segmented"], pkt.FLAG_COMPRESSED), (["aes_gcm_encrypt"], pkt.FLAG_COMPRESSED)]:
+        msg = bytearray(p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", header_options, save_file=False))
+        msg[6] ^= flag
+        for decrypt in [lambda: p1.pgp_decrypt_message(bytes(msg), "", "password", save_file=False),
+            lambda: p1.pgp_decrypt_stream(io.BytesIO(bytes(msg)), io.BytesIO(), "password"),
+            lambda: p1.pgp_decrypt_message(bytes(msg), "", "password", header_options, save_file=False)]:
+            try:
+                decrypt()
+                all_passed = False; sub_options = header_options + ["tampered"]
+            except Exception:
+                pass
+    try:
+        p1.pgp_decrypt_message(p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", ["aes_gcm_encrypt"], save_file=False),
+            "", "password", ["sign_msg", "aes_gcm_encrypt"], save_file=False)
+        all_passed = False; sub_options = ["sign_msg", "required"]
+    except Exception:
+        pass
+    # segmented messages, whole and by byte ranges, small segments so there are many of them,
+    # streamed ones start on the segment pool after the first 3 segments
+    p1.set_segment_params(100).set_parallel_params(250, window=3)
+    for segmented_options in [["segmented"], ["segmented", "compression", "sign_msg", "chacha20_encrypt"], ["segmented", "radix64", "sign_msg", "aes_gcm_encrypt"]]:
+        msg = p1.pgp_encrypt_message(test_data, "pgp_facade_test.pgp", segmented_options, save_file=False)
+        streamed = io.BytesIO()
+        p1.pgp_encrypt_stream(io.BytesIO(test_data), streamed, "pgp_facade_test.pgp", segmented_options, chunk_size=33)
+        rez = io.BytesIO()
+        p1.pgp_decrypt_stream(io.BytesIO(streamed.getvalue()), rez, "password", segmented_options, chunk_size=50)
+        if p1.pgp_decrypt_message(msg, "", "password", segmented_options, save_file=False) != test_data or rez.getvalue() != test_data:
+            all_passed = False; sub_options = segmented_options
+        if "radix64" in segmented_options: continue
+        for start, end in [(0, None), (0, 1), (99, 101), (250, 700), (887, 888), (800, 5000)]:
+            if p1.pgp_decrypt_range(msg, "password", start, end) != test_data[start:end] \
+                or p1.pgp_decrypt_range(streamed, "password", start, end) != test_data[start:end]:
+                all_passed = False; sub_options = segmented_options + [(start, end)]
+    p1.set_segment_params().set_parallel_params()
+    # every compression algorithm, compressible and incompressible payloads, decrypt reads the algorithm from the message
+    for algo in ["bz2", "lzma", "deflate"]:
+        p1.set_compression_params(algo, 1)
+        for payload in [test_data, os.urandom(5000)]:
+            msg = p1.pgp_encrypt_message(payload, "pgp_facade_test.pgp", options, save_file=False)
+            streamed = io.BytesIO()
+            p1.pgp_encrypt_stream(io.BytesIO(payload), streamed, "pgp_facade_test.pgp", options, chunk_size=100)
+            p2 = PGPFacade(mks.MockPRKStore(), mks.MockPUKStore())
+            if p2.pgp_decrypt_message(msg, "", "password", options, save_file=False) != payload \
+                or p2.pgp_decrypt_message(streamed.getvalue(), "", "password", options, save_file=False) != payload:
+                all_passed = False; sub_options = options + [algo]
+    p1.set_compression_params()
+    # batch api, sequential, thread pool and process pool
+    from concurrent.futures import ThreadPoolExecutor
+    batch_options = ["compression", "sign_msg", "aes_encrypt"]
+    batch = [{"op": "encrypt_message", "data": test_data * (i + 1), "options": batch_options,
+        "sender_prk_id": "prk1_2048", "sender_prk_passwd": "password",
+        "sender_puk_id": "puk1_2048", "receiver_puk_id": "puk2_2048"} for i in range(8)]
+    batch += [{"op": "encrypt_message", "data": test_data, "options": batch_options}] # fails, no keys
+    with ThreadPoolExecutor(4) as thread_pool, make_batch_process_pool(2, load_mock_key_stores) as process_pool:
+        for executor in [None, thread_pool, process_pool]:
+            results = p1.pgp_process_batch(batch, executor)
+            if results[-1]["ok"]: all_passed = False
+            decr_batch = [{"op": "decrypt_message", "data": r["data"], "options": batch_options, "passwd": "password"} for r in results[:-1]]
+            decr_results = p1.pgp_process_batch(decr_batch, executor)
+            if [r["data"] for r in decr_results] != [test_data * (i + 1) for i in range(8)]: all_passed = False
+
     if all_passed: print(" [*]\tAll tests passed")
     else: print(" [X]\tTest failed -- fail options: " + str(sub_options))
 
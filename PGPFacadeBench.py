@@ -0,0 +1,298 @@
+""" Benchmark of pgp_encrypt_message/pgp_decrypt_message over every option subset,
+    payload size and RSA key size. Reports encrypt/decrypt latency percentiles,
+    throughput and peak RSS, writes the results as a JSON baseline and compares
+    a run (or a saved result file) against a baseline.
+
+    usage: python PGPFacadeBench.py [--sizes 1K,64K,1M | quick | full] [--key-sizes 1024,2048,4096]
+               [--options all | none,aes_encrypt,compression+aes_encrypt,...] [--api message | stream]
+               [--compression deflate,bz2,lzma:9] [--parallel-threshold 4M | off] [--repeat 5] [--payload random | text] [--out results.json]
+               [--compare baseline.json [--current results.json]] [--threshold 0.10]
+
+    Every case runs in its own worker process, so peak RSS belongs to that case
+    only (--no-isolate runs them in this process, RSS then only grows).
+    "full" goes up to 1 GB - with --api message the whole message is held in
+    memory several times over, --api stream keeps memory use flat.
+    Compare mode exits with status 1 when a case got slower (p50) or bigger
+    (peak RSS) by more than the threshold. """
+
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import itertools
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import cryptography
+from cryptography.hazmat.primitives import serialization
+import key_store_interface as ksi
+import PGPFacade as pgpf
+import mock_key_store as mks
+
+OPTIONS = ["compression", "radix64", "sign_msg", "aes_encrypt", "3des_encrypt", "aes_gcm_encrypt", "chacha20_encrypt", "segmented"]
+# "all" runs every subset of the other options with each of these cipher choices,
+# AEAD ciphers are meant to be used alone (all four don't fit a 1024b key's wrap)
+CIPHER_SETS = [[], ["aes_encrypt"], ["3des_encrypt"], ["aes_encrypt", "3des_encrypt"], ["aes_gcm_encrypt"], ["chacha20_encrypt"], ["segmented"]]
+SIZE_PRESETS = {
+    "quick": "1K,64K,1M",
+    "full": "1K,16K,256K,4M,64M,1G",
+}
+UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+PASSWD = "password"
+BLOCK_SIZE = 2 ** 20 # payloads repeat one block of this size
+MIN_CASE_TIME = 0.5 # small payloads are repeated until a case takes at least this long
+MAX_RUNS = 200
+RSS_SLACK_MB = 8 # RSS differences below this are never reported as regressions
+
+
+class BenchPRKStore(ksi.PrivateKeyStore):
+
+    def __init__(self, keys):
+        self.keys = keys # uid -> private key
+
+    def get_key_by_kid(self, keyId : int, key_passwd : str):
+        for key in self.keys.values():
+            if key.public_key().public_numbers().n % (2 ** 64) == keyId: return key
+        return None
+
+    def get_key_by_uid(self, userId : str, key_passwd : str):
+        return self.keys.get(userId, None)
+
+
+class BenchPUKStore(ksi.PublicKeyStore):
+
+    def __init__(self, keys):
+        self.keys = {uid: key.public_key() for uid, key in keys.items()}
+        self.key_ids = {uid: key.public_numbers().n % (2 ** 64) for uid, key in self.keys.items()}
+
+    def get_key_by_kid(self, keyId : int):
+        for key in self.keys.values():
+            if key.public_numbers().n % (2 ** 64) == keyId: return key
+        return None
+
+    def get_key_by_uid(self, userId : str):
+        return self.keys.get(userId, None)
+
+    def get_kid_key_pairs_by_uid(self, userId : str):
+        return [(self.key_ids[userId], self.keys[userId])] if userId in self.keys else []
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS: return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0: return str(size // UNITS[unit]) + unit
+    return str(size)
+
+def parse_options(text):
+    if text == "all":
+        others = [option for option in OPTIONS if option not in pgpf.CIPHER_OPTIONS and option != "segmented"]
+        return [list(combo) + ciphers for ciphers in CIPHER_SETS for n in range(len(others) + 1) for combo in itertools.combinations(others, n)]
+    option_sets = []
+    for option_set in text.split(","):
+        options = [] if option_set == "none" else option_set.split("+")
+        for option in options:
+            if option not in OPTIONS: raise ValueError("unknown option " + option)
+        option_sets += [options]
+    return option_sets
+
+def parse_compression(text):
+    """ "lzma:9" -> ("lzma", 9), "bz2" -> ("bz2", None) """
+    algo, _, level = text.partition(":")
+    return algo, int(level) if level else None
+
+def options_label(result):
+    options = list(result["options"])
+    compression = result.get("compression", "deflate")
+    if "compression" in options and compression != "deflate": options[options.index("compression")] = "compression=" + compression
+    return "+".join(options) or "none"
+
+def make_payload(size, kind):
+    if kind == "text":
+        block = b"".join(b"line %d of the benchmark payload, compresses well\n" % i for i in range(BLOCK_SIZE // 40))[:BLOCK_SIZE]
+    else:
+        block = os.urandom(BLOCK_SIZE)
+    return (block * (size // BLOCK_SIZE + 1))[:size]
+
+def iter_payload(size, kind, chunk_size=pgpf.pgpc.PGPCore.STREAM_CHUNK_SIZE):
+    block = make_payload(min(size, BLOCK_SIZE), kind)
+    view = memoryview(block)
+    for start in range(0, size, chunk_size):
+        offset = start % len(block)
+        yield view[offset:offset + min(chunk_size, size - start)]
+
+def percentile(values, p):
+    values = sorted(values)
+    pos = (len(values) - 1) * p / 100
+    low = int(pos); high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+def summarize(times, size):
+    p50 = percentile(times, 50)
+    return {
+        "runs": len(times),
+        "min_ms": min(times) * 1000, "p50_ms": p50 * 1000, "p90_ms": percentile(times, 90) * 1000,
+        "p99_ms": percentile(times, 99) * 1000, "max_ms": max(times) * 1000,
+        "mb_s": size / p50 / 2 ** 20 if p50 > 0 else None,
+    }
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+class CountingSink:
+
+    def __init__(self): self.size = 0
+
+    def write(self, data): self.size += len(data)
+
+
+# set in every worker process by init_bench_worker
+bench_facade = None
+
+def init_bench_worker(key_pems):
+    global bench_facade
+    keys = {uid: serialization.load_pem_private_key(pem, None) for uid, pem in key_pems.items()}
+    bench_facade = pgpf.PGPFacade(BenchPRKStore(keys), BenchPUKStore(keys))
+
+def run_case(case):
+    """ case - {"api", "key_size", "size", "options", "compression", "payload", "repeat"},
+    returns case with "encrypt", "decrypt" and "peak_rss_mb" added """
+    uid = "bench%d" % case["key_size"]
+    bench_facade.set_send_msg_params(sender_prk_id=uid, sender_prk_passwd=PASSWD, sender_puk_id=uid, receiver_puk_id=uid)
+    bench_facade.set_compression_params(*parse_compression(case.get("compression", "deflate")))
+    bench_facade.set_parallel_params(case.get("parallel_threshold", pgpf.PARALLEL_THRESHOLD))
+    size, options = case["size"], case["options"]
+    encrypt_times = []; decrypt_times = []
+    if case["api"] == "message":
+        data = make_payload(size, case["payload"])
+    started = time.perf_counter()
+    while len(encrypt_times) < case["repeat"] or (time.perf_counter() - started < MIN_CASE_TIME and len(encrypt_times) < MAX_RUNS):
+        if case["api"] == "message":
+            start = time.perf_counter()
+            msg = bench_facade.pgp_encrypt_message(data, "bench", options, save_file=False)
+            encrypt_times += [time.perf_counter() - start]
+            start = time.perf_counter()
+            out = bench_facade.pgp_decrypt_message(msg, "bench", PASSWD, options, save_file=False)
+            decrypt_times += [time.perf_counter() - start]
+            if out != data: raise Exception("round trip failed for " + str(options))
+            del msg, out
+        else:
+            # ciphertext goes to a temporary file so memory use stays independent of size
+            with tempfile.TemporaryFile() as msg:
+                start = time.perf_counter()
+                bench_facade.pgp_encrypt_stream(iter_payload(size, case["payload"]), msg, "bench", options)
+                encrypt_times += [time.perf_counter() - start]
+                sink = CountingSink()
+                msg.seek(0)
+                start = time.perf_counter()
+                bench_facade.pgp_decrypt_stream(msg, sink, PASSWD, options)
+                decrypt_times += [time.perf_counter() - start]
+            if sink.size != size: raise Exception("round trip failed for " + str(options))
+    return dict(case, encrypt=summarize(encrypt_times, size), decrypt=summarize(decrypt_times, size), peak_rss_mb=peak_rss_mb())
+
+def run_case_isolated(case, key_pems):
+    with ProcessPoolExecutor(max_workers=1, initializer=init_bench_worker, initargs=(key_pems,)) as executor:
+        return executor.submit(run_case, case).result()
+
+def load_keys(key_sizes):
+    # fixture keys from mock_key_store, the same ones on every run
+    keys = {"bench%d" % key_size: mks.fixture_key("bench%d" % key_size, key_size) for key_size in key_sizes}
+    return {uid: key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        for uid, key in keys.items()}
+
+def case_key(result):
+    return (result["api"], result["key_size"], result["size"], options_label(result))
+
+def print_result(result):
+    print(" [*]\t%-7s %5d %6s %-54s enc p50 %9.2f ms %8.1f MB/s | dec p50 %9.2f ms %8.1f MB/s | rss %7.1f MB" % (
+        result["api"], result["key_size"], format_size(result["size"]), options_label(result),
+        result["encrypt"]["p50_ms"], result["encrypt"]["mb_s"], result["decrypt"]["p50_ms"], result["decrypt"]["mb_s"],
+        result["peak_rss_mb"]))
+
+def run(args):
+    sizes = [parse_size(size) for size in SIZE_PRESETS.get(args.sizes, args.sizes).split(",")]
+    key_sizes = [int(key_size) for key_size in args.key_sizes.split(",")]
+    print(" [*]\tLoading keys " + args.key_sizes)
+    key_pems = load_keys(key_sizes)
+    if not args.isolate: init_bench_worker(key_pems)
+    results = []
+    parallel_threshold = None if args.parallel_threshold == "off" else parse_size(args.parallel_threshold)
+    option_cases = []
+    for options in parse_options(args.options):
+        # compression settings only matter with the compression option
+        option_cases += [(options, compression) for compression in args.compression.split(",")] if "compression" in options else [(options, "deflate")]
+    for key_size, size, (options, compression) in itertools.product(key_sizes, sizes, option_cases):
+        case = {"api": args.api, "key_size": key_size, "size": size, "options": options, "compression": compression,
+            "payload": args.payload, "repeat": args.repeat, "parallel_threshold": parallel_threshold}
+        result = run_case_isolated(case, key_pems) if args.isolate else run_case(case)
+        print_result(result)
+        results += [result]
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(), "python": platform.python_version(), "cryptography": cryptography.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(), "args": vars(args),
+        },
+        "results": results,
+    }
+
+def compare(baseline, current, threshold):
+    """ Prints every case of current that is slower or uses more memory than in
+    baseline by more than threshold (a fraction), returns the number of regressions """
+    baseline_results = {case_key(result): result for result in baseline["results"]}
+    regressions = 0; compared = 0
+    for result in current["results"]:
+        old = baseline_results.get(case_key(result), None)
+        if old is None: continue
+        compared += 1
+        changes = []
+        for op in ("encrypt", "decrypt"):
+            ratio = result[op]["p50_ms"] / old[op]["p50_ms"] if old[op]["p50_ms"] > 0 else 1
+            if ratio > 1 + threshold: changes += ["%s p50 %.2f -> %.2f ms (%+.0f%%)" % (op, old[op]["p50_ms"], result[op]["p50_ms"], (ratio - 1) * 100)]
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + threshold) and result["peak_rss_mb"] - old["peak_rss_mb"] > RSS_SLACK_MB:
+            changes += ["peak rss %.1f -> %.1f MB" % (old["peak_rss_mb"], result["peak_rss_mb"])]
+        if changes:
+            regressions += 1
+            print(" [!]\t%-7s %5d %6s %-54s %s" % (result["api"], result["key_size"], format_size(result["size"]),
+                options_label(result), ", ".join(changes)))
+    print(" [*]\t%d cases compared, %d regressions over %.0f%%" % (compared, regressions, threshold * 100))
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="PGPFacade option matrix benchmark")
+    parser.add_argument("--sizes", default="quick", help="comma separated sizes (1K, 4M, 1G) or " + " / ".join(SIZE_PRESETS))
+    parser.add_argument("--key-sizes", default="1024,2048,4096")
+    parser.add_argument("--options", default="all", help="all, or comma separated option sets joined with + (none for no options)")
+    parser.add_argument("--api", choices=["message", "stream"], default="message")
+    parser.add_argument("--compression", default="deflate", help="comma separated algorithms for the compression option, with an optional level (lzma:9)")
+    parser.add_argument("--parallel-threshold", default=format_size(pgpf.PARALLEL_THRESHOLD),
+        help="size from which segmented messages use the segment thread pool, off to never use it")
+    parser.add_argument("--repeat", type=int, default=5, help="minimum runs per case")
+    parser.add_argument("--payload", choices=["random", "text"], default="random")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--current", help="compare this result file instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false", help="run every case in this process")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.current:
+        with open(args.current) as f: current = json.load(f)
+    else:
+        current = run(args)
+    if args.out:
+        with open(args.out, "w") as f: json.dump(current, f, indent=1)
+        print(" [*]\tResults written to " + args.out)
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
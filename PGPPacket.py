@@ -0,0 +1,309 @@
+""" Length-prefixed binary framing of PGP messages (similar to OpenPGP packets)
+
+    message := MAGIC VERSION header keys payload
+    header  := flags (2B) sender key id (8B) recipient count (1B) keys length (8B)
+               payload length (8B) recipient key id (8B)*
+    keys    := key wrap and other outer packets, keys length bytes
+    payload := TAG_PAYLOAD packets (and the segment index), payload length bytes
+    packet  := tag (1B) body_length (8B, big endian) body
+
+    The fixed size header tells which options a message was made with, who
+    signed it and who can decrypt it, see inspect_message in PGPFacade. The
+    payload length is UNKNOWN_LENGTH when the message was streamed or is
+    segmented (the header is written before the payload). Version 1
+    messages have no header, MAGIC VERSION is followed by packets right away
+
+    Packets are read through memoryview slices of the original buffer,
+    so parsing a message does not copy any of its parts. Streamed messages
+    split literal data and payload into several packets of bounded size
+    and are read with PacketReader.
+
+    Segmented messages (see PGPFacade "segmented" option) carry the payload
+    as independently encrypted segments, one TAG_PAYLOAD packet each, and end
+    with a segment index so any part of them can be found and decrypted alone:
+
+    segmented := MAGIC VERSION header outer packets TAG_SEGMENTED TAG_PAYLOAD* TAG_SEGMENT_INDEX
+    index     := literal data size (8B) payload packet offset (8B)* index packet offset (8B) """
+
+import struct
+from collections import namedtuple
+
+MAGIC = b"\x89PGP"
+VERSION = 2
+VERSIONS = (1, 2) # versions that can be read
+MESSAGE_HEADER = MAGIC + bytes([VERSION])
+
+PACKET_HEADER = struct.Struct(">BQ")
+KEY_ID = struct.Struct(">Q")
+
+# after MESSAGE_HEADER - flags, sender key id (0 if not signed), number of recipients,
+# length of the keys section and of the payload section, then the recipient key ids
+MESSAGE_INFO = struct.Struct(">HQBQQ")
+RECIPIENT_COUNT_OFFSET = 10
+UNKNOWN_LENGTH = 2 ** 64 - 1
+MAX_RECIPIENTS = 255
+# largest packet PacketReader buffers - streamed and segmented messages split data into
+# packets of at most MAX_CHUNK_SIZE (plus compression and tag overhead, hence the margin),
+# only single payload and version 1 messages hold all of it in one packet, see max_packet_size_of.
+# A segment index of this size covers 2M segments
+MAX_PACKET_SIZE = 16 * 2 ** 20
+MAX_CHUNK_SIZE = MAX_PACKET_SIZE // 2
+# size - of the whole header, version 1 messages only have the version and size set
+MessageHeader = namedtuple("MessageHeader", ["version", "flags", "sender_kid", "recipient_kids", "keys_length", "payload_length", "size"])
+
+# message flags, which options the message was made with
+FLAG_COMPRESSED = 1
+FLAG_SIGNED = 2
+FLAG_AES128 = 4
+FLAG_3DES = 8
+FLAG_AES256_GCM = 16
+FLAG_CHACHA20_POLY1305 = 32
+FLAG_SEGMENTED = 64
+
+# outer packets (after the header)
+TAG_KEY_WRAP = 1 # recipient key id (8B) + RSA-OAEP wrapped key material, see pack_key_material
+TAG_RECIPIENT = 2 # receiver key id, version 1 messages (the header lists them now)
+TAG_PAYLOAD = 3 # inner packets, possibly compressed and/or encrypted
+TAG_SEGMENTED = 4 # SEGMENT_PARAMS of a segmented payload
+TAG_SEGMENT_INDEX = 5 # last packet of a segmented message
+# inner packets (payload)
+TAG_FILENAME = 10
+TAG_TIMESTAMP = 11
+TAG_LITERAL_DATA = 12 # message data, can be split into several packets
+TAG_SIGNATURE = 13 # sender key id (8B) + leading two octets (2B) + signature
+
+# symmetric algorithm ids used in key material, id -> (key size, iv size)
+ALGO_AES128 = 1
+ALGO_3DES = 2
+ALGO_AES256_GCM = 3 # AEAD, the "iv" is the nonce
+ALGO_CHACHA20_POLY1305 = 4
+ALGO_PARAM_SIZES = {ALGO_AES128: (16, 16), ALGO_3DES: (16, 8), ALGO_AES256_GCM: (32, 12), ALGO_CHACHA20_POLY1305: (32, 12)}
+
+# segmented payloads - AEAD algorithm id, flags, plaintext size of every segment but
+# the last, size of literal data packets and offset of the first one in the plaintext
+SEGMENT_PARAMS = struct.Struct(">BBQQQ")
+SEGMENT_FLAG_COMPRESSED = 1 # every segment is compressed on its own
+SegmentParams = namedtuple("SegmentParams", ["algo", "flags", "segment_size", "literal_size", "literal_start"])
+SEGMENT_OFFSET = struct.Struct(">Q")
+
+Packet = namedtuple("Packet", ["tag", "body", "start"]) # start = offset of the packet header
+
+class PacketFormatError(Exception): pass
+
+def pack(tag : int, body) -> bytes:
+    return PACKET_HEADER.pack(tag, len(body)) + body
+
+def pack_key_id(key_id : int) -> bytes:
+    return KEY_ID.pack(key_id)
+
+def unpack_key_id(body) -> int:
+    return KEY_ID.unpack(body)[0]
+
+def pack_key_material(params : list) -> bytes:
+    """ params is a list of (algo id, session key, iv), all of them are packed
+    together so they can be wrapped with a single RSA operation.
+    AES128 + 3DES take 58 bytes, which still fits RSA-OAEP with a 1024b key (62 bytes
+    at most), an AEAD cipher takes 45. Longer material needs a bigger key """
+    material = b""
+    for algo, session_key, iv in params:
+        if (len(session_key), len(iv)) != ALGO_PARAM_SIZES[algo]: raise PacketFormatError("bad key material size")
+        material += bytes([algo]) + session_key + iv
+    return material
+
+def unpack_key_material(material) -> dict:
+    """ returns {algo id: (session key, iv)} """
+    params = {}
+    offset = 0
+    while offset < len(material):
+        algo = material[offset]
+        if algo not in ALGO_PARAM_SIZES: raise PacketFormatError("unknown symmetric algorithm " + str(algo))
+        key_size, iv_size = ALGO_PARAM_SIZES[algo]
+        offset += 1
+        params[algo] = (bytes(material[offset:offset + key_size]), bytes(material[offset + key_size:offset + key_size + iv_size]))
+        offset += key_size + iv_size
+    if offset != len(material): raise PacketFormatError("truncated key material")
+    return params
+
+def pack_segment_params(params : SegmentParams) -> bytes:
+    return SEGMENT_PARAMS.pack(*params)
+
+def unpack_segment_params(body) -> SegmentParams:
+    if len(body) != SEGMENT_PARAMS.size: raise PacketFormatError("bad segment parameters")
+    params = SegmentParams(*SEGMENT_PARAMS.unpack(body))
+    if params.segment_size == 0 or params.literal_size == 0: raise PacketFormatError("bad segment parameters")
+    return params
+
+def pack_segment_index(literal_data_size : int, offsets : list, index_offset : int) -> bytes:
+    """ offsets - message offsets of the payload packets, index_offset - of the index packet """
+    return b"".join(SEGMENT_OFFSET.pack(value) for value in [literal_data_size] + offsets + [index_offset])
+
+def unpack_segment_index(body):
+    """ returns (literal data size, payload packet offsets) """
+    if len(body) < 2 * SEGMENT_OFFSET.size or len(body) % SEGMENT_OFFSET.size: raise PacketFormatError("bad segment index")
+    values = [value for (value,) in SEGMENT_OFFSET.iter_unpack(body)]
+    return values[0], values[1:-1]
+
+def pack_message_header(flags : int, sender_kid : int, recipient_kids : list, keys_length : int, payload_length=UNKNOWN_LENGTH) -> bytes:
+    if len(recipient_kids) > MAX_RECIPIENTS: raise PacketFormatError("too many recipients")
+    return MESSAGE_HEADER + MESSAGE_INFO.pack(flags, sender_kid, len(recipient_kids), keys_length, payload_length) \
+        + b"".join(pack_key_id(kid) for kid in recipient_kids)
+
+def header_binding(flags : int, sender_kid : int, recipient_kids : list) -> bytes:
+    """ The part of the header signatures and AEAD tags cover - all of it but the section
+    lengths (zero here), which aren't known yet when the payload is signed and sealed """
+    return pack_message_header(flags, sender_kid, recipient_kids, 0, 0)
+
+def message_header_binding(header : MessageHeader) -> bytes:
+    """ header_binding of a parsed header, version 1 messages have none (b"") """
+    if header.flags is None: return b""
+    return header_binding(header.flags, header.sender_kid, header.recipient_kids)
+
+def message_header_size(data) -> int:
+    """ size of the header at the start of data, None if data is too short to tell """
+    if len(data) < len(MESSAGE_HEADER): return None
+    if not is_packet_message(data): raise PacketFormatError("not a packet message")
+    version = data[len(MAGIC)]
+    if version not in VERSIONS: raise PacketFormatError("unsupported message version " + str(version))
+    if version == 1: return len(MESSAGE_HEADER)
+    if len(data) < len(MESSAGE_HEADER) + MESSAGE_INFO.size: return None
+    return len(MESSAGE_HEADER) + MESSAGE_INFO.size + data[len(MESSAGE_HEADER) + RECIPIENT_COUNT_OFFSET] * KEY_ID.size
+
+def unpack_message_header(data) -> MessageHeader:
+    size = message_header_size(data)
+    if size is None or len(data) < size: raise PacketFormatError("truncated message header")
+    if data[len(MAGIC)] == 1: return MessageHeader(1, None, None, None, None, None, size)
+    flags, sender_kid, count, keys_length, payload_length = MESSAGE_INFO.unpack_from(data, len(MESSAGE_HEADER))
+    kids_start = len(MESSAGE_HEADER) + MESSAGE_INFO.size
+    recipient_kids = [kid for (kid,) in KEY_ID.iter_unpack(bytes(data[kids_start:size]))]
+    return MessageHeader(VERSION, flags, sender_kid, recipient_kids, keys_length, payload_length, size)
+
+def read_message_header(f) -> MessageHeader:
+    """ header of the message in a seekable binary file, leaves f after it """
+    f.seek(0)
+    data = f.read(len(MESSAGE_HEADER) + MESSAGE_INFO.size)
+    size = message_header_size(data)
+    if size is not None and size > len(data): data += f.read(size - len(data))
+    return unpack_message_header(data)
+
+def read_packet_at(f, offset : int) -> Packet:
+    """ reads one packet from a seekable binary file """
+    f.seek(offset)
+    header = f.read(PACKET_HEADER.size)
+    if len(header) < PACKET_HEADER.size: raise PacketFormatError("truncated packet header")
+    tag, length = PACKET_HEADER.unpack(header)
+    body = f.read(length)
+    if len(body) < length: raise PacketFormatError("truncated packet body")
+    return Packet(tag, body, offset)
+
+def read_segment_index(f) -> Packet:
+    """ index packet of a segmented message in a seekable binary file, found
+    through the offset in the last 8 bytes """
+    f.seek(0, 2)
+    if f.tell() < len(MESSAGE_HEADER) + PACKET_HEADER.size + 2 * SEGMENT_OFFSET.size: raise PacketFormatError("not a segmented message")
+    f.seek(-SEGMENT_OFFSET.size, 2)
+    (index_offset,) = SEGMENT_OFFSET.unpack(f.read(SEGMENT_OFFSET.size))
+    packet = read_packet_at(f, index_offset)
+    if packet.tag != TAG_SEGMENT_INDEX: raise PacketFormatError("not a segmented message")
+    return packet
+
+def max_packet_size_of(header : MessageHeader, max_packet_size=MAX_PACKET_SIZE) -> int:
+    """ largest packet of a message with this header, None if it isn't bounded (version 1).
+    A single payload packet can take the whole payload section """
+    if header.flags is None: return None
+    if header.payload_length == UNKNOWN_LENGTH: return max_packet_size
+    return max(max_packet_size, header.payload_length)
+
+def message(packets : list, flags=0, sender_kid=0, recipient_kids=()) -> bytes:
+    """ packets is a list of (tag, body) pairs, TAG_PAYLOAD ones last. Without
+    them (streamed messages) the payload length is UNKNOWN_LENGTH """
+    packed = [pack(tag, body) for tag, body in packets]
+    keys_length = sum(len(p) for (tag, body), p in zip(packets, packed) if tag != TAG_PAYLOAD)
+    payload_length = sum(len(p) for p in packed) - keys_length
+    if not any(tag == TAG_PAYLOAD for tag, body in packets): payload_length = UNKNOWN_LENGTH
+    return pack_message_header(flags, sender_kid, list(recipient_kids), keys_length, payload_length) + b"".join(packed)
+
+def is_packet_message(data) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+def iter_packets(data, offset=0):
+    view = memoryview(data)
+    while offset < len(view):
+        if offset + PACKET_HEADER.size > len(view): raise PacketFormatError("truncated packet header")
+        tag, length = PACKET_HEADER.unpack_from(view, offset)
+        body_start = offset + PACKET_HEADER.size
+        if body_start + length > len(view): raise PacketFormatError("truncated packet body")
+        yield Packet(tag, view[body_start:body_start + length], offset)
+        offset = body_start + length
+
+def parse_packets(data) -> list:
+    return list(iter_packets(data))
+
+def parse_message(data) -> list:
+    return list(iter_packets(data, unpack_message_header(data).size))
+
+class PacketReader():
+
+    """ Incremental parser for streamed messages - feed() takes chunks of any size
+    and returns the packets they complete. Only the packet being read is buffered, a packet
+    longer than max_packet_size (None for no limit) is rejected as soon as its header is read.
+    With a message header the limit is raised to what the message may hold, see max_packet_size_of """
+
+    def __init__(self, expect_message_header=False, max_packet_size=MAX_PACKET_SIZE):
+        self.buffer = bytearray()
+        self.offset = 0 # offset of buffer[0] in the whole stream
+        self.expect_message_header = expect_message_header
+        self.max_packet_size = max_packet_size
+        self.header = None # MessageHeader, once it is read
+
+    def feed(self, chunk) -> list:
+        self.buffer += chunk
+        packets = []
+        position = 0
+        if self.expect_message_header:
+            size = message_header_size(self.buffer)
+            if size is None or len(self.buffer) < size: return packets
+            self.header = unpack_message_header(bytes(self.buffer[:size]))
+            if self.max_packet_size is not None: self.max_packet_size = max_packet_size_of(self.header, self.max_packet_size)
+            position = size
+            self.expect_message_header = False
+        while len(self.buffer) - position >= PACKET_HEADER.size:
+            tag, length = PACKET_HEADER.unpack_from(self.buffer, position)
+            if self.max_packet_size is not None and length > self.max_packet_size:
+                raise PacketFormatError("packet of %d bytes, at most %d expected" % (length, self.max_packet_size))
+            body_start = position + PACKET_HEADER.size
+            if len(self.buffer) - body_start < length: break
+            packets.append(Packet(tag, bytes(self.buffer[body_start:body_start + length]), self.offset + position))
+            position = body_start + length
+        del self.buffer[:position]
+        self.offset += position
+        return packets
+
+    def finish(self):
+        if self.buffer or self.expect_message_header: raise PacketFormatError("stream ends inside a packet")
+
+
+class PacketStage():
+
+    """ Stream stage (see PGPCore.StreamStage) that frames every chunk as one packet """
+
+    def __init__(self, tag : int):
+        self.tag = tag
+
+    def update(self, chunk): return pack(self.tag, bytes(chunk))
+
+    def finalize(self): return b""
+
+
+def read_packets(chunks, expect_message_header=False, max_packet_size=MAX_PACKET_SIZE):
+    """ Yields packets from an iterable of chunks, see PacketReader """
+    reader = PacketReader(expect_message_header, max_packet_size)
+    for chunk in chunks: yield from reader.feed(chunk)
+    reader.finish()
+
+def find(packets : list, tag : int) -> Packet:
+    for packet in packets:
+        if packet.tag == tag: return packet
+    return None
+
+def find_all(packets : list, tag : int) -> list:
+    return [packet for packet in packets if packet.tag == tag]
@@ -0,0 +1,86 @@
+import unittest
+import io
+import PGPPacket as pkt
+
+class PGPPacketTests(unittest.TestCase):
+
+    def test_message_idemp(self):
+        separator_like = b"&???|||???&" + b"{}{}***{}][{}***{}{}"
+        msg = pkt.message([(pkt.TAG_RECIPIENT, pkt.pack_key_id(2 ** 64 - 1)), (pkt.TAG_PAYLOAD, separator_like * 3)])
+        packets = pkt.parse_message(msg)
+        self.assertEqual([p.tag for p in packets], [pkt.TAG_RECIPIENT, pkt.TAG_PAYLOAD])
+        self.assertEqual(pkt.unpack_key_id(packets[0].body), 2 ** 64 - 1)
+        self.assertEqual(bytes(packets[1].body), separator_like * 3)
+        self.assertIsInstance(packets[1].body, memoryview)
+
+    def test_message_header(self):
+        msg = pkt.message([(pkt.TAG_KEY_WRAP, b"k" * 20), (pkt.TAG_PAYLOAD, b"p" * 30)],
+            pkt.FLAG_SIGNED | pkt.FLAG_AES256_GCM, 5, [7, 2 ** 64 - 1])
+        header = pkt.unpack_message_header(msg)
+        self.assertEqual(header, pkt.MessageHeader(pkt.VERSION, pkt.FLAG_SIGNED | pkt.FLAG_AES256_GCM, 5, [7, 2 ** 64 - 1],
+            pkt.PACKET_HEADER.size + 20, pkt.PACKET_HEADER.size + 30, len(pkt.MESSAGE_HEADER) + pkt.MESSAGE_INFO.size + 16))
+        self.assertEqual(len(msg), header.size + header.keys_length + header.payload_length)
+        self.assertIsNone(pkt.message_header_size(msg[:header.size - 17]))
+        self.assertEqual(pkt.read_message_header(io.BytesIO(msg)), header)
+        self.assertEqual(pkt.unpack_message_header(pkt.message([(pkt.TAG_KEY_WRAP, b"")])).payload_length, pkt.UNKNOWN_LENGTH)
+        # version 1, packets right after the version
+        v1 = pkt.MAGIC + bytes([1]) + msg[header.size:]
+        self.assertEqual(pkt.unpack_message_header(v1).size, len(pkt.MESSAGE_HEADER))
+        self.assertEqual([p.tag for p in pkt.parse_message(v1)], [pkt.TAG_KEY_WRAP, pkt.TAG_PAYLOAD])
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.message([], recipient_kids=range(pkt.MAX_RECIPIENTS + 1))
+
+    def test_packet_offsets(self):
+        data = pkt.pack(pkt.TAG_LITERAL_DATA, b"abc") + pkt.pack(pkt.TAG_SIGNATURE, b"sig")
+        signature = pkt.find(pkt.parse_packets(data), pkt.TAG_SIGNATURE)
+        self.assertEqual(data[:signature.start], pkt.pack(pkt.TAG_LITERAL_DATA, b"abc"))
+
+    def test_key_material_idemp(self):
+        params = [(pkt.ALGO_AES128, b"k" * 16, b"i" * 16), (pkt.ALGO_3DES, b"K" * 16, b"I" * 8)]
+        material = pkt.pack_key_material(params)
+        self.assertLessEqual(len(material), 62) # RSA-OAEP(SHA256) limit for 1024b keys
+        self.assertEqual(pkt.unpack_key_material(material), {algo: (sk, iv) for algo, sk, iv in params})
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.unpack_key_material(material[:-1])
+
+    def test_segment_index(self):
+        params = pkt.SegmentParams(pkt.ALGO_AES256_GCM, pkt.SEGMENT_FLAG_COMPRESSED, 4096, 4096, 40)
+        self.assertEqual(pkt.unpack_segment_params(pkt.pack_segment_params(params)), params)
+        head = pkt.message([(pkt.TAG_SEGMENTED, pkt.pack_segment_params(params))])
+        payload = pkt.pack(pkt.TAG_PAYLOAD, b"x" * 10) + pkt.pack(pkt.TAG_PAYLOAD, b"y" * 5)
+        index_offset = len(head) + len(payload)
+        msg = head + payload + pkt.pack(pkt.TAG_SEGMENT_INDEX, pkt.pack_segment_index(12, [len(head), len(head) + 19], index_offset))
+        f = io.BytesIO(msg)
+        index = pkt.read_segment_index(f)
+        self.assertEqual(index.start, index_offset)
+        literal_data_size, offsets = pkt.unpack_segment_index(index.body)
+        self.assertEqual((literal_data_size, offsets), (12, [len(head), len(head) + 19]))
+        self.assertEqual(bytes(pkt.read_packet_at(f, offsets[1]).body), b"y" * 5)
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.read_segment_index(io.BytesIO(head + payload))
+
+    def test_packet_reader(self):
+        msg = pkt.message([(pkt.TAG_RECIPIENT, pkt.pack_key_id(7)), (pkt.TAG_PAYLOAD, b""), (pkt.TAG_PAYLOAD, b"x" * 1000)])
+        packets = list(pkt.read_packets([msg[i:i + 3] for i in range(0, len(msg), 3)], expect_message_header=True))
+        self.assertEqual([(p.tag, bytes(p.body), p.start) for p in packets],
+            [(p.tag, bytes(p.body), p.start) for p in pkt.parse_message(msg)])
+        with self.assertRaises(pkt.PacketFormatError):
+            list(pkt.read_packets([msg[:-1]], expect_message_header=True))
+        # a packet over the limit is rejected from its header, before its body arrives
+        streamed = pkt.message([(pkt.TAG_RECIPIENT, pkt.pack_key_id(7))]) + pkt.PACKET_HEADER.pack(pkt.TAG_PAYLOAD, 2 ** 40)
+        with self.assertRaises(pkt.PacketFormatError):
+            list(pkt.read_packets([streamed], expect_message_header=True))
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.PacketReader(max_packet_size=999).feed(pkt.pack(pkt.TAG_PAYLOAD, b"x" * 1000))
+        # single payload messages may hold a packet as long as their payload section
+        self.assertEqual(len(list(pkt.read_packets([msg], expect_message_header=True, max_packet_size=10))), 3)
+
+    def test_bad_messages(self):
+        self.assertFalse(pkt.is_packet_message(b"legacy message"))
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.parse_message(pkt.MAGIC + bytes([pkt.VERSION + 1]))
+        with self.assertRaises(pkt.PacketFormatError):
+            pkt.parse_message(pkt.message([(pkt.TAG_PAYLOAD, b"0123456789")])[:-1])
+
+if __name__ == '__main__':
+    unittest.main()
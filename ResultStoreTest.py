@@ -0,0 +1,58 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+import result_store as rs
+
+class ResultStoreTests(unittest.TestCase):
+
+    def test_put_get_remove(self):
+        store = rs.ResultStore()
+        result_id = store.put(b"result data", "user_request.pgp")
+        self.assertNotEqual(result_id, store.put(b"result data", "user_request.pgp"))
+        self.assertEqual(store.get(result_id).data, b"result data")
+        store.remove(result_id)
+        self.assertIsNone(store.get(result_id))
+        self.assertEqual(store.stats(), {"results": 1, "memory_bytes": len(b"result data")})
+
+    def test_spooled_results(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            store = rs.ResultStore(spool_threshold=4, spool_dir=spool_dir)
+            result_id = store.put(b"larger than the threshold", "user_request.pgp")
+            result = store.get(result_id)
+            self.assertFalse(result.in_memory())
+            with open(result.path, "rb") as f: self.assertEqual(f.read(), b"larger than the threshold")
+            self.assertEqual(store.stats()["memory_bytes"], 0)
+            # an opened result can still be read after it is evicted
+            opened, f = store.open(result_id)
+            store.remove(result_id)
+            self.assertEqual(os.listdir(spool_dir), [])
+            with f: self.assertEqual(f.read(), b"larger than the threshold")
+            self.assertEqual(store.open(result_id), (None, None))
+
+    def test_eviction(self):
+        store = rs.ResultStore(max_results=2, max_memory_bytes=10, ttl=60)
+        first = store.put(b"1", "a"); second = store.put(b"2", "b"); third = store.put(b"3", "c")
+        self.assertIsNone(store.get(first))
+        self.assertIsNotNone(store.get(second))
+        store.put(b"0123456789", "d")
+        self.assertIsNone(store.get(second)); self.assertIsNone(store.get(third))
+        with mock.patch.object(rs.time, "monotonic", return_value=rs.time.monotonic() + 61):
+            self.assertEqual(store.stats()["results"], 1)
+            store.put(b"new", "e")
+            self.assertEqual(store.stats()["results"], 1)
+
+    def test_result_over_memory_limit_kept(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            store = rs.ResultStore(max_results=1, max_memory_bytes=10, spool_threshold=100, spool_dir=spool_dir)
+            older = store.put(b"old", "a")
+            # over max_memory_bytes but under the threshold - spooled, not evicted right away
+            result_id = store.put(b"0123456789abcdef", "b")
+            result = store.get(result_id)
+            self.assertFalse(result.in_memory())
+            self.assertIsNone(store.get(older))
+            with open(result.path, "rb") as f: self.assertEqual(f.read(), b"0123456789abcdef")
+            self.assertEqual(store.stats(), {"results": 1, "memory_bytes": 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+""" Local key agent, in the spirit of gpg-agent.
+
+    One agent process owns the key stores and the unlocked private keys, and
+    signs and RSA-decrypts for PGPFacade instances in any number of worker
+    processes, which connect over a Unix domain socket. Rings are parsed and
+    keys unlocked once, in the agent, instead of once per worker.
+
+    AgentPublicKeyStore and AgentPrivateKeyStore implement key_store_interface.
+    Private keys they return are AgentPrivateKey proxies - the key itself never
+    leaves the agent, sign() and decrypt() are forwarded to it.
+
+    Messages are JSON objects prefixed with their 4 byte big-endian length,
+    bytes are base64 encoded. The socket is only accessible to its owner.
+
+    usage: python key_agent.py [socket path] [keys.db]
+    (JSON rings from the working directory unless a database is given) """
+
+import os
+import sys
+import json
+import base64
+import struct
+import socket
+import threading
+import socketserver
+from cryptography.hazmat.primitives.asymmetric import padding, utils, rsa
+from cryptography.hazmat.primitives import serialization
+import key_store_interface as ksi
+import PGPCore as pgpc
+
+DEFAULT_SOCKET = os.environ.get("PGP_KEY_AGENT", "pgp_key_agent.sock")
+MESSAGE_LENGTH = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 16 * 2 ** 20
+
+
+class KeyAgentError(Exception):
+    pass
+
+
+def send_message(sock, message : dict):
+    data = json.dumps(message).encode()
+    sock.sendall(MESSAGE_LENGTH.pack(len(data)) + data)
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk: raise ConnectionError("key agent connection closed")
+        data += chunk
+    return bytes(data)
+
+def recv_message(sock) -> dict:
+    header = sock.recv(MESSAGE_LENGTH.size)
+    if not header: return None # closed between messages
+    if len(header) < MESSAGE_LENGTH.size: header += recv_exactly(sock, MESSAGE_LENGTH.size - len(header))
+    (size,) = MESSAGE_LENGTH.unpack(header)
+    if size > MAX_MESSAGE_SIZE: raise KeyAgentError("key agent message too large")
+    return json.loads(recv_exactly(sock, size))
+
+def b64(data : bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def public_pem(public_key) -> str:
+    return public_key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+
+class KeyAgent:
+    """ Answers requests with the stores of key_manager, JSON rings are reloaded
+    when their files change (keys added or removed by other processes) """
+
+    def __init__(self, key_manager):
+        self.key_manager = key_manager
+        self.reload_lock = threading.Lock()
+        self.mtimes = self.ring_mtimes()
+
+    def ring_files(self):
+        public_ks = self.key_manager.get_public_key_store(); private_ks = self.key_manager.get_private_key_store()
+        # SQLite stores read the database on every lookup and have no ring files
+        return [f for f in (getattr(public_ks, "filename", None), getattr(public_ks, "public_ring_filename", None),
+            getattr(private_ks, "filename", None)) if f is not None]
+
+    def ring_mtimes(self):
+        return {f: os.path.getmtime(f) if os.path.exists(f) else None for f in self.ring_files()}
+
+    def reload_if_changed(self):
+        with self.reload_lock:
+            mtimes = self.ring_mtimes()
+            if mtimes == self.mtimes: return
+            self.mtimes = mtimes
+            public_ks = self.key_manager.get_public_key_store()
+            public_ks.load_keys(); public_ks.load_public_key_ring()
+            # the unlock cache survives, lookups still check the reloaded ring first
+            self.key_manager.get_private_key_store().load_keys()
+
+    def private_key(self, request):
+        private_key = self.key_manager.get_private_key_store().get_key_by_kid(int(request["kid"]), request["passwd"])
+        if private_key is None: raise KeyAgentError("no such key or wrong password")
+        return private_key
+
+    def handle(self, request : dict) -> dict:
+        self.reload_if_changed()
+        op = request.get("op")
+        public_ks = self.key_manager.get_public_key_store()
+        private_ks = self.key_manager.get_private_key_store()
+        if op == "ping":
+            return {}
+        if op == "public_key":
+            if "kid" in request: pairs = [(int(request["kid"]), public_ks.get_key_by_kid(int(request["kid"])))]
+            else: pairs = public_ks.get_kid_key_pairs_by_uid(request["uid"])
+            pairs = [(kid, key) for kid, key in pairs if key is not None]
+            return {"pems": [public_pem(key) for kid, key in pairs], "kids": [str(kid) for kid, key in pairs]}
+        if op == "unlock":
+            if "kid" in request: keys = [private_ks.get_key_by_kid(int(request["kid"]), request["passwd"])]
+            else: keys = private_ks.get_key_by_uid(request["uid"], request["passwd"])
+            return {"keys": [{"kid": str(key.public_key().public_numbers().n % (2 ** 64)), "pem": public_pem(key.public_key())}
+                for key in keys if key is not None]}
+        if op == "sign_digest":
+            digest = base64.b64decode(request["digest"])
+            return {"signature": b64(pgpc.PGPCore(self.private_key(request), None, None).digest_signature(digest))}
+        if op == "decrypt":
+            data = base64.b64decode(request["data"])
+            return {"data": b64(pgpc.PGPCore(self.private_key(request), None, data).rsa_priv_decry().get_data())}
+        if op == "uid_by_kid":
+            return {"uid": public_ks.get_uid_by_kid(int(request["kid"]))}
+        if op == "stats":
+            return {"stats": self.key_manager.stats()}
+        raise KeyAgentError("unknown key agent operation " + str(op))
+
+
+class KeyAgentRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (ConnectionError, KeyAgentError, ValueError):
+                return
+            if request is None: return
+            try:
+                response = dict(self.server.agent.handle(request), ok=True)
+            except Exception as e:
+                response = {"ok": False, "error": str(e) if isinstance(e, KeyAgentError) else repr(e)}
+            send_message(self.request, response)
+
+
+class KeyAgentServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, key_manager):
+        self.agent = KeyAgent(key_manager)
+        if os.path.exists(socket_path): os.remove(socket_path)
+        old_umask = os.umask(0o177) # socket is created rw for the owner only
+        try:
+            super().__init__(socket_path, KeyAgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.socket_path = socket_path
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path): os.remove(self.socket_path)
+
+
+class KeyAgentClient:
+    """ One connection per thread, reconnects once if the agent went away """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.local = threading.local()
+
+    def connection(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+        return sock
+
+    def close(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is not None: sock.close()
+        self.local.sock = None
+
+    def call(self, op : str, **args) -> dict:
+        for attempt in range(2):
+            try:
+                sock = self.connection()
+                send_message(sock, dict(args, op=op))
+                response = recv_message(sock)
+                if response is None: raise ConnectionError("key agent connection closed")
+                break
+            except OSError:
+                self.close()
+                if attempt == 1: raise
+        if not response.pop("ok"): raise KeyAgentError(response["error"])
+        return response
+
+
+class AgentPrivateKey:
+    """ Stands in for rsa.RSAPrivateKey in PGPCore - signs SHA-256 digests with
+    PSS and decrypts OAEP, the two operations PGPCore uses, through the agent """
+
+    def __init__(self, client : KeyAgentClient, key_id : int, key_passwd : str, public_key : rsa.RSAPublicKey):
+        self.client = client
+        self.key_id = key_id
+        self.key_passwd = key_passwd
+        self._public_key = public_key
+        self.key_size = public_key.key_size
+
+    def public_key(self) -> rsa.RSAPublicKey:
+        return self._public_key
+
+    def sign(self, data, sign_padding, algorithm):
+        if not isinstance(sign_padding, padding.PSS) or not isinstance(algorithm, utils.Prehashed):
+            raise KeyAgentError("key agent keys only sign prehashed digests with PSS")
+        response = self.client.call("sign_digest", kid=str(self.key_id), passwd=self.key_passwd, digest=b64(bytes(data)))
+        return base64.b64decode(response["signature"])
+
+    def decrypt(self, ciphertext, decrypt_padding):
+        if not isinstance(decrypt_padding, padding.OAEP):
+            raise KeyAgentError("key agent keys only decrypt OAEP")
+        response = self.client.call("decrypt", kid=str(self.key_id), passwd=self.key_passwd, data=b64(bytes(ciphertext)))
+        return base64.b64decode(response["data"])
+
+
+class AgentPublicKeyStore(ksi.PublicKeyStore):
+
+    def __init__(self, client : KeyAgentClient):
+        self.client = client
+        self.parsed_keys = {} # pem -> key, public keys are cheap to keep
+
+    def load_pem(self, pem):
+        key = self.parsed_keys.get(pem, None)
+        if key is None: key = self.parsed_keys[pem] = serialization.load_pem_public_key(pem.encode())
+        return key
+
+    def get_key_by_kid(self, keyId : int) -> rsa.RSAPublicKey:
+        pems = self.client.call("public_key", kid=str(keyId))["pems"]
+        return self.load_pem(pems[0]) if pems else None
+
+    def get_key_by_uid(self, userId : str) -> list:
+        return [key for kid, key in self.get_kid_key_pairs_by_uid(userId)]
+
+    def get_kid_key_pairs_by_uid(self, userId : str) -> list:
+        response = self.client.call("public_key", uid=userId)
+        return [(int(kid), self.load_pem(pem)) for kid, pem in zip(response["kids"], response["pems"])]
+
+    def get_uid_by_kid(self, keyId : int) -> str:
+        return self.client.call("uid_by_kid", kid=str(keyId))["uid"]
+
+
+class AgentPrivateKeyStore(ksi.PrivateKeyStore):
+
+    def __init__(self, client : KeyAgentClient):
+        self.client = client
+
+    def proxies(self, response, key_passwd):
+        return [AgentPrivateKey(self.client, int(key["kid"]), key_passwd, serialization.load_pem_public_key(key["pem"].encode()))
+            for key in response["keys"]]
+
+    def get_key_by_kid(self, keyId : int, key_passwd : str):
+        keys = self.proxies(self.client.call("unlock", kid=str(keyId), passwd=key_passwd), key_passwd)
+        return keys[0] if keys else None
+
+    def get_key_by_uid(self, userId : str, key_passwd : str) -> list:
+        return self.proxies(self.client.call("unlock", uid=userId, passwd=key_passwd), key_passwd)
+
+
+# (private key store, public key store) backed by the agent, for PGPFacade and
+# make_batch_process_pool (use functools.partial to pick the socket)
+def load_agent_key_stores(socket_path=DEFAULT_SOCKET):
+    client = KeyAgentClient(socket_path)
+    return AgentPrivateKeyStore(client), AgentPublicKeyStore(client)
+
+
+if __name__ == "__main__":
+    from key_manager import KeyManager
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET
+    db_filename = sys.argv[2] if len(sys.argv) > 2 else None
+    unlock_cache_size = int(os.environ.get("PGP_AGENT_UNLOCK_CACHE", 64))
+    unlock_ttl = int(os.environ.get("PGP_AGENT_UNLOCK_TTL", 300))
+    server = KeyAgentServer(socket_path, KeyManager(unlock_cache_size=unlock_cache_size, unlock_ttl=unlock_ttl, db_filename=db_filename))
+    print(" [*]\tKey agent listening on " + socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,13 +1,36 @@
+import time
+import json
 import hashlib
+import threading
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from key_store import PrivateKeyStore, PublicKeyStore
+from sqlite_key_store import SQLitePrivateKeyStore, SQLitePublicKeyStore
+
+# (private key store, public key store) of a new KeyManager, used to give
+# batch worker processes their own stores (see PGPFacade.make_batch_process_pool)
+def load_key_stores(db_filename=None):
+    key_manager = KeyManager(db_filename=db_filename)
+    return key_manager.get_private_key_store(), key_manager.get_public_key_store()
 
 class KeyManager:
-    def __init__(self):
-        self.public_key_store = PublicKeyStore()
-        self.private_key_store = PrivateKeyStore()
+    # db_filename selects the SQLite backend, otherwise the JSON rings are used
+    def __init__(self, unlock_cache_size=0, unlock_ttl=300, db_filename=None):
+        started = time.perf_counter()
+        if db_filename is not None:
+            self.public_key_store = SQLitePublicKeyStore(db_filename)
+        else:
+            self.public_key_store = PublicKeyStore()
+        self.public_load_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        if db_filename is not None:
+            self.private_key_store = SQLitePrivateKeyStore(db_filename, unlock_cache_size=unlock_cache_size, unlock_ttl=unlock_ttl)
+        else:
+            self.private_key_store = PrivateKeyStore(unlock_cache_size=unlock_cache_size, unlock_ttl=unlock_ttl)
+        self.private_load_seconds = time.perf_counter() - started
+        self.key_rings = {} # "private" / "public" -> (store change counts, listing, etag)
+        self.key_rings_lock = threading.Lock()
     
     def get_public_key_store(self):
         return self.public_key_store
@@ -15,59 +38,83 @@ class KeyManager:
     def get_private_key_store(self):
         return self.private_key_store
 
+    # {"public": stats, "private": stats} of the key stores, with their load times
+    def stats(self):
+        return {
+            "public": dict(self.public_key_store.stats(), load_seconds=self.public_load_seconds),
+            "private": dict(self.private_key_store.stats(), load_seconds=self.private_load_seconds),
+        }
+
     def generate_key_pair(self, name, email, password, key_size):
         private_key = rsa.generate_private_key(
             public_exponent=65537,
             key_size=key_size,
             backend=default_backend()
         )
-        public_key = private_key.public_key()
+        self.add_key_pair(private_key, name, email, password)
+        print(f"Generated {key_size}-bit key pair for {name} ({email}).")
 
+    # stores an already generated key pair (see key_pool), returns its key id
+    def add_key_pair(self, private_key, name, email, password):
+        public_key = private_key.public_key()
         self.public_key_store.add_key(public_key, email, name)
         self.private_key_store.add_key(public_key, private_key, email, password, name)
-
-        print(f"Generated {key_size}-bit key pair for {name} ({email}).")
+        return public_key.public_numbers().n % (2 ** 64)
+
+    def cached_key_ring(self, ring):
+        """ (listing, etag, JSON body of the listing) of the "private" or "public" key ring. Listings
+        are built again only after a key store changed, the etag is a digest of the body so it
+        survives restarts. The listing is shared by every caller until then, it must not be modified """
+        changes = (self.public_key_store.change_count(), self.private_key_store.change_count())
+        with self.key_rings_lock:
+            cached = self.key_rings.get(ring, None)
+            if cached is not None and cached[0] == changes: return cached[1:]
+        listing = self.build_private_key_ring() if ring == "private" else self.build_public_key_ring()
+        body = json.dumps(listing, sort_keys=True).encode()
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        with self.key_rings_lock:
+            self.key_rings[ring] = (changes, listing, etag, body)
+        return listing, etag, body
 
     def list_private_key_ring(self):
+        return self.cached_key_ring("private")[0]
+
+    def list_public_key_ring(self):
+        return self.cached_key_ring("public")[0]
+
+    def build_private_key_ring(self):
         key_ring = []
 
         # Collect public and private keys
-        for key_id, key_info in self.private_key_store.keys_by_kid.items():
-            encrypted_private_key, key_passwd_hash, email, timestamp, name = key_info
-            public_key = self.public_key_store.get_key_by_kid(key_id)
+        for key_id, encrypted_private_key, key_passwd_hash, email, timestamp, name in self.private_key_store.list_keys():
+            public_key_pem = self.public_key_store.get_pem_by_kid(key_id)
 
-            if public_key:
+            if public_key_pem:
                 key_ring.append({
                     "timestamp": timestamp.isoformat(),
                     "name": name,
                     "key_id":   str( key_id),
-                    "public_key": public_key.public_bytes(
-                        encoding=serialization.Encoding.PEM,
-                        format=serialization.PublicFormat.SubjectPublicKeyInfo
-                    ).decode(),
+                    "public_key": public_key_pem,
                     "private_key": encrypted_private_key.decode('utf-8'),
+                    "fingerprint": self.public_key_store.get_fingerprint_by_kid(key_id),
                     "user_id": email
                 })
 
         return {"private_key_ring": key_ring}
 
-    def list_public_key_ring(self):
+    def build_public_key_ring(self):
         public_keys = []
-        for key_id, key_data in self.public_key_store.public_key_ring.items():
-            public_key, user_id, timestamp, name = key_data
+        for key_id, public_key_pem, user_id, timestamp, name, fingerprint in self.public_key_store.list_public_key_ring():
             public_keys.append({
                 "user_id": user_id,
-                "public_key": public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PublicFormat.SubjectPublicKeyInfo
-                ).decode(),
+                "public_key": public_key_pem,
                 "timestamp": timestamp.isoformat(),
                 "key_id": str(key_id),
+                "fingerprint": fingerprint,
                 "name": name
             })
         return {"public_key_ring": public_keys}
 
-        
 
     def remove_key(self, key_id):
         self.public_key_store.remove_key(key_id)
@@ -82,13 +129,10 @@ class KeyManager:
             print("Access denied. Incorrect password or key not found.")
 
     def get_public_key_by_id(self, key_id):
-        public_key = self.public_key_store.get_key_by_kid(key_id)
-        if public_key:
+        public_key_pem = self.public_key_store.get_pem_by_kid(key_id)
+        if public_key_pem:
             return {
-                "public_key": public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PublicFormat.SubjectPublicKeyInfo
-                ).decode(),
+                "public_key": public_key_pem,
                 "key_id": str(key_id)
             }
         else:
@@ -0,0 +1,182 @@
+""" Background RSA key generation for /generate_key_pair.
+
+    KeyPool keeps a few fresh key pairs of each configured size ready, generated
+    by worker processes and topped up as they are taken. When a pool is empty
+    the caller gets a KeyJob instead, finished by the next key that comes out
+    of the workers, and polls it through /key_jobs/<job_id>. """
+
+import time
+import secrets
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+JOB_PENDING, JOB_DONE, JOB_FAILED = "pending", "done", "failed"
+# key sizes /generate_key_pair accepts
+KEY_SIZES = (1024, 2048, 4096)
+# seconds before a failed generation is retried, doubled with every failure in a row up to MAX_RETRY_DELAY
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+
+# runs in the worker processes, keys go back as PEM since key objects can't be pickled
+def generate_key_pem(key_size : int) -> bytes:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+def parse_pool_sizes(text : str) -> dict:
+    """ "2048:4,4096:2" -> {2048: 4, 4096: 2} """
+    pool_sizes = {}
+    for item in text.split(","):
+        if not item.strip(): continue
+        key_size, count = item.split(":")
+        pool_sizes[int(key_size)] = int(count)
+    return pool_sizes
+
+
+class KeyJob:
+
+    def __init__(self, key_size, on_key):
+        self.job_id = secrets.token_urlsafe(12)
+        self.key_size = key_size
+        self.on_key = on_key # on_key(private_key) -> result, called once the key is there
+        self.status = JOB_PENDING
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+
+    def finish(self, private_key):
+        try:
+            self.result = self.on_key(private_key)
+            self.status = JOB_DONE
+        except Exception as e:
+            self.error = repr(e)
+            self.status = JOB_FAILED
+
+    def fail(self, error):
+        self.error = error
+        self.status = JOB_FAILED
+
+    def to_dict(self):
+        job = {"job_id": self.job_id, "key_size": self.key_size, "status": self.status}
+        if self.result is not None: job["result"] = self.result
+        if self.error is not None: job["error"] = self.error
+        return job
+
+
+class KeyPool:
+
+    def __init__(self, pool_sizes=None, max_workers=None, executor=None, max_jobs=1024, retry_delay=RETRY_DELAY):
+        self.pool_sizes = pool_sizes if pool_sizes is not None else {2048: 4, 4096: 2}
+        self.executor = executor if executor is not None else ProcessPoolExecutor(max_workers=max_workers)
+        self.max_jobs = max_jobs
+        self.retry_delay = retry_delay
+        self.keys = {} # key_size -> deque of ready private keys
+        self.in_flight = {} # key_size -> number of keys being generated
+        self.waiting = {} # key_size -> deque of KeyJob waiting for a key
+        self.jobs = OrderedDict() # job_id -> KeyJob, oldest first
+        self.failures = {} # key_size -> failed generations in a row
+        self.backing_off = set() # key sizes waiting for a retry, refill leaves them alone
+        self.closed = False
+        # reentrant, a future that is already done runs its callback inside refill
+        self.lock = threading.RLock()
+        self.generated = 0
+        self.taken = 0
+
+    # call with self.lock held
+    def refill(self, key_size):
+        if self.closed or key_size in self.backing_off: return
+        wanted = self.pool_sizes.get(key_size, 0) + len(self.waiting.get(key_size, ()))
+        have = len(self.keys.get(key_size, ())) + self.in_flight.get(key_size, 0)
+        for i in range(wanted - have):
+            self.in_flight[key_size] = self.in_flight.get(key_size, 0) + 1
+            future = self.executor.submit(generate_key_pem, key_size)
+            future.add_done_callback(lambda future, key_size=key_size: self.key_generated(key_size, future))
+
+    def start(self):
+        """ starts filling every pool """
+        with self.lock:
+            for key_size in self.pool_sizes: self.refill(key_size)
+        return self
+
+    def key_generated(self, key_size, future):
+        job = None; private_key = None; error = None
+        try:
+            private_key = serialization.load_pem_private_key(future.result(), password=None)
+        except Exception as e:
+            error = repr(e)
+        with self.lock:
+            self.in_flight[key_size] -= 1
+            waiting = self.waiting.get(key_size, None)
+            if waiting: job = waiting.popleft()
+            elif private_key is not None:
+                self.keys.setdefault(key_size, deque()).append(private_key)
+            if private_key is not None: self.generated += 1
+            if error is None:
+                self.failures[key_size] = 0
+                self.refill(key_size)
+            else: self.back_off(key_size)
+        # outside the lock, on_key may take a while (key encryption, store writes)
+        if job is not None:
+            if error is None: job.finish(private_key)
+            else: job.fail(error)
+
+    # call with self.lock held - the failed key is replaced after a delay growing with
+    # the failures in a row, so a broken worker pool isn't hammered
+    def back_off(self, key_size):
+        failures = self.failures[key_size] = self.failures.get(key_size, 0) + 1
+        if key_size in self.backing_off: return
+        self.backing_off.add(key_size)
+        timer = threading.Timer(min(self.retry_delay * 2 ** (failures - 1), MAX_RETRY_DELAY), self.retry, (key_size,))
+        timer.daemon = True
+        timer.start()
+
+    def retry(self, key_size):
+        with self.lock:
+            self.backing_off.discard(key_size)
+            self.refill(key_size)
+
+    def take(self, key_size : int):
+        """ a ready private key, or None if the pool for key_size is empty """
+        with self.lock:
+            keys = self.keys.get(key_size, None)
+            private_key = keys.popleft() if keys else None
+            if private_key is not None: self.taken += 1
+            self.refill(key_size)
+            return private_key
+
+    def submit(self, key_size : int, on_key) -> KeyJob:
+        """ Calls on_key(private_key) with a pooled key right away if there is one,
+        otherwise once a key is generated. Returns the job either way """
+        job = KeyJob(key_size, on_key)
+        with self.lock:
+            private_key = self.take(key_size)
+            if private_key is None:
+                self.waiting.setdefault(key_size, deque()).append(job)
+                self.refill(key_size)
+            self.jobs[job.job_id] = job
+            # forget the oldest finished jobs
+            while len(self.jobs) > self.max_jobs:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status == JOB_PENDING: break
+                del self.jobs[oldest.job_id]
+        if private_key is not None: job.finish(private_key)
+        return job
+
+    def get_job(self, job_id : str) -> KeyJob:
+        with self.lock:
+            return self.jobs.get(job_id, None)
+
+    def stats(self):
+        with self.lock:
+            stats = {"generated": self.generated, "taken": self.taken, "jobs": len(self.jobs)}
+            for key_size in sorted(set(self.pool_sizes) | set(self.keys) | set(self.waiting)):
+                stats["ready_%d" % key_size] = len(self.keys.get(key_size, ()))
+                stats["waiting_%d" % key_size] = len(self.waiting.get(key_size, ()))
+            return stats
+
+    def shutdown(self):
+        with self.lock: self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,16 +1,107 @@
 import json
+import base64
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from datetime import datetime
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 from key_store_interface import PublicKeyStore as BasePublicKeyStore
 from key_store_interface import PrivateKeyStore as BasePrivateKeyStore
 
-class PublicKeyStore(BasePublicKeyStore):
+def pem_fingerprint(pem: str) -> str:
+    """ SHA-256 of the DER encoded key as hex, taken from the PEM text without parsing the key """
+    der = base64.b64decode("".join(line for line in pem.splitlines() if not line.startswith("-----")))
+    return hashlib.sha256(der).hexdigest()
+
+
+class LazyPublicKey:
+    """ Public key kept as PEM text, parsed on first use and memoized.
+    Rings are loaded without parsing keys nobody asks for. The PEM and
+    the fingerprint are also made once per entry, for the ring listings """
+
+    __slots__ = ("_pem", "_key", "_fingerprint")
+
+    def __init__(self, pem: str = None, key: rsa.RSAPublicKey = None):
+        self._pem = pem
+        self._key = key
+        self._fingerprint = None
+
+    @property
+    def key(self) -> rsa.RSAPublicKey:
+        if self._key is None: self._key = PublicKeyStore.deserialize_public_key(self._pem)
+        return self._key
+
+    @property
+    def pem(self) -> str:
+        if self._pem is None: self._pem = PublicKeyStore.serialize_public_key(self._key)
+        return self._pem
+
+    @property
+    def fingerprint(self) -> str:
+        if self._fingerprint is None: self._fingerprint = pem_fingerprint(self.pem)
+        return self._fingerprint
+
+    def is_parsed(self):
+        return self._key is not None
+
+
+class KeyIndex(dict):
+    """ Secondary index, user id or name -> key ids (kept in insertion order).
+    The keys_by_kid entries hold user id and name, so they serve as the
+    reverse kid -> uid index when a key is removed """
+
+    def add(self, value, key_id):
+        self.setdefault(value, {})[key_id] = None
+
+    def discard(self, value, key_id):
+        key_ids = self.get(value, None)
+        if key_ids is None: return
+        key_ids.pop(key_id, None)
+        if not key_ids: del self[value]
+
+    def key_ids(self, value) -> list:
+        return list(self.get(value, ()))
+
+
+class IndexedKeyStore:
+    """ Keeps keys_by_uid and keys_by_name in sync with keys_by_kid.
+    Subclasses set UID and NAME to the positions of those fields in their entries """
+
+    def build_indexes(self):
+        self.keys_by_uid = KeyIndex()
+        self.keys_by_name = KeyIndex()
+        for key_id in self.keys_by_kid: self.index_key(key_id)
+
+    def index_key(self, key_id):
+        key_entry = self.keys_by_kid[key_id]
+        self.keys_by_uid.add(key_entry[self.UID], key_id)
+        self.keys_by_name.add(key_entry[self.NAME], key_id)
+
+    def unindex_key(self, key_id):
+        key_entry = self.keys_by_kid.get(key_id, None)
+        if key_entry is None: return
+        self.keys_by_uid.discard(key_entry[self.UID], key_id)
+        self.keys_by_name.discard(key_entry[self.NAME], key_id)
+
+    def get_uid_by_kid(self, keyId: int) -> str:
+        key_entry = self.keys_by_kid.get(keyId, None)
+        return key_entry[self.UID] if key_entry else None
+
+    # self.changes goes up whenever keys are loaded, added or removed, KeyManager rebuilds its listings then
+    def change_count(self):
+        return self.changes
+
+
+class PublicKeyStore(IndexedKeyStore, BasePublicKeyStore):
+    # entries hold LazyPublicKey objects, get_key_* return parsed keys
+    UID, NAME = 1, 3 # positions in keys_by_kid entries
     def __init__(self, filename='private_key_ring.json', public_ring_filename='public_key_ring.json'):
         self.filename = filename
         self.public_ring_filename = public_ring_filename
+        self.changes = 0
         self.load_keys()
         self.load_public_key_ring()
 
@@ -19,24 +110,21 @@ class PublicKeyStore(BasePublicKeyStore):
             with open(self.filename, 'r') as file:
                 data = json.load(file)
                 public_keys_data = data.get('public_key_store', {})
-                self.keys_by_kid = {int(k): (self.deserialize_public_key(v[0]), v[1], datetime.fromisoformat(v[2]), v[3]) for k, v in public_keys_data.items()}
-                self.keys_by_uid = {}
-                for k, (public_key, user_id, timestamp, name) in self.keys_by_kid.items():
-                    if user_id not in self.keys_by_uid:
-                        self.keys_by_uid[user_id] = []
-                    self.keys_by_uid[user_id].append((public_key, timestamp, name))
+                self.keys_by_kid = {int(k): (LazyPublicKey(v[0]), v[1], datetime.fromisoformat(v[2]), v[3]) for k, v in public_keys_data.items()}
         except FileNotFoundError:
             self.keys_by_kid = {}
-            self.keys_by_uid = {}
+        self.build_indexes()
+        self.changes += 1
 
     def load_public_key_ring(self):
         try:
             with open(self.public_ring_filename, 'r') as file:
                 data = json.load(file)
                 public_keys_data = data.get('public_key_store', {})
-                self.public_key_ring = {int(k): (self.deserialize_public_key(v[0]), v[1], datetime.fromisoformat(v[2]), v[3]) for k, v in public_keys_data.items()}
+                self.public_key_ring = {int(k): (LazyPublicKey(v[0]), v[1], datetime.fromisoformat(v[2]), v[3]) for k, v in public_keys_data.items()}
         except FileNotFoundError:
             self.public_key_ring = {}
+        self.changes += 1
 
     def save_keys(self):
         try:
@@ -45,14 +133,14 @@ class PublicKeyStore(BasePublicKeyStore):
         except FileNotFoundError:
             data = {}
 
-        public_keys_data = {str(k): [self.serialize_public_key(v[0]), v[1], v[2].isoformat(), v[3]] for k, v in self.keys_by_kid.items()}
+        public_keys_data = {str(k): [v[0].pem, v[1], v[2].isoformat(), v[3]] for k, v in self.keys_by_kid.items()}
         data['public_key_store'] = public_keys_data
 
         with open(self.filename, 'w') as file:
             json.dump(data, file, indent=4)
 
     def save_public_key_ring(self):
-        public_keys_data = {str(k): [self.serialize_public_key(v[0]), v[1], v[2].isoformat(), v[3]] for k, v in self.public_key_ring.items()}
+        public_keys_data = {str(k): [v[0].pem, v[1], v[2].isoformat(), v[3]] for k, v in self.public_key_ring.items()}
         data = {'public_key_store': public_keys_data}
 
         with open(self.public_ring_filename, 'w') as file:
@@ -61,53 +149,72 @@ class PublicKeyStore(BasePublicKeyStore):
     def add_key(self, public_key: rsa.RSAPublicKey, user_id: str, name: str):
         key_id = public_key.public_numbers().n % (2 ** 64)
         timestamp = datetime.now()
-        self.keys_by_kid[key_id] = (public_key, user_id, timestamp, name)
-        if user_id not in self.keys_by_uid:
-            self.keys_by_uid[user_id] = []
-        self.keys_by_uid[user_id].append((public_key, timestamp, name))
+        self.unindex_key(key_id)
+        self.keys_by_kid[key_id] = (LazyPublicKey(key=public_key), user_id, timestamp, name)
+        self.index_key(key_id)
+        self.changes += 1
         self.save_keys()
 
     def add_public_key(self, public_key: rsa.RSAPublicKey, user_id: str, name: str):
         key_id = public_key.public_numbers().n % (2 ** 64)
         timestamp = datetime.now()
-        self.public_key_ring[key_id] = (public_key, user_id, timestamp, name)
+        self.public_key_ring[key_id] = (LazyPublicKey(key=public_key), user_id, timestamp, name)
+        self.changes += 1
         self.save_public_key_ring()
 
     def remove_key(self, key_id):
         if key_id in self.keys_by_kid:
-            public_key, user_id, _, name = self.keys_by_kid.pop(key_id)
-            to_remove = []
-            for uid, keys in self.keys_by_uid.items():
-                for key in keys:
-                    if key[0] == public_key:
-                        to_remove.append((uid, key))
-                        break
-            for uid, key in to_remove:
-                self.keys_by_uid[uid].remove(key)
-                if not self.keys_by_uid[uid]:
-                    del self.keys_by_uid[uid]
+            self.unindex_key(key_id)
+            del self.keys_by_kid[key_id]
+            self.changes += 1
             self.save_keys()
 
     def get_key_by_kid(self, keyId: int) -> rsa.RSAPublicKey:
         key_entry = self.keys_by_kid.get(keyId, None)
-        return key_entry[0] if key_entry else None
+        return key_entry[0].key if key_entry else None
+
+    # PEM text of the key, doesn't need to parse it
+    def get_pem_by_kid(self, keyId: int) -> str:
+        key_entry = self.keys_by_kid.get(keyId, None)
+        return key_entry[0].pem if key_entry else None
+
+    def get_fingerprint_by_kid(self, keyId: int) -> str:
+        key_entry = self.keys_by_kid.get(keyId, None)
+        return key_entry[0].fingerprint if key_entry else None
 
     def get_key_by_uid(self, userId: str) -> list:
-        return [key[0] for key in self.keys_by_uid.get(userId, [])]
+        return [key for key_id, key in self.get_kid_key_pairs_by_uid(userId)]
+
+    def get_kid_key_pairs_by_uid(self, userId: str) -> list:
+        return [(key_id, self.keys_by_kid[key_id][0].key) for key_id in self.keys_by_uid.key_ids(userId)]
 
-    def get_key_by_name(self, name: str) -> int:
-        key = self.keys_by_name.get(name, None)
-        return key.public_numbers().n if key else None
+    # (key_id, pem, user_id, timestamp, name, fingerprint) for every imported public key
+    def list_public_key_ring(self) -> list:
+        return [(k, v[0].pem) + v[1:] + (v[0].fingerprint,) for k, v in self.public_key_ring.items()]
+
+    # key counts for /metrics
+    def stats(self) -> dict:
+        return {"keys": self.key_count(), "public_ring_keys": self.public_ring_key_count(), "parsed_keys": self.parsed_key_count()}
+
+    def key_count(self):
+        return len(self.keys_by_kid)
+
+    def public_ring_key_count(self):
+        return len(self.public_key_ring)
+
+    def parsed_key_count(self):
+        return sum(1 for v in self.keys_by_kid.values() if v[0].is_parsed()) + sum(1 for v in self.public_key_ring.values() if v[0].is_parsed())
+
+    # first key added under this name
+    def get_key_by_name(self, name: str) -> rsa.RSAPublicKey:
+        key_ids = self.keys_by_name.key_ids(name)
+        return self.keys_by_kid[key_ids[0]][0].key if key_ids else None
 
     def export_key(self, key_id, filepath):
         print(key_id)
-        key_entry = self.keys_by_kid.get(key_id, None)
-        if key_entry:
-            key = key_entry[0]
-            pem = key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
+        pem = self.get_pem_by_kid(key_id)
+        if pem:
+            pem = pem.encode('utf-8')
             print(filepath)
             with open(filepath, 'wb+') as pem_out:
                 pem_out.write(pem)
@@ -144,9 +251,69 @@ class PublicKeyStore(BasePublicKeyStore):
         )
 
 
-class PrivateKeyStore(BasePrivateKeyStore):
-    def __init__(self, filename='private_key_ring.json'):
+class UnlockedKeyCache:
+    """ Bounded LRU cache of decrypted private keys, entries expire after ttl
+    seconds without use. Keyed by key id and a digest of the password, so the
+    password itself is never kept """
+
+    def __init__(self, max_size=32, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(key_id, key_passwd):
+        return (key_id, hashlib.sha256(key_passwd.encode()).digest())
+
+    def get(self, key_id, key_passwd):
+        cache_key = self.cache_key(key_id, key_passwd)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(cache_key, None)
+            if entry is None or now - entry[1] > self.ttl:
+                if entry is not None: del self.entries[cache_key]
+                self.misses += 1
+                return None
+            self.entries[cache_key] = (entry[0], now)
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key_id, key_passwd, private_key):
+        cache_key = self.cache_key(key_id, key_passwd)
+        with self.lock:
+            self.entries[cache_key] = (private_key, time.monotonic())
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def lock_key(self, key_id):
+        with self.lock:
+            for cache_key in [k for k in self.entries if k[0] == key_id]:
+                del self.entries[cache_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class PrivateKeyStore(IndexedKeyStore, BasePrivateKeyStore):
+    UID, NAME = 2, 4 # positions in keys_by_kid entries
+    unlocks = 0 # keys decrypted (cache misses), and the time it took
+    unlock_seconds = 0.0
+    # unlock_cache_size > 0 keeps that many unlocked keys in memory (see UnlockedKeyCache)
+    def __init__(self, filename='private_key_ring.json', unlock_cache_size=0, unlock_ttl=300):
         self.filename = filename
+        self.unlock_cache = UnlockedKeyCache(unlock_cache_size, unlock_ttl) if unlock_cache_size > 0 else None
+        self.changes = 0
         self.load_keys()
 
     def load_keys(self):
@@ -155,14 +322,10 @@ class PrivateKeyStore(BasePrivateKeyStore):
                 data = json.load(file)
                 private_keys_data = data.get('private_key_store', {})
                 self.keys_by_kid = {int(k): (v[0].encode('utf-8'), v[1], v[2], datetime.fromisoformat(v[3]), v[4]) for k, v in private_keys_data.items()}
-                self.keys_by_uid = {}
-                for k, (encrypted_private_key, key_passwd_hash, user_id, timestamp, name) in self.keys_by_kid.items():
-                    if user_id not in self.keys_by_uid:
-                        self.keys_by_uid[user_id] = []
-                    self.keys_by_uid[user_id].append((encrypted_private_key, key_passwd_hash, timestamp, name))
         except FileNotFoundError:
             self.keys_by_kid = {}
-            self.keys_by_uid = {}
+        self.build_indexes()
+        self.changes += 1
 
     def save_keys(self):
         try:
@@ -180,7 +343,27 @@ class PrivateKeyStore(BasePrivateKeyStore):
     def add_key(self, public_key: rsa.RSAPublicKey, private_key: rsa.RSAPrivateKey, user_id: str, key_passwd: str, name: str):
         key_id = public_key.public_numbers().n % (2 ** 64)
         timestamp = datetime.now()
+        encrypted_private_key, key_passwd_hash = self.protect_key(private_key, key_passwd)
 
+        self.unindex_key(key_id)
+        self.lock(key_id)
+        self.keys_by_kid[key_id] = (encrypted_private_key, key_passwd_hash, user_id, timestamp, name)
+        self.index_key(key_id)
+        self.changes += 1
+        self.save_keys()
+
+    def remove_key(self, key_id):
+        if key_id in self.keys_by_kid:
+            self.unindex_key(key_id)
+            del self.keys_by_kid[key_id]
+            self.lock(key_id)
+            self.changes += 1
+            self.save_keys()
+
+
+    # encrypted PKCS8 PEM of the key and the hash used to check its password
+    @staticmethod
+    def protect_key(private_key: rsa.RSAPrivateKey, key_passwd: str):
         # Hash the password using SHA-1
         key_passwd_hash = hashlib.sha1(key_passwd.encode()).hexdigest()
 
@@ -189,46 +372,60 @@ class PrivateKeyStore(BasePrivateKeyStore):
             format=serialization.PrivateFormat.PKCS8,
             encryption_algorithm=serialization.BestAvailableEncryption(key_passwd.encode())
         )
-
-        self.keys_by_kid[key_id] = (encrypted_private_key, key_passwd_hash, user_id, timestamp, name)
-        if user_id not in self.keys_by_uid:
-            self.keys_by_uid[user_id] = []
-        self.keys_by_uid[user_id].append((encrypted_private_key, key_passwd_hash, timestamp, name))
-        self.save_keys()
-
-    def remove_key(self, key_id):
-        if key_id in self.keys_by_kid:
-            private_key_tuple = self.keys_by_kid.pop(key_id)
-            to_remove = []
-            for user_id, keys in self.keys_by_uid.items():
-                for key in keys:
-                    if key[0] == private_key_tuple[0]:
-                        to_remove.append((user_id, key))
-                        break
-            for user_id, key in to_remove:
-                self.keys_by_uid[user_id].remove(key)
-                if not self.keys_by_uid[user_id]:
-                    del self.keys_by_uid[user_id]
-            self.save_keys()
-
+        return encrypted_private_key, key_passwd_hash
+
+    # (key_id, encrypted_private_key, key_passwd_hash, user_id, timestamp, name) for every key
+    def list_keys(self) -> list:
+        return [(k,) + v for k, v in self.keys_by_kid.items()]
+
+    def unlock(self, key_id, encrypted_private_key, key_passwd):
+        if self.unlock_cache is not None:
+            private_key = self.unlock_cache.get(key_id, key_passwd)
+            if private_key is not None: return private_key
+        started = time.perf_counter()
+        private_key = serialization.load_pem_private_key(encrypted_private_key, password=key_passwd.encode(), backend=default_backend())
+        self.unlocks += 1
+        self.unlock_seconds += time.perf_counter() - started
+        if self.unlock_cache is not None: self.unlock_cache.put(key_id, key_passwd, private_key)
+        return private_key
+
+    # drops the unlocked key from the cache, next use has to unlock it again
+    def lock(self, key_id):
+        if self.unlock_cache is not None: self.unlock_cache.lock_key(key_id)
+
+    def lock_all(self):
+        if self.unlock_cache is not None: self.unlock_cache.clear()
+
+    def unlock_cache_stats(self):
+        return self.unlock_cache.stats() if self.unlock_cache is not None else None
+
+    # key count, unlocks and unlock cache stats for /metrics
+    def stats(self) -> dict:
+        stats = {"keys": self.key_count(), "unlocks": self.unlocks, "unlock_seconds": self.unlock_seconds}
+        cache_stats = self.unlock_cache_stats()
+        if cache_stats is not None: stats.update({"unlock_cache_" + k: v for k, v in cache_stats.items()})
+        return stats
+
+    def key_count(self):
+        return len(self.keys_by_kid)
 
     def get_key_by_kid(self, keyId: int, key_passwd: str) -> rsa.RSAPrivateKey:
         key_entry = self.keys_by_kid.get(keyId, None)
         # Verify password using hashed password
         if key_entry and key_entry[1] == hashlib.sha1(key_passwd.encode()).hexdigest():
-            return serialization.load_pem_private_key(key_entry[0], password=key_passwd.encode(), backend=default_backend())
+            return self.unlock(keyId, key_entry[0], key_passwd)
         return None
     
     def get_key_by_uid(self, userId: str, key_passwd: str) -> list:
-        keys = self.keys_by_uid.get(userId, [])
+        key_passwd_hash = hashlib.sha1(key_passwd.encode()).hexdigest()
+        keys = [(key_id, self.keys_by_kid[key_id]) for key_id in self.keys_by_uid.key_ids(userId)]
         # Verify password using hashed password
-        return [serialization.load_pem_private_key(key[0], password=key_passwd.encode(), backend=default_backend()) for key in keys if key[1] == hashlib.sha1(key_passwd.encode()).hexdigest()]
+        return [self.unlock(key_id, key[0], key_passwd) for key_id, key in keys if key[1] == key_passwd_hash]
 
+    # first key added under this name
     def get_key_by_name(self, name: str, key_passwd: str) -> rsa.RSAPrivateKey:
-        key = self.keys_by_name.get(name, None)
-        if key:
-            return serialization.load_pem_private_key(key, password=key_passwd.encode(), backend=default_backend())
-        return None
+        key_ids = self.keys_by_name.key_ids(name)
+        return self.get_key_by_kid(key_ids[0], key_passwd) if key_ids else None
 
     def export_key(self, key_id, filepath, key_passwd):
         key_entry = self.keys_by_kid.get(key_id, None)
@@ -12,6 +12,11 @@ class PublicKeyStore():
     def get_key_by_uid(self, userId : str) -> int: return None # returns None if key not found
         # returns public key as int
 
+    # accepts userId (type str), like get_key_by_uid
+    # returns [(keyId, public key)] for the user's keys, ids as stored
+    # with the keys so callers don't have to compute them
+    def get_kid_key_pairs_by_uid(self, userId : str) -> list: return []
+
 
 class PrivateKeyStore():
 
@@ -1,11 +1,70 @@
-from flask import Flask, request, jsonify, render_template, Response, send_file
-from key_manager import KeyManager
-from PGPFacade import PGPFacade
+import io
+import os
+import mmap
+import json
+import base64
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, render_template, Response, send_file, g
+from key_manager import KeyManager, load_key_stores
+from PGPFacade import PGPFacade, NoPrivateKeyError, make_batch_process_pool
+from result_store import ResultStore
+from metrics import StageMetrics, format_gauges
+from key_pool import KeyPool, parse_pool_sizes, JOB_PENDING, KEY_SIZES
+from key_agent import load_agent_key_stores
+from PGPPacket import PacketFormatError
+from PGPCore import close_map
+from cryptography.exceptions import InvalidTag
 
 app = Flask(__name__)
 app.static_folder = 'static'
 key_manager = KeyManager()
 
+# /encr_batch_api workers - "thread" shares key_manager's stores, "process" workers load their own
+BATCH_POOL = os.environ.get("PGP_BATCH_POOL", "thread")
+BATCH_WORKERS = int(os.environ.get("PGP_BATCH_WORKERS", os.cpu_count() or 1))
+batch_executor = None
+# results of /encr_api, served by /download/<result_id>
+result_store = ResultStore()
+# per-stage encrypt/decrypt timings for /metrics, PGP_STAGE_METRICS=0 turns them off
+stage_metrics = StageMetrics()
+stage_hook = stage_metrics.record if os.environ.get("PGP_STAGE_METRICS", "1") != "0" else None
+# ready key pairs per key size for /generate_key_pair, e.g. PGP_KEY_POOL="2048:4,4096:2"
+KEY_POOL_SIZES = parse_pool_sizes(os.environ.get("PGP_KEY_POOL", "1024:2,2048:4,4096:2"))
+KEY_POOL_WORKERS = int(os.environ.get("PGP_KEY_POOL_WORKERS", 2))
+key_pool = None
+# socket of a key agent (python key_agent.py) - if set, encryption and decryption use the
+# agent's keys and unlock cache, shared by all workers. Key management still uses key_manager,
+# the agent picks up changes to the rings
+KEY_AGENT_SOCKET = os.environ.get("PGP_KEY_AGENT")
+agent_key_stores = load_agent_key_stores(KEY_AGENT_SOCKET) if KEY_AGENT_SOCKET else None
+
+def facade_key_stores():
+    if agent_key_stores is not None: return agent_key_stores
+    return key_manager.get_private_key_store(), key_manager.get_public_key_store()
+
+
+# uploads spooled to a temporary file are mapped instead of read onto the heap. Werkzeug
+# spools every upload to a SpooledTemporaryFile, one that hasn't rolled over to disk is
+# still in memory (fileno() would write it out) and small enough to copy
+def upload_data(upload):
+    stream = upload.stream
+    if not getattr(stream, "_rolled", True): stream = stream._file
+    if isinstance(stream, io.BytesIO): return stream.getvalue()
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return stream.read()
+    stream.flush()
+    if os.fstat(fileno).st_size == 0: return b""
+    data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    g.setdefault("upload_maps", []).append(data)
+    return data
+
+@app.teardown_request
+def close_upload_maps(error):
+    for data in g.pop("upload_maps", []): close_map(data)
+
 
 @app.route("/")
 def index():
@@ -19,16 +78,24 @@ def encrypt():
         private_key_id = int(request.form["private_key_id"])
         private_key_password = request.form["private_key_password"]
         public_key_id = int(request.form["public_key_id"])
+        # optional comma separated list of receivers, the message is encrypted once for all of them
+        public_key_ids = request.form.get("public_key_ids")
+        receiver_puk_id = [int(kid) for kid in public_key_ids.split(",")] if public_key_ids else public_key_id
         sign = request.form["sign"]
         compress = request.form["compress"]
         radix64 = request.form["radix64"]
         msg_data = None
         if request.form["text_or_file"] == "file":
-            msg_data = request.files.get("file").stream.read()
+            msg_data = upload_data(request.files.get("file"))
         else: msg_data = request.form["text"].encode()
         options = []
         if aes_enc_msg == "true": options += ["aes_encrypt"]
         if des3_enc_msg == "true": options += ["3des_encrypt"]
+        # AEAD ciphers, optional fields
+        if request.form.get("aes_gcm_enc_msg") == "true": options += ["aes_gcm_encrypt"]
+        if request.form.get("chacha20_enc_msg") == "true": options += ["chacha20_encrypt"]
+        # independently encrypted segments, parts can be decrypted through /download/<result_id>/decrypted
+        if request.form.get("segmented") == "true": options += ["segmented"]
         if private_key_id != "null": options += [private_key_id]
         options += [private_key_password]
         if public_key_id != "null": options += [public_key_id]
@@ -36,10 +103,10 @@ def encrypt():
         if compress == "true": options += ["compression"]
         if radix64 == "true": options += ["radix64"]
 
-        pgpf = PGPFacade(
-            key_manager.get_private_key_store(),
-            key_manager.get_public_key_store()
-        )
+        pgpf = PGPFacade(*facade_key_stores(), stage_hook)
+        # optional, "deflate" (default), "bz2" or "lzma" and a level
+        compress_level = request.form.get("compress_level")
+        pgpf.set_compression_params(request.form.get("compress_algo", "deflate"), int(compress_level) if compress_level else None)
 
         result = None
         if request.form["op_type"] == "encrypt_message":
@@ -47,13 +114,21 @@ def encrypt():
                 sender_prk_id=private_key_id,
                 sender_prk_passwd=private_key_password,
                 sender_puk_id=private_key_id,
-                receiver_puk_id=public_key_id
+                receiver_puk_id=receiver_puk_id
             )
-            result = pgpf.pgp_encrypt_message(data=msg_data, filename="user_request.pgp", options=options)
+            # a mapped upload is encrypted chunk by chunk, not packed into one payload on the heap
+            if isinstance(msg_data, mmap.mmap):
+                sink = io.BytesIO()
+                pgpf.pgp_encrypt_stream(msg_data, sink, "user_request.pgp", options)
+                result = sink.getvalue()
+            else: result = pgpf.pgp_encrypt_message(data=msg_data, filename="user_request.pgp", options=options, save_file=False)
         elif request.form["op_type"] == "decrypt_message":
-            result = pgpf.pgp_decrypt_message(data=msg_data, filename="user_request.pgp", passwd=private_key_password, options=options)
-        print(result)
-        return result
+            result = pgpf.pgp_decrypt_message(data=msg_data, filename="user_request.pgp", passwd=private_key_password, options=options, save_file=False)
+        result_id = result_store.put(result, "user_request.pgp")
+        response = Response(result)
+        # the same result can be downloaded from /download/<result_id>
+        response.headers["X-Result-Id"] = result_id
+        return response
 
     except FileExistsError as e:
         return jsonify({
@@ -70,30 +145,179 @@ def encrypt():
             "op_type": request.form["op_type"],
         })
 
-@app.route("/download")
-def download_file():
-    return send_file("user_request.pgp")
+def get_batch_executor():
+    global batch_executor
+    # created on first use, so importing the app doesn't start workers
+    if batch_executor is None:
+        if BATCH_POOL == "process":
+            loader = functools.partial(load_agent_key_stores, KEY_AGENT_SOCKET) if KEY_AGENT_SOCKET else load_key_stores
+            batch_executor = make_batch_process_pool(BATCH_WORKERS, loader)
+        else: batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+    return batch_executor
+
+def parse_batch_key_id(key_id):
+    # key ids are numbers (as JSON numbers or digit strings), anything else is a user id
+    if isinstance(key_id, str) and key_id.isdigit(): return int(key_id)
+    if isinstance(key_id, list): return [parse_batch_key_id(k) for k in key_id]
+    return key_id
+
+@app.route("/encr_batch_api", methods=["POST"])
+def encrypt_batch():
+    """ NDJSON in, NDJSON out. Each request line is an object with op ("encrypt_message" or
+    "decrypt_message"), data (base64), options, and for encryption sender_prk_id,
+    sender_prk_passwd, sender_puk_id, receiver_puk_id, optionally compression_algo and
+    compression_level, for decryption passwd.
+    Each response line has index and ok, plus data (base64) or error """
+    # a line that can't be parsed gets an error result in its place, the others still run
+    items = []; results = []
+    for line in request.get_data().splitlines():
+        if not line.strip(): continue
+        try:
+            item = json.loads(line)
+            item["data"] = base64.b64decode(item.get("data", ""), validate=True)
+            for field in ["sender_prk_id", "sender_puk_id", "receiver_puk_id"]:
+                if field in item: item[field] = parse_batch_key_id(item[field])
+            items.append(item); results.append(None)
+        except (ValueError, TypeError, AttributeError) as e:
+            results.append({"ok": False, "error": "bad request line: " + str(e)})
+
+    # items run in "process" pool workers are not timed
+    pgpf = PGPFacade(*facade_key_stores(), stage_hook)
+    item_results = iter(pgpf.pgp_process_batch(items, get_batch_executor()))
+    results = [next(item_results) if result is None else result for result in results]
+    lines = []
+    for index, result in enumerate(results):
+        result["index"] = index
+        if result["ok"]: result["data"] = base64.b64encode(result["data"]).decode()
+        lines.append(json.dumps(result))
+    return Response("\n".join(lines) + "\n", mimetype="application/x-ndjson")
+
+@app.route("/download/<result_id>")
+def download_file(result_id):
+    result = result_store.get(result_id)
+    if result is None:
+        return jsonify({"message": "Result not found or expired."}), 404
+    # conditional=True answers Range requests with 206 partial content
+    if result.in_memory():
+        return send_file(io.BytesIO(result.data), as_attachment=True, download_name=result.filename,
+            mimetype="application/octet-stream", conditional=True)
+    # sent by path, Range needs the size and werkzeug only knows it for paths. The file opens in
+    # send_file, if the result was evicted since get there is nothing to send
+    try:
+        return send_file(result.path, as_attachment=True, download_name=result.filename,
+            mimetype="application/octet-stream", conditional=True)
+    except FileNotFoundError:
+        return jsonify({"message": "Result not found or expired."}), 404
+
+@app.route("/download/<result_id>/decrypted", methods=["POST"])
+def download_decrypted_range(result_id):
+    """ Data of a segmented binary message kept from /encr_api, decrypted with the key
+    unlocked by private_key_password. With a Range header only the segments holding
+    that range are decrypted and the answer is 206 partial content """
+    passwd = request.form.get("private_key_password")
+    if passwd is None:
+        return jsonify({"message": "private_key_password is required."}), 400
+    # opened by the store, eviction can't remove the file between looking the result up and reading it
+    result, f = result_store.open(result_id)
+    if result is None:
+        return jsonify({"message": "Result not found or expired."}), 404
+    pgpf = PGPFacade(*facade_key_stores(), stage_hook)
+    with f:
+        try:
+            size = pgpf.pgp_segmented_data_size(f)
+        except PacketFormatError:
+            return jsonify({"message": "Not a segmented binary message."}), 400
+        byte_range = request.range.range_for_length(size) if request.range is not None else None
+        if request.range is not None and byte_range is None:
+            return Response(status=416, headers={"Content-Range": "bytes */%d" % size})
+        start, end = byte_range if byte_range is not None else (0, size)
+        try:
+            data = pgpf.pgp_decrypt_range(f, passwd, start, end)
+        except NoPrivateKeyError as e:
+            return jsonify({"message": str(e)}), 403
+        except (InvalidTag, PacketFormatError):
+            return jsonify({"message": "The message is corrupted."}), 400
+    response = Response(data, status=206 if byte_range is not None else 200, mimetype="application/octet-stream")
+    if byte_range is not None: response.headers["Content-Range"] = request.range.to_content_range_header(size)
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+@app.route("/inspect_api", methods=["POST"])
+def inspect():
+    """ Options, signer and recipients of a message (a file, or the text field with
+    text_or_file=text) from its header, nothing is decrypted and no password is needed """
+    if request.form.get("text_or_file", "file") == "file": msg_data = upload_data(request.files.get("file"))
+    else: msg_data = request.form["text"].encode()
+    try:
+        info = PGPFacade(*facade_key_stores()).inspect_message(msg_data)
+    except (PacketFormatError, ValueError) as e:
+        return jsonify({"message": "Not a message with a header: " + str(e)}), 400
+    # key ids don't fit a JavaScript number
+    if info["sender_key_id"] is not None: info["sender_key_id"] = str(info["sender_key_id"])
+    if info["recipient_key_ids"] is not None: info["recipient_key_ids"] = [str(kid) for kid in info["recipient_key_ids"]]
+    return jsonify(info), 200
+
+@app.route("/metrics")
+def metrics():
+    """ Prometheus text format - stage timings, key store and result store stats """
+    text = stage_metrics.render() \
+        + format_gauges("pgp_key_store", key_manager.stats(), "store") \
+        + format_gauges("pgp_result_store", {"encr_api": result_store.stats()}, "store") \
+        + (format_gauges("pgp_key_pool", {"generate_key_pair": key_pool.stats()}, "pool") if key_pool is not None else "")
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+def get_key_pool():
+    global key_pool
+    # like the batch pool, created on first use - __main__ starts it early to warm it up
+    if key_pool is None:
+        key_pool = KeyPool(KEY_POOL_SIZES, KEY_POOL_WORKERS).start()
+    return key_pool
 
 @app.route('/generate_key_pair', methods=['POST'])
 def generate_key_pair():
+    """ 201 if a pooled key pair was used, otherwise 202 with a job to poll at status_url """
     data = request.json
     name = data.get('name')
     email = data.get('email')
     password = data.get('password')
-    key_size = int(data.get('key_size', 2048))
-
-    key_manager.generate_key_pair(name, email, password, key_size)
-    return jsonify({"message": f"Generated {key_size}-bit key pair for {name} ({email})."}), 201
+    key_size = data.get('key_size', 2048)
+    if str(key_size) not in [str(size) for size in KEY_SIZES]:
+        return jsonify({"message": "key_size must be one of " + ", ".join(str(size) for size in KEY_SIZES)}), 400
+    key_size = int(key_size)
+
+    def store_key_pair(private_key):
+        key_id = key_manager.add_key_pair(private_key, name, email, password)
+        return {"message": f"Generated {key_size}-bit key pair for {name} ({email}).", "key_id": str(key_id)}
+
+    job = get_key_pool().submit(key_size, store_key_pair)
+    if job.status != JOB_PENDING:
+        return jsonify(job.result if job.result is not None else {"message": job.error}), 201 if job.result is not None else 500
+    return jsonify(dict(job.to_dict(), status_url=f"/key_jobs/{job.job_id}")), 202
+
+@app.route('/key_jobs/<job_id>', methods=['GET'])
+def key_job_status(job_id):
+    job = get_key_pool().get_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+    return jsonify(job.to_dict()), 200
+
+# the UI lists the rings after every action, unchanged ones are answered with 304 not modified.
+# The body is serialized once per change of the ring, by KeyManager
+def key_ring_response(ring):
+    keys, etag, body = key_manager.cached_key_ring(ring)
+    if request.if_none_match.contains_weak(etag): response = Response(status=304)
+    else: response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True # cached by the browser, but always revalidated
+    return response
 
 @app.route('/list_private_key_ring', methods=['GET'])
 def list_private_key_ring():
-    keys = key_manager.list_private_key_ring()
-    return jsonify(keys), 200
+    return key_ring_response("private")
 
 @app.route('/list_public_key_ring', methods=['GET'])
 def list_public_key_ring():
-    keys = key_manager.list_public_key_ring()
-    return jsonify(keys), 200
+    return key_ring_response("public")
 
 @app.route('/access_private_key', methods=['POST'])
 def access_private_key():
@@ -236,4 +460,5 @@ def export_key_pair(key_id):
 
 
 if __name__ == "__main__":
+    get_key_pool()
     app.run(debug=True, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,99 @@
+""" Aggregated PGPFacade stage timings and key store statistics in the
+    Prometheus text format, served by /metrics in main.py.
+
+    stage_metrics = StageMetrics()
+    PGPFacade(private_ks, public_ks, stage_hook=stage_metrics.record) """
+
+import bisect
+import threading
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # per bucket, last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+
+class StageStats:
+
+    def __init__(self, buckets):
+        self.duration = Histogram(buckets)
+        self.bytes = 0
+
+
+class StageMetrics:
+    """ Per (op, stage) duration histograms and byte counts, record() is the
+    PGPFacade stage hook """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.stages = {} # (op, stage) -> StageStats
+        self.lock = threading.Lock()
+
+    def record(self, op : str, stage : str, seconds : float, size : int):
+        with self.lock:
+            stats = self.stages.get((op, stage), None)
+            if stats is None: stats = self.stages[(op, stage)] = StageStats(self.buckets)
+            stats.duration.observe(seconds)
+            stats.bytes += size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {key: {"count": s.duration.count, "seconds": s.duration.sum, "bytes": s.bytes} for key, s in self.stages.items()}
+
+    def render(self) -> str:
+        with self.lock:
+            stages = sorted(self.stages.items())
+            histograms = []; byte_counts = []; throughputs = []
+            for (op, stage), stats in stages:
+                labels = {"op": op, "stage": stage}
+                for bound, count in stats.duration.cumulative_counts():
+                    histograms.append(("_bucket", dict(labels, le=str(bound)), count))
+                histograms.append(("_sum", labels, stats.duration.sum))
+                histograms.append(("_count", labels, stats.duration.count))
+                byte_counts.append(("", labels, stats.bytes))
+                if stats.bytes and stats.duration.sum > 0: throughputs.append(("", labels, stats.bytes / stats.duration.sum))
+        return format_metric("pgp_stage_duration_seconds", "histogram", "Time spent in each encrypt/decrypt stage", histograms) \
+            + format_metric("pgp_stage_bytes_total", "counter", "Bytes fed to each encrypt/decrypt stage", byte_counts) \
+            + format_metric("pgp_stage_throughput_bytes_per_second", "gauge", "Bytes per second of stage time since start", throughputs)
+
+
+def format_labels(labels : dict) -> str:
+    if not labels: return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join('%s="%s"' % (k, v) for k, v in zip(labels.keys(), escaped)) + "}"
+
+def format_metric(name : str, metric_type : str, help_text : str, samples : list) -> str:
+    """ samples - list of (name suffix, labels dict, value) """
+    lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, metric_type)]
+    lines += ["%s%s%s %s" % (name, suffix, format_labels(labels), repr(float(value)) if isinstance(value, float) else value)
+        for suffix, labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+def format_gauges(prefix : str, stats_by_label : dict, label : str) -> str:
+    """ stats_by_label - {label value: {key: number}}, gives one gauge per key,
+    named prefix_key, with a sample for every label value that has it """
+    names = []
+    for stats in stats_by_label.values():
+        names += [key for key, value in stats.items() if key not in names
+            and isinstance(value, (int, float)) and not isinstance(value, bool)]
+    return "".join(format_metric(prefix + "_" + key, "gauge", key.replace("_", " "),
+        [("", {label: label_value}, stats[key]) for label_value, stats in stats_by_label.items() if stats.get(key, None) is not None])
+        for key in names)
@@ -1,34 +1,70 @@
+import os
+import json
+import threading
 import key_store_interface as ksi
 from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
 
-# data for testing, shared between PUK and PRK key stores
+# data for testing, shared between PUK and PRK key stores,
+# filled from the fixture file when the first mock store is created
 key_data = dict()
 private_key_data = dict()
 public_key_data = dict()
+public_key_ids = dict() # name -> key id
 
 private_kids = ["prk1_2048", "prk2_2048", "prk1_1024", "prk2_1024"]
 public_kids = ["puk1_2048", "puk2_2048", "puk1_1024", "puk2_1024"]
 
+# pregenerated test keys, name -> unencrypted PEM. Keys missing from the file are
+# generated once and added to it, PGP_MOCK_KEYS points to another file
+FIXTURE_FILE = os.environ.get("PGP_MOCK_KEYS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_keys.json"))
+fixture_keys = dict() # name -> parsed private key
+fixture_lock = threading.RLock()
 
-# generate private keys
-for pr_kid in private_kids:
-    private_key_data[pr_kid] = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=int(pr_kid[-4::]),
-    )
-    private_key_data[private_key_data[pr_kid] \
-        .public_key().public_numbers().n % (2 ** 64)] = private_key_data[pr_kid]
-    #key_data[key_data[pr_kid].public_key().public_numbers().n % (2 ** 64)] = key_data[pr_kid]
 
-# generate public keys
-for pu_kid in public_kids:
-    public_key_data[pu_kid] = private_key_data[pu_kid.replace("u", "r")].public_key()
-    # print(pu_kid + " -- kid:: " + str(public_key_data[pu_kid].public_numbers().n % (2 ** 64)))
-    public_key_data[public_key_data[pu_kid].public_numbers().n % (2 ** 64)] = public_key_data[pu_kid]
+def read_fixture_file():
+    try:
+        with open(FIXTURE_FILE, "r") as f: return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_fixture_file(pems):
+    tmp_filename = FIXTURE_FILE + ".tmp"
+    with open(tmp_filename, "w") as f: json.dump(pems, f, indent=4, sort_keys=True)
+    os.replace(tmp_filename, FIXTURE_FILE)
+
+def fixture_key(name : str, key_size : int) -> rsa.RSAPrivateKey:
+    """ Private test key stored under name, the same one on every run """
+    with fixture_lock:
+        key = fixture_keys.get(name, None)
+        if key is not None and key.key_size == key_size: return key
+        pems = read_fixture_file()
+        if name in pems: key = serialization.load_pem_private_key(pems[name].encode(), password=None)
+        if key is None or key.key_size != key_size:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+            pems[name] = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()).decode()
+            write_fixture_file(pems)
+        fixture_keys[name] = key
+        return key
+
+def load_key_data():
+    with fixture_lock:
+        if private_key_data: return
+        for pr_kid in private_kids:
+            private_key_data[pr_kid] = fixture_key(pr_kid, int(pr_kid[-4::]))
+            private_key_data[private_key_data[pr_kid] \
+                .public_key().public_numbers().n % (2 ** 64)] = private_key_data[pr_kid]
+
+        for pu_kid in public_kids:
+            public_key_data[pu_kid] = private_key_data[pu_kid.replace("u", "r")].public_key()
+            public_key_ids[pu_kid] = public_key_data[pu_kid].public_numbers().n % (2 ** 64)
+            public_key_data[public_key_ids[pu_kid]] = public_key_data[pu_kid]
 
 class MockPUKStore(ksi.PublicKeyStore):
 
     def __init__(self):
+        load_key_data()
         self.my_key_store = public_key_data
         self.my_kids = public_kids
 
@@ -45,11 +81,18 @@ class MockPUKStore(ksi.PublicKeyStore):
         if userId in self.my_kids:
             return self.my_key_store[userId]
         return None
+
+    def get_kid_key_pairs_by_uid(self, userId : str) -> list:
+        if not isinstance(userId, str): raise Exception("userId not of type string")
+        if userId in self.my_kids:
+            return [(public_key_ids[userId], self.my_key_store[userId])]
+        return []
     
 
 class MockPRKStore(ksi.PrivateKeyStore):
 
     def __init__(self):
+        load_key_data()
         self.my_key_store = private_key_data
         self.my_kids = private_kids
 
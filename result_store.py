@@ -0,0 +1,93 @@
+""" Per-request results of /encr_api, kept under an opaque id until downloaded
+    from /download/<id> or evicted. Small results stay in memory, larger ones
+    are spooled to temporary files. The store is bounded by number of results,
+    total bytes in memory and age. """
+
+import io
+import os
+import time
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class StoredResult:
+
+    def __init__(self, data : bytes, filename : str, spool_dir, spool_threshold):
+        self.filename = filename
+        self.size = len(data)
+        self.created = time.monotonic()
+        self.data = None
+        self.path = None
+        if self.size > spool_threshold:
+            fd, self.path = tempfile.mkstemp(suffix=".pgp", dir=spool_dir)
+            with os.fdopen(fd, "wb") as f: f.write(data)
+        else: self.data = data
+
+    def in_memory(self):
+        return self.data is not None
+
+    def discard(self):
+        if self.path is not None and os.path.exists(self.path): os.remove(self.path)
+
+
+class ResultStore:
+
+    def __init__(self, max_results=256, max_memory_bytes=64 * 2 ** 20, ttl=3600, spool_threshold=2 ** 20, spool_dir=None):
+        self.max_results = max_results
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = ttl
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.results = OrderedDict() # oldest first
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, data : bytes, filename : str) -> str:
+        # a result that doesn't fit in memory at all is spooled whatever the threshold
+        result = StoredResult(data, filename, self.spool_dir, min(self.spool_threshold, self.max_memory_bytes))
+        result_id = secrets.token_urlsafe(16)
+        with self.lock:
+            self.results[result_id] = result
+            if result.in_memory(): self.memory_bytes += result.size
+            self.evict(keep=result_id)
+        return result_id
+
+    def get(self, result_id : str) -> StoredResult:
+        with self.lock:
+            self.evict()
+            return self.results.get(result_id, None)
+
+    def open(self, result_id : str):
+        """ (result, binary file with its data) or (None, None). The file is opened under the
+        lock, so it stays readable even if the result is evicted while it is read """
+        with self.lock:
+            self.evict()
+            result = self.results.get(result_id, None)
+            if result is None: return None, None
+            return result, io.BytesIO(result.data) if result.in_memory() else open(result.path, "rb")
+
+    def remove(self, result_id : str):
+        with self.lock:
+            result = self.results.pop(result_id, None)
+            if result is not None: self.drop(result)
+
+    def drop(self, result : StoredResult):
+        if result.in_memory(): self.memory_bytes -= result.size
+        result.discard()
+
+    # call with self.lock held, keep - id of a result just put, never evicted
+    def evict(self, keep=None):
+        now = time.monotonic()
+        while self.results:
+            result_id, oldest = next(iter(self.results.items()))
+            if result_id == keep: break
+            if len(self.results) <= self.max_results and self.memory_bytes <= self.max_memory_bytes \
+                and now - oldest.created <= self.ttl: break
+            del self.results[result_id]
+            self.drop(oldest)
+
+    def stats(self):
+        with self.lock:
+            return {"results": len(self.results), "memory_bytes": self.memory_bytes}
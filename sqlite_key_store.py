@@ -0,0 +1,248 @@
+""" SQLite backend for the key stores.
+
+    Same interface as the JSON stores in key_store, but every add/remove is a
+    single-row write and lookups by key id, user id and name go through
+    indexes, so neither depends on the number of keys in the rings.
+    Both stores can share one database file.
+
+    usage: python sqlite_key_store.py keys.db [private_key_ring.json] [public_key_ring.json]
+    imports the JSON rings into keys.db """
+
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+from cryptography.hazmat.primitives.asymmetric import rsa
+import key_store as ks
+
+# key ids use all 64 bits, more than SQLite's signed INTEGER holds, so they are stored as text
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS public_keys (
+    ring TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    pem TEXT NOT NULL,
+    user_id TEXT,
+    timestamp TEXT NOT NULL,
+    name TEXT,
+    PRIMARY KEY (ring, key_id)
+);
+CREATE INDEX IF NOT EXISTS public_keys_user_id ON public_keys (ring, user_id);
+CREATE INDEX IF NOT EXISTS public_keys_name ON public_keys (ring, name);
+CREATE TABLE IF NOT EXISTS private_keys (
+    key_id TEXT PRIMARY KEY,
+    encrypted_pem TEXT NOT NULL,
+    passwd_hash TEXT NOT NULL,
+    user_id TEXT,
+    timestamp TEXT NOT NULL,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS private_keys_user_id ON private_keys (user_id);
+CREATE INDEX IF NOT EXISTS private_keys_name ON private_keys (name);
+"""
+
+# public_keys.ring values
+OWN_RING = "own" # public halves of our key pairs (PublicKeyStore.keys_by_kid)
+PUBLIC_RING = "public" # imported public keys (PublicKeyStore.public_key_ring)
+
+
+def connect(db_filename):
+    conn = sqlite3.connect(db_filename, check_same_thread=False)
+    # WAL keeps readers going during writes and survives a crash mid-write
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class SQLitePublicKeyStore(ks.PublicKeyStore):
+
+    def __init__(self, db_filename='keys.db'):
+        self.db_filename = db_filename
+        self.conn = connect(db_filename)
+        self.db_lock = threading.Lock()
+        self.parsed_keys = {} # key_id -> LazyPublicKey, memoized parses
+        self.changes = 0
+
+    def query(self, sql, params=()):
+        with self.db_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        with self.db_lock, self.conn:
+            self.conn.execute(sql, params)
+        self.changes += 1
+
+    # data_version moves when other connections (processes, the other store) commit
+    def change_count(self):
+        return (self.changes, self.query("PRAGMA data_version")[0][0])
+
+    def lazy_key(self, key_id, pem):
+        lazy_key = self.parsed_keys.get(key_id, None)
+        if lazy_key is None:
+            lazy_key = self.parsed_keys[key_id] = ks.LazyPublicKey(pem)
+        return lazy_key
+
+    def insert(self, ring, public_key: rsa.RSAPublicKey, user_id: str, name: str):
+        key_id = public_key.public_numbers().n % (2 ** 64)
+        self.write("INSERT OR REPLACE INTO public_keys VALUES (?, ?, ?, ?, ?, ?)",
+            (ring, str(key_id), self.serialize_public_key(public_key), user_id, datetime.now().isoformat(), name))
+        self.parsed_keys.pop(key_id, None)
+
+    def add_key(self, public_key: rsa.RSAPublicKey, user_id: str, name: str):
+        self.insert(OWN_RING, public_key, user_id, name)
+
+    def add_public_key(self, public_key: rsa.RSAPublicKey, user_id: str, name: str):
+        self.insert(PUBLIC_RING, public_key, user_id, name)
+
+    def remove_key(self, key_id):
+        self.write("DELETE FROM public_keys WHERE ring = ? AND key_id = ?", (OWN_RING, str(key_id)))
+        self.parsed_keys.pop(key_id, None)
+
+    def get_key_by_kid(self, keyId: int) -> rsa.RSAPublicKey:
+        pem = self.get_pem_by_kid(keyId)
+        return self.lazy_key(keyId, pem).key if pem else None
+
+    def get_pem_by_kid(self, keyId: int) -> str:
+        rows = self.query("SELECT pem FROM public_keys WHERE ring = ? AND key_id = ?", (OWN_RING, str(keyId)))
+        return rows[0][0] if rows else None
+
+    def get_fingerprint_by_kid(self, keyId: int) -> str:
+        pem = self.get_pem_by_kid(keyId)
+        return self.lazy_key(keyId, pem).fingerprint if pem else None
+
+    def get_key_by_uid(self, userId: str) -> list:
+        return [key for key_id, key in self.get_kid_key_pairs_by_uid(userId)]
+
+    def get_kid_key_pairs_by_uid(self, userId: str) -> list:
+        rows = self.query("SELECT key_id, pem FROM public_keys WHERE ring = ? AND user_id = ?", (OWN_RING, userId))
+        return [(int(key_id), self.lazy_key(int(key_id), pem).key) for key_id, pem in rows]
+
+    def get_uid_by_kid(self, keyId: int) -> str:
+        rows = self.query("SELECT user_id FROM public_keys WHERE ring = ? AND key_id = ?", (OWN_RING, str(keyId)))
+        return rows[0][0] if rows else None
+
+    def get_key_by_name(self, name: str) -> rsa.RSAPublicKey:
+        rows = self.query("SELECT key_id, pem FROM public_keys WHERE ring = ? AND name = ? LIMIT 1", (OWN_RING, name))
+        return self.lazy_key(int(rows[0][0]), rows[0][1]).key if rows else None
+
+    def list_public_key_ring(self) -> list:
+        rows = self.query("SELECT key_id, pem, user_id, timestamp, name FROM public_keys WHERE ring = ?", (PUBLIC_RING,))
+        return [(int(key_id), pem, user_id, datetime.fromisoformat(timestamp), name, self.lazy_key(int(key_id), pem).fingerprint)
+            for key_id, pem, user_id, timestamp, name in rows]
+
+    def key_count(self):
+        return self.query("SELECT COUNT(*) FROM public_keys WHERE ring = ?", (OWN_RING,))[0][0]
+
+    def public_ring_key_count(self):
+        return self.query("SELECT COUNT(*) FROM public_keys WHERE ring = ?", (PUBLIC_RING,))[0][0]
+
+    def parsed_key_count(self):
+        return sum(1 for lazy_key in list(self.parsed_keys.values()) if lazy_key.is_parsed())
+
+
+class SQLitePrivateKeyStore(ks.PrivateKeyStore):
+
+    def __init__(self, db_filename='keys.db', unlock_cache_size=0, unlock_ttl=300):
+        self.db_filename = db_filename
+        self.conn = connect(db_filename)
+        self.db_lock = threading.Lock()
+        self.unlock_cache = ks.UnlockedKeyCache(unlock_cache_size, unlock_ttl) if unlock_cache_size > 0 else None
+        self.changes = 0
+
+    def query(self, sql, params=()):
+        with self.db_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        with self.db_lock, self.conn:
+            self.conn.execute(sql, params)
+        self.changes += 1
+
+    def change_count(self):
+        return (self.changes, self.query("PRAGMA data_version")[0][0])
+
+    def add_key(self, public_key: rsa.RSAPublicKey, private_key: rsa.RSAPrivateKey, user_id: str, key_passwd: str, name: str):
+        key_id = public_key.public_numbers().n % (2 ** 64)
+        encrypted_private_key, key_passwd_hash = self.protect_key(private_key, key_passwd)
+        self.write("INSERT OR REPLACE INTO private_keys VALUES (?, ?, ?, ?, ?, ?)",
+            (str(key_id), encrypted_private_key.decode('utf-8'), key_passwd_hash, user_id, datetime.now().isoformat(), name))
+        self.lock(key_id)
+
+    def remove_key(self, key_id):
+        self.write("DELETE FROM private_keys WHERE key_id = ?", (str(key_id),))
+        self.lock(key_id)
+
+    def list_keys(self) -> list:
+        rows = self.query("SELECT key_id, encrypted_pem, passwd_hash, user_id, timestamp, name FROM private_keys")
+        return [(int(key_id), pem.encode('utf-8'), passwd_hash, user_id, datetime.fromisoformat(timestamp), name)
+            for key_id, pem, passwd_hash, user_id, timestamp, name in rows]
+
+    def key_count(self):
+        return self.query("SELECT COUNT(*) FROM private_keys")[0][0]
+
+    def unlock_rows(self, rows, key_passwd):
+        key_passwd_hash = self.protect_passwd(key_passwd)
+        return [self.unlock(int(key_id), pem.encode('utf-8'), key_passwd) for key_id, pem, passwd_hash in rows if passwd_hash == key_passwd_hash]
+
+    @staticmethod
+    def protect_passwd(key_passwd: str):
+        return hashlib.sha1(key_passwd.encode()).hexdigest()
+
+    def get_key_by_kid(self, keyId: int, key_passwd: str) -> rsa.RSAPrivateKey:
+        keys = self.unlock_rows(self.query("SELECT key_id, encrypted_pem, passwd_hash FROM private_keys WHERE key_id = ?", (str(keyId),)), key_passwd)
+        return keys[0] if keys else None
+
+    def get_key_by_uid(self, userId: str, key_passwd: str) -> list:
+        return self.unlock_rows(self.query("SELECT key_id, encrypted_pem, passwd_hash FROM private_keys WHERE user_id = ?", (userId,)), key_passwd)
+
+    def get_uid_by_kid(self, keyId: int) -> str:
+        rows = self.query("SELECT user_id FROM private_keys WHERE key_id = ?", (str(keyId),))
+        return rows[0][0] if rows else None
+
+    def get_key_by_name(self, name: str, key_passwd: str) -> rsa.RSAPrivateKey:
+        keys = self.unlock_rows(self.query("SELECT key_id, encrypted_pem, passwd_hash FROM private_keys WHERE name = ? LIMIT 1", (name,)), key_passwd)
+        return keys[0] if keys else None
+
+    def export_key(self, key_id, filepath, key_passwd):
+        rows = self.query("SELECT encrypted_pem, passwd_hash FROM private_keys WHERE key_id = ?", (str(key_id),))
+        if rows and rows[0][1] == self.protect_passwd(key_passwd):
+            with open(filepath, 'wb') as pem_out:
+                pem_out.write(rows[0][0].encode('utf-8'))
+                return True
+        else:
+            return False
+
+
+def import_json_rings(db_filename, filename='private_key_ring.json', public_ring_filename='public_key_ring.json'):
+    """ Copies keys from the JSON rings into the database in one transaction.
+    Keys are copied as PEM text, nothing is parsed or decrypted.
+    Returns the number of (private, own public, imported public) keys """
+    def read_ring(ring_filename, store_name):
+        try:
+            with open(ring_filename, 'r') as file:
+                return json.load(file).get(store_name, {})
+        except FileNotFoundError:
+            return {}
+
+    private_keys = read_ring(filename, 'private_key_store')
+    own_keys = read_ring(filename, 'public_key_store')
+    public_keys = read_ring(public_ring_filename, 'public_key_store')
+    conn = connect(db_filename)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO private_keys VALUES (?, ?, ?, ?, ?, ?)",
+            [(k, v[0], v[1], v[2], v[3], v[4]) for k, v in private_keys.items()])
+        conn.executemany("INSERT OR REPLACE INTO public_keys VALUES (?, ?, ?, ?, ?, ?)",
+            [(OWN_RING, k, v[0], v[1], v[2], v[3]) for k, v in own_keys.items()]
+            + [(PUBLIC_RING, k, v[0], v[1], v[2], v[3]) for k, v in public_keys.items()])
+    conn.close()
+    return len(private_keys), len(own_keys), len(public_keys)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python sqlite_key_store.py keys.db [private_key_ring.json] [public_key_ring.json]")
+        sys.exit(1)
+    counts = import_json_rings(*sys.argv[1:4])
+    print(" [*]\tImported %d private, %d own public and %d public keys into %s" % (counts + (sys.argv[1],)))
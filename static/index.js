@@ -30,6 +30,9 @@ $(document).ready(function () {
 
     form_data.append("aes_enc_msg", $("#aes_enc_msg").is(":checked"));
     form_data.append("des3_enc_msg", $("#3des_enc_msg").is(":checked"));
+    form_data.append("aes_gcm_enc_msg", $("#aes_gcm_enc_msg").is(":checked"));
+    form_data.append("chacha20_enc_msg", $("#chacha20_enc_msg").is(":checked"));
+    form_data.append("segmented", $("#segmented").is(":checked"));
     form_data.append("private_key_id", selectedPrivateKey.id);
     form_data.append("private_key_password", selectedPrivateKey.password);
     form_data.append("public_key_id", selectedPublicKey.id);
@@ -295,9 +298,14 @@ $(document).ready(function () {
       type: "POST",
       contentType: "application/json",
       data: JSON.stringify(formData),
-      success: function (response) {
-        alert(response.message);
+      success: function (response, textStatus, jqXHR) {
         $("#generateKeyModal").modal("hide");
+        if (jqXHR.status === 202) {
+          // no ready key pair of this size, the server generates one in the background
+          pollKeyJob(response.status_url);
+          return;
+        }
+        alert(response.message);
         location.reload(); // Refreshes the page to show the new key pair
       },
       error: function (error) {
@@ -307,6 +315,30 @@ $(document).ready(function () {
     });
   });
 
+  function pollKeyJob(statusUrl) {
+    $.ajax({
+      url: statusUrl,
+      type: "GET",
+      success: function (job) {
+        if (job.status === "pending") {
+          setTimeout(function () {
+            pollKeyJob(statusUrl);
+          }, 1000);
+        } else if (job.status === "done") {
+          alert(job.result.message);
+          location.reload();
+        } else {
+          alert("Error generating key pair");
+          console.log(job.error);
+        }
+      },
+      error: function (error) {
+        alert("Error generating key pair");
+        console.log(error);
+      },
+    });
+  }
+
   // Handle form submission for importing public key
   $("#importPublicKeyForm").submit(function (event) {
     event.preventDefault();